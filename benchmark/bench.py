@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Asher256 <asher256@gmail.com>
+# License: LGPL 2.1
+#
+# Github repo: https://github.com/Asher256/dockerfile-patch/
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Benchmark the dockerfile-patch pipeline offline (fake Docker client).
+
+The benchmarks use synthetic Dockerfiles and Jinja2 patches. The report is
+written in the JSON format:
+
+    python3 benchmark/bench.py [--quick] [--output bench_output.txt]
+
+"""
+
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+from collections import OrderedDict
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+# pylint: disable=wrong-import-position
+import dockerfile_patch  # noqa: E402
+from dockerfile_patch import protocol  # noqa: E402
+from fake_docker import FakeDockerClient  # noqa: E402
+from fake_registry import FakeRegistry  # noqa: E402
+
+
+# The full grid of parameters (--quick uses the first values)
+INSTRUCTIONS = (1, 100, 1000, 10000)
+STAGES = (1, 10, 50)
+TEMPLATES = (1, 10, 50)
+FACTS = (100, 10000)
+JOBS = (1, 4)
+
+# The modules that must not be imported by 'import dockerfile_patch'
+HEAVY_MODULES = ('docker', 'yaml', 'jinja2', 'requests', 'urllib.request')
+
+TEMPLATE = """{% if osfamily == 'Debian' %}
+RUN apt-get update && apt-get install -y ca-certificates # {{ index }}
+{% else %}
+RUN echo '{{ operatingsystem }} {{ architecture }}' # {{ index }}
+{% endif %}
+"""
+
+
+def percentile(values, percent):
+    """Return the percentile of a list of values (nearest rank)."""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    rank = max(0, int(round(percent / 100.0 * len(values) + 0.5)) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+def summarize(durations):
+    """Return the latency statistics of a list of durations (seconds)."""
+    return OrderedDict((('count', len(durations)),
+                        ('mean', sum(durations) / len(durations)
+                         if durations else 0.0),
+                        ('p50', percentile(durations, 50)),
+                        ('p90', percentile(durations, 90)),
+                        ('p99', percentile(durations, 99)),
+                        ('max', max(durations) if durations else 0.0)))
+
+
+def synthetic_dockerfile(instructions, stages, images=10):
+    """Return a Dockerfile with 'instructions' split into 'stages'."""
+    lines = []
+    per_stage = max(1, instructions // stages)
+    for stage in range(stages):
+        lines.append('FROM image{}:latest'.format(stage % images))
+        for index in range(per_stage - 1):
+            if index % 10 == 9:
+                lines.append('# comment {}'.format(index))
+            elif index % 10 == 8:
+                lines.append('RUN echo {} && \\\n    echo continued'
+                             .format(index))
+            else:
+                lines.append('ENV VAR_{}_{}=value'.format(stage, index))
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_templates(directory, count):
+    """Write 'count' Jinja2 patches and return their paths."""
+    paths = []
+    for index in range(count):
+        path = os.path.join(directory, 'patch{}.j2'.format(index))
+        with open(path, 'w') as fhandler:
+            fhandler.write(TEMPLATE.replace('{{ index }}', str(index)))
+        paths.append(path)
+    return paths
+
+
+def measure(function, repeat):
+    """Run 'function' 'repeat' times.
+
+    The peak memory is measured by an extra run (tracemalloc slows down
+    the timed runs).
+
+    Return: (durations, peak memory in bytes)
+
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return durations, peak
+
+
+def result(name, params, durations, peak, units=1, extra=None):
+    """Return a benchmark result."""
+    total = sum(durations)
+    item = OrderedDict((('name', name),
+                        ('params', params),
+                        ('throughput', units * len(durations) / total
+                         if total else 0.0),
+                        ('latency', summarize(durations)),
+                        ('peak_memory_bytes', peak)))
+    if extra:
+        item.update(extra)
+    return item
+
+
+def bench_startup(repeat):
+    """Cold start: 'import dockerfile_patch' and 'dockerfile-patch --help'.
+
+    Each run is a new Python process (nothing is cached in memory).
+
+    """
+    results = []
+    check_imports = ('import sys, json, dockerfile_patch; '
+                     'print(json.dumps([name for name in {!r} '
+                     'if name in sys.modules]))'.format(HEAVY_MODULES))
+    commands = (('import dockerfile_patch',
+                 [sys.executable, '-c', check_imports]),
+                ('dockerfile-patch --help',
+                 [sys.executable, os.path.join(ROOT_DIR, 'dockerfile-patch'),
+                  '--help']))
+    for name, command in commands:
+        durations = []
+        output = b''
+        for _ in range(repeat):
+            start = time.perf_counter()
+            output = subprocess.check_output(command, cwd=ROOT_DIR)
+            durations.append(time.perf_counter() - start)
+
+        extra = None
+        if command[1] == '-c':
+            extra = {'heavy_modules_imported': json.loads(
+                output.decode('utf-8'))}
+        results.append(result(name, OrderedDict(), durations, 0,
+                              extra=extra))
+
+    return results
+
+
+def bench_dockerfile(workdir, repeat, quick):
+    """DockerfilePatcher.load() and to_str()."""
+    results = []
+    for instructions in INSTRUCTIONS[:2] if quick else INSTRUCTIONS:
+        for stages in STAGES[:2] if quick else STAGES:
+            if stages > instructions:
+                continue
+
+            dockerfile_dir = tempfile.mkdtemp(dir=workdir)
+            with open(os.path.join(dockerfile_dir, 'Dockerfile'), 'w') \
+                    as fhandler:
+                fhandler.write(synthetic_dockerfile(instructions, stages))
+
+            params = OrderedDict((('instructions', instructions),
+                                  ('stages', stages)))
+
+            patcher = dockerfile_patch.DockerfilePatcher()
+            durations, peak = measure(lambda: patcher.load(dockerfile_dir),
+                                      repeat)
+            results.append(result('DockerfilePatcher.load', params,
+                                  durations, peak, units=instructions))
+
+            for image in patcher.get_base_images():
+                patcher.add_patch(image, 'RUN echo patched')
+            durations, peak = measure(patcher.to_str, repeat)
+            results.append(result('DockerfilePatcher.to_str', params,
+                                  durations, peak, units=instructions))
+
+    return results
+
+
+def fact_output(count, fact_format):
+    """Return the output of a fact script with 'count' facts."""
+    facts = OrderedDict(('package_{}'.format(index),
+                         '{}.{}-1ubuntu: x'.format(index // 100, index))
+                        for index in range(count))
+    if fact_format == 'json':
+        content = json.dumps(facts).encode('utf-8')
+    elif fact_format == 'nul':
+        content = ''.join('{}={}\0'.format(key, value)
+                          for key, value in facts.items()).encode('utf-8')
+    else:
+        content = ''.join('{}: "{}"\n'.format(key, value)
+                          for key, value in facts.items()).encode('utf-8')
+
+    return '{} {} 000001 {} {}\n'.format(
+        protocol.HEADER.decode('ascii'), protocol.FACTS_PROTOCOL,
+        fact_format, len(content)).encode('ascii') + content
+
+
+def bench_parse_facts(repeat, quick):
+    """protocol.parse_output() of a fact-heavy script in each format."""
+    results = []
+    for count in FACTS[:1] if quick else FACTS:
+        for fact_format, _ in protocol.FACT_FILES:
+            output = fact_output(count, fact_format)
+            durations, peak = measure(
+                lambda: protocol.parse_output(output, ['packages']), repeat)
+            results.append(result('protocol.parse_output',
+                                  OrderedDict((('facts', count),
+                                               ('format', fact_format))),
+                                  durations, peak, units=count))
+
+    return results
+
+
+def bench_gather_facts(latencies, repeat, quick):
+    """DockerFact.gather_facts_many() with the fake Docker client.
+
+    The fact engine 'registry' uses the fake registry (the latencies
+    'manifest' and 'blob').
+
+    """
+    results = []
+    registry = FakeRegistry(latencies=latencies).start()
+    for fact_engine in dockerfile_patch.FACT_ENGINES:
+        images = ['image{}:latest'.format(index) for index in range(10)]
+        recorders = [registry.recorder]
+        if fact_engine == 'registry':
+            images = [registry.address + '/' + image for image in images]
+
+        for jobs in JOBS[:1] if quick else JOBS:
+            def run():
+                """Gather the facts of all images."""
+                client = FakeDockerClient(latencies=latencies)
+                recorders.append(client.recorder)
+                docker_facter = dockerfile_patch.DockerFact(
+                    fact_engine=fact_engine, docker_client=client)
+                docker_facter.add_fact_script(
+                    dockerfile_patch.DEFAULT_FACTS_SCRIPT)
+                docker_facter.gather_facts_many(images, jobs=jobs)
+
+            registry.recorder.durations.clear()
+            del recorders[1:]
+            durations, peak = measure(run, repeat)
+            stages = {}
+            for recorder in recorders:
+                for operation, values in recorder.durations.items():
+                    stages.setdefault(operation, []).extend(values)
+
+            results.append(result(
+                'DockerFact.gather_facts_many',
+                OrderedDict((('images', len(images)),
+                             ('fact_engine', fact_engine),
+                             ('jobs', jobs))),
+                durations, peak, units=len(images),
+                extra={'stages': OrderedDict(
+                    (operation, summarize(values))
+                    for operation, values in sorted(stages.items()))}))
+
+    registry.stop()
+    return results
+
+
+def bench_pipeline(workdir, latencies, repeat, quick):
+    """dockerfile_patch() end-to-end with the fake Docker client."""
+    results = []
+    template_env = dockerfile_patch.template_environment(
+        os.path.join(workdir, 'jinja2'))
+    for templates in TEMPLATES[:2] if quick else TEMPLATES:
+        template_dir = tempfile.mkdtemp(dir=workdir)
+        patches = write_templates(template_dir, templates)
+
+        for stages in STAGES[:2] if quick else STAGES:
+            dockerfile_dir = tempfile.mkdtemp(dir=workdir)
+            with open(os.path.join(dockerfile_dir, 'Dockerfile'), 'w') \
+                    as fhandler:
+                fhandler.write(synthetic_dockerfile(stages * 20, stages))
+
+            def run():
+                """Patch the Dockerfile."""
+                docker_facter = dockerfile_patch.DockerFact(
+                    docker_client=FakeDockerClient(latencies=latencies))
+                dockerfile_patch.dockerfile_patch(
+                    dockerfile_dir, patches,
+                    [dockerfile_patch.DEFAULT_FACTS_SCRIPT],
+                    jobs=4, template_env=template_env,
+                    docker_facter=docker_facter)
+
+            durations, peak = measure(run, repeat)
+            results.append(result('dockerfile_patch',
+                                  OrderedDict((('templates', templates),
+                                               ('stages', stages))),
+                                  durations, peak))
+
+    return results
+
+
+def parse_args():
+    """Parse the arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-o', '--output', default=None,
+                        help='A file where the JSON report will be saved '
+                        '(default: stdout)')
+    parser.add_argument('-q', '--quick', action='store_true', default=False,
+                        help='Run a small subset of the benchmarks')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='The number of runs of each benchmark')
+    for operation, default in (('pull', 0.05), ('inspect', 0.005),
+                               ('run', 0.2), ('save', 0.05),
+                               ('manifest', 0.02), ('blob', 0.02)):
+        parser.add_argument('--{}-latency'.format(operation), type=float,
+                            default=default,
+                            help='The latency of the fake docker {} '
+                            '(seconds, default: {})'.format(operation,
+                                                            default))
+    return parser.parse_args()
+
+
+def main():
+    """The program starts here."""
+    args = parse_args()
+    latencies = {'pull': args.pull_latency,
+                 'inspect': args.inspect_latency,
+                 'run': args.run_latency,
+                 'save': args.save_latency,
+                 'manifest': args.manifest_latency,
+                 'blob': args.blob_latency}
+
+    workdir = tempfile.mkdtemp(prefix='dockerfile-patch-bench-')
+    try:
+        # the '[RUN] docker pull' messages are not part of the report
+        with contextlib.redirect_stderr(io.StringIO()):
+            results = bench_startup(args.repeat)
+            results += bench_dockerfile(workdir, args.repeat, args.quick)
+            results += bench_parse_facts(args.repeat, args.quick)
+            results += bench_gather_facts(latencies, args.repeat,
+                                          args.quick)
+            results += bench_pipeline(workdir, latencies, args.repeat,
+                                      args.quick)
+    finally:
+        shutil.rmtree(workdir)
+
+    report = OrderedDict((('python', platform.python_version()),
+                          ('platform', platform.platform()),
+                          ('repeat', args.repeat),
+                          ('latencies', latencies),
+                          ('results', results)))
+
+    content = json.dumps(report, indent=2) + '\n'
+    if args.output:
+        with open(args.output, 'w') as fhandler:
+            fhandler.write(content)
+    else:
+        sys.stdout.write(content)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Asher256 <asher256@gmail.com>
+# License: LGPL 2.1
+#
+# Github repo: https://github.com/Asher256/dockerfile-patch/
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""A stand-in for docker.DockerClient that works offline.
+
+The fake client implements the part of the Docker API used by
+dockerfile_patch (pull, inspect, save, containers) with configurable
+latencies. The fact scripts are not executed: the containers print the
+facts of the fake image.
+
+"""
+
+
+import io
+import json
+import time
+import hashlib
+import tarfile
+import threading
+from collections import defaultdict
+
+import docker.errors
+
+
+# The facts printed by the fake containers (default-facts.sh)
+DEFAULT_FACTS = {'osfamily': 'Debian',
+                 'operatingsystem': 'Linux',
+                 'kernelrelease': '6.1.0-fake',
+                 'architecture': 'x86_64'}
+
+
+def image_digest(image):
+    """Return a stable fake digest of an image name."""
+    return 'sha256:' + hashlib.sha256(image.encode('utf-8')).hexdigest()
+
+
+def make_image_archive(files):
+    """Return a 'docker save' archive (one layer) with 'files'."""
+    layer = io.BytesIO()
+    with tarfile.open(fileobj=layer, mode='w') as layer_tar:
+        for name, content in sorted(files.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            layer_tar.addfile(info, io.BytesIO(content))
+
+    result = io.BytesIO()
+    with tarfile.open(fileobj=result, mode='w') as image_tar:
+        for name, content in (('layer0/layer.tar', layer.getvalue()),
+                              ('manifest.json', json.dumps(
+                                  [{'Config': 'config.json',
+                                    'Layers': ['layer0/layer.tar']}])
+                               .encode('utf-8'))):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            image_tar.addfile(info, io.BytesIO(content))
+
+    return result.getvalue()
+
+
+class Recorder(object):
+    """Record the calls and the latencies of the fake client."""
+
+    def __init__(self, latencies=None):
+        """Init the recorder.
+
+        latencies: {'pull': seconds, 'inspect': seconds, 'run': seconds,
+        'save': seconds}
+
+        """
+        self.latencies = dict(latencies or {})
+        self.calls = defaultdict(int)
+        self.durations = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def call(self, operation):
+        """Simulate the latency of an operation and record it."""
+        start = time.perf_counter()
+        latency = self.latencies.get(operation, 0)
+        if latency:
+            time.sleep(latency)
+
+        with self.lock:
+            self.calls[operation] += 1
+            self.durations[operation].append(time.perf_counter() - start)
+
+
+class FakeImages(object):
+    """client.images."""
+
+    def __init__(self, client):
+        """Init."""
+        self.client = client
+
+    def pull(self, image, **kwargs):
+        """docker pull."""
+        self.client.recorder.call('pull')
+        self.client.local_images.add(image)
+
+    def get(self, image):
+        """Raise ImageNotFound if the image was not pulled."""
+        if image not in self.client.local_images:
+            raise docker.errors.ImageNotFound(image)
+        return image
+
+
+class FakeAPI(object):
+    """client.api (low-level API)."""
+
+    def __init__(self, client):
+        """Init."""
+        self.client = client
+
+    def pull(self, image, stream=False, decode=False, **kwargs):
+        """docker pull (a stream of progress events)."""
+        self.client.images.pull(image)
+        events = [{'status': 'Pulling fs layer', 'id': 'layer0'},
+                  {'status': 'Downloading', 'id': 'layer0',
+                   'progressDetail': {'current': 512 * 1024,
+                                      'total': 1024 * 1024}},
+                  {'status': 'Pull complete', 'id': 'layer0'},
+                  {'status': 'Status: Downloaded newer image for ' + image}]
+        if not stream:
+            return events
+        return iter(events)
+
+    def inspect_image(self, image):
+        """docker inspect."""
+        self.client.recorder.call('inspect')
+        if image not in self.client.local_images:
+            raise docker.errors.ImageNotFound(image)
+
+        return {'Id': image_digest(self.client.aliases.get(image, image)),
+                'Os': 'linux',
+                'Architecture': 'amd64',
+                'Size': 1024 * 1024,
+                'Config': {'User': self.client.users.get(image, ''),
+                           'Env': ['PATH=/usr/bin:/bin'],
+                           'Labels': {}}}
+
+    def get_image(self, image, chunk_size=64 * 1024):
+        """docker save (a stream of bytes)."""
+        self.client.recorder.call('save')
+        data = make_image_archive({'etc/debian_version': b'12.0\n',
+                                   'etc/os-release': b'ID=debian\n'})
+        for index in range(0, len(data), chunk_size):
+            yield data[index:index + chunk_size]
+
+
+class FakeContainer(object):
+    """A container created by client.containers.create()."""
+
+    def __init__(self, client, image):
+        """Init."""
+        self.client = client
+        self.image = image
+        self.id = hashlib.sha256(repr(id(self)).encode()).hexdigest()[:12]
+        self.files = {}
+
+    def put_archive(self, path, data):
+        """docker cp."""
+        with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+            for member in archive:
+                if member.isfile():
+                    self.files[member.name] = \
+                        archive.extractfile(member).read()
+        return True
+
+    def start(self):
+        """docker start."""
+        self.client.recorder.call('run')
+
+    def wait(self, timeout=None):
+        """docker wait."""
+        return {'StatusCode': 0}
+
+    def logs(self, stdout=True, stderr=True):
+        """docker logs (the facts of the first script, 'facts.nul')."""
+        if not stdout:
+            return b''
+        facts = ''.join('{}={}\0'.format(key, value)
+                        for key, value in DEFAULT_FACTS.items()) \
+            .encode('utf-8')
+        return 'DOCKERFILE-PATCH-FACTS 2 000001 nul {}\n'.format(len(facts)) \
+            .encode('ascii') + facts
+
+    def kill(self):
+        """docker kill."""
+
+    def remove(self, force=False):
+        """docker rm."""
+        self.client.removed_containers += 1
+
+
+class FakeContainers(object):
+    """client.containers."""
+
+    def __init__(self, client):
+        """Init."""
+        self.client = client
+
+    def create(self, image, command=None, **kwargs):
+        """docker create."""
+        return FakeContainer(self.client, image)
+
+
+class FakeDockerClient(object):
+    """A fake docker.DockerClient."""
+
+    def __init__(self, latencies=None, aliases=None, users=None):
+        """Init the fake client.
+
+        latencies: {'pull': seconds, 'inspect': seconds, 'run': seconds,
+        'save': seconds}
+        aliases: {'image': 'other image'} (the same digest)
+        users: {'image': 'USER'}
+
+        """
+        self.recorder = Recorder(latencies)
+        self.aliases = dict(aliases or {})
+        self.users = dict(users or {})
+        self.local_images = set()
+        self.removed_containers = 0
+        self.images = FakeImages(self)
+        self.api = FakeAPI(self)
+        self.containers = FakeContainers(self)
+
+    def version(self):
+        """docker version."""
+        return {'KernelVersion': DEFAULT_FACTS['kernelrelease']}
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Asher256 <asher256@gmail.com>
+# License: LGPL 2.1
+#
+# Github repo: https://github.com/Asher256/dockerfile-patch/
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""A stand-in for a Docker registry that works offline.
+
+The fake registry serves the same multi-arch image (linux/amd64 and
+linux/arm64, Debian) for every repository and tag, with an optional latency
+and an optional token authentication. The base layer ends with a large file
+that the fact engine 'registry' is not supposed to download.
+
+"""
+
+
+import io
+import gzip
+import json
+import time
+import hashlib
+import tarfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fake_docker import Recorder
+
+
+MANIFEST_LIST = 'application/vnd.docker.distribution.manifest.list.v2+json'
+MANIFEST = 'application/vnd.docker.distribution.manifest.v2+json'
+
+
+def digest(content):
+    """Return the digest of a blob."""
+    return 'sha256:' + hashlib.sha256(content).hexdigest()
+
+
+def make_layer(files):
+    """Return a gzipped layer (a sorted tar archive) with 'files'."""
+    layer = io.BytesIO()
+    with tarfile.open(fileobj=layer, mode='w') as layer_tar:
+        for name, content in sorted(files.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            layer_tar.addfile(info, io.BytesIO(content))
+    return gzip.compress(layer.getvalue(), compresslevel=1)
+
+
+def make_image():
+    """Return (the blobs {digest: content}, the manifest list)."""
+    blobs = {}
+
+    def add(content):
+        """Add a blob and return its descriptor."""
+        blobs[digest(content)] = content
+        return {'digest': digest(content), 'size': len(content)}
+
+    layer = add(make_layer({
+        'etc/debian_version': b'12.0\n',
+        'etc/os-release': b'ID=debian\n',
+        # not read by the fact engine 'registry' (after the target files)
+        'var/lib/large': bytes(bytearray(range(256))) * 32 * 1024}))
+
+    manifests = []
+    for architecture in ('amd64', 'arm64'):
+        config = add(json.dumps({
+            'os': 'linux', 'architecture': architecture,
+            'config': {'User': '', 'Env': ['PATH=/usr/bin:/bin'],
+                       'Labels': {'benchmark': 'true'}}}).encode('utf-8'))
+        manifest = json.dumps({'schemaVersion': 2, 'mediaType': MANIFEST,
+                               'config': config,
+                               'layers': [layer]}).encode('utf-8')
+        descriptor = add(manifest)
+        descriptor.update({'mediaType': MANIFEST,
+                           'platform': {'os': 'linux',
+                                        'architecture': architecture}})
+        manifests.append(descriptor)
+
+    manifest_list = json.dumps({'schemaVersion': 2,
+                                'mediaType': MANIFEST_LIST,
+                                'manifests': manifests}).encode('utf-8')
+    return blobs, manifest_list
+
+
+class FakeRegistry(object):
+    """A registry (HTTP API V2) running in a thread."""
+
+    def __init__(self, latencies=None, token=None):
+        """Init the fake registry.
+
+        latencies: {'manifest': seconds, 'blob': seconds}
+        token: the Bearer token required by the registry (None = no
+        authentication)
+
+        """
+        self.recorder = Recorder(latencies)
+        self.token = token
+        self.blobs, self.manifest_list = make_image()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                          self._handler_class())
+        self.server.daemon_threads = True
+        self.address = '127.0.0.1:{}'.format(self.server.server_port)
+        self.thread = None
+
+    def _handler_class(self):
+        """Return the request handler of this registry."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """The requests of the registry API."""
+
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                """Quiet."""
+
+            def send(self, code, content=b'', headers=None):
+                """Send a response."""
+                self.send_response(code)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                try:
+                    self.wfile.write(content)
+                except OSError:
+                    # the client stopped reading (early stop)
+                    pass
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """GET /token, /v2/<name>/manifests/<ref>, /v2/.../blobs/."""
+                if self.path.startswith('/token'):
+                    self.send(200, json.dumps(
+                        {'token': registry.token}).encode('utf-8'))
+                    return
+
+                if registry.token and self.headers.get('Authorization') != \
+                        'Bearer ' + registry.token:
+                    self.send(401, headers={
+                        'WWW-Authenticate':
+                        'Bearer realm="http://{}/token",service="fake"'
+                        .format(registry.address)})
+                    return
+
+                name, _, reference = self.path.rpartition('/')
+                if name.endswith('/manifests'):
+                    registry.recorder.call('manifest')
+                    if reference.startswith('sha256:'):
+                        content = registry.blobs.get(reference)
+                        media_type = MANIFEST
+                    else:
+                        content = registry.manifest_list
+                        media_type = MANIFEST_LIST
+                elif name.endswith('/blobs'):
+                    registry.recorder.call('blob')
+                    content = registry.blobs.get(reference)
+                    media_type = 'application/octet-stream'
+                else:
+                    content = None
+
+                if content is None:
+                    self.send(404)
+                    return
+
+                self.send(200, content, {'Content-Type': media_type,
+                                         'Docker-Content-Digest':
+                                         digest(content)})
+
+        return Handler
+
+    def start(self):
+        """Start the registry (in a thread)."""
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop the registry."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        """Start the registry."""
+        return self.start()
+
+    def __exit__(self, *args):
+        """Stop the registry."""
+        self.stop()
+
+
+if __name__ == '__main__':
+    with FakeRegistry() as REGISTRY:
+        print('Fake registry: http://{}/v2/'.format(REGISTRY.address))
+        while True:
+            time.sleep(3600)
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
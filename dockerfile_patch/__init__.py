@@ -17,65 +17,233 @@ import os
 import logging
 import platform
 import tempfile
-import shutil
+import tarfile
 import argparse
 import signal
 import gc
+import json
+import io
+import time
+import hashlib
+import fcntl
+import threading
+import glob
+import random
+import weakref
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 from collections import OrderedDict
-from copy import deepcopy
-import yaml
-import docker
-from dockerfile_parse import DockerfileParser
-from jinja2 import Template
+# docker, yaml, jinja2 and .registry are imported when they are used (fast
+# startup of 'dockerfile-patch --help' and of the Docker-free paths)
+from .instructions import parse_dockerfile, build_stages
+from .protocol import main_script, parse_output, script_namespaces, \
+    script_provides, NAMESPACES_FACT
+from .static_facts import gather_static_facts
+from .instrumentation import Instrumentation
 
 
 assert platform.system() == 'Linux', 'The operating system needs to be Linux'
 assert sys.version_info >= (3, 3), "The Python version needs to be >= 3.3"
 
 
+# default facts gatherer
+DEFAULT_FACTS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    'data', 'default-facts.sh')
+
+# 'container': run all fact scripts in a container
+# 'static': read the default facts from the image files (no container)
+# 'registry': read the default facts from the registry (no pull)
+FACT_ENGINES = ('container', 'static', 'registry')
+
+# The facts known without fact script (docker inspect, image config)
+IMAGE_FACTS = frozenset(('docker_image_user',))
+
+# The facts added to the default facts by a fact engine
+ENGINE_FACTS = {'registry': frozenset(('image_digest', 'image_env',
+                                       'image_labels', 'platforms'))}
+
+# When the Docker images are pulled (like Kubernetes' imagePullPolicy). The
+# images pinned by digest (image@sha256:...) are never pulled again.
+PULL_POLICIES = ('always', 'if-not-present', 'never')
+
+# The transient errors of the Docker daemon and of the registries are
+# retried (the delay doubles after each attempt)
+DEFAULT_RETRIES = 2
+RETRY_DELAY = 1.0
+
+# The HTTP status and the messages of the transient errors (the Docker daemon
+# returns 500 for most errors: a 500 is only transient with one of the
+# messages). The registry client uses the same status.
+TRANSIENT_STATUS = (408, 429, 502, 503, 504)
+TRANSIENT_MESSAGES = ('timeout', 'timed out', 'connection reset',
+                      'connection refused', 'too many requests',
+                      'toomanyrequests', 'temporarily unavailable',
+                      'service unavailable', 'bad gateway', 'unexpected eof')
+
+# The DockerFact instances cancelled on SIGINT and SIGTERM
+_ACTIVE_FACTERS = weakref.WeakSet()
+
+
+def default_cache_dir(name=None):
+    """Return the cache directory of dockerfile-patch.
+
+    name: a sub-directory (e.g. 'facts')
+
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME',
+                                os.path.join(os.path.expanduser('~'),
+                                             '.cache'))
+    path = os.path.join(cache_home, 'dockerfile-patch')
+    if name:
+        path = os.path.join(path, name)
+    return path
+
+
+class DockerfilePatchError(Exception):
+    """An error that stops the patching of a Dockerfile."""
+
+
+class TransientError(DockerfilePatchError):
+    """A temporary error of the Docker daemon or of a registry (retried)."""
+
+
+def transient_error(err):
+    """Return True if an exception is a temporary error (can be retried)."""
+    if isinstance(err, TransientError):
+        return True
+    if getattr(err, 'transient', False):
+        # registry.RegistryError
+        return True
+
+    import docker.errors
+    import requests.exceptions
+
+    if isinstance(err, docker.errors.APIError):
+        if err.status_code in TRANSIENT_STATUS:
+            return True
+        return err.is_server_error() and \
+            any(message in str(err).lower() for message in TRANSIENT_MESSAGES)
+    return isinstance(err, (requests.exceptions.ConnectionError,
+                            requests.exceptions.Timeout))
+
+
 class DockerfilePatcher(object):
     """Load a Dockerfile and patch it."""
 
-    def __init__(self):
-        """Init the class."""
-        # empty DockerfileParser
+    def __init__(self, build_args=None):
+        """Init the class.
+
+        build_args: the values of the ARGs used by the FROM lines
+        {'name': 'value'} (like 'docker build --build-arg')
+
+        """
+        self.build_args = dict(build_args or {})
+        # the instructions (Instruction records, see instructions.py)
         self.structure = []
-        self.patches = []
+        # the indexes of the FROM instructions in self.structure
+        self.from_index = []
+        # the stages (Stage, one per FROM instruction)
+        self.stages = []
+        # {'image': patch}
+        self.patches = OrderedDict()
         self.logging = logging.getLogger(__name__ + '.' +
                                          self.__class__.__name__)
 
     def load(self, path):
-        """Load a Dockerfile."""
-        dfp = DockerfileParser(path=path)
-        self.structure = deepcopy(dfp.structure)
+        """Load a Dockerfile (path: the file or its directory)."""
+        if os.path.isdir(path):
+            path = os.path.join(path, 'Dockerfile')
+
+        # newline='': the end of lines are kept as they are
+        with open(path, 'r', encoding='utf-8', newline='') as fhandler:
+            content = fhandler.read()
+
+        self._parse(content)
         self.logging.debug("[DOCKERFILE PATCHER] '%s' loaded:\n%s",
-                           os.path.join(path, 'Dockerfile'),
-                           dfp.content)
+                           path, content)
+
+    def loads(self, content):
+        """Load the content of a Dockerfile (a string)."""
+        self._parse(content)
+        self.logging.debug("[DOCKERFILE PATCHER] Dockerfile loaded:\n%s",
+                           content)
+
+    def _parse(self, content):
+        """Parse the instructions and the stages of a Dockerfile."""
+        self.structure, self.from_index = parse_dockerfile(content)
+        try:
+            self.stages = build_stages(self.structure, self.from_index,
+                                       self.build_args)
+        except ValueError as err:
+            raise DockerfilePatchError(str(err))
+        self.logging.debug("[DOCKERFILE PATCHER] Stages: %s",
+                           str(self.stages))
+
+        platforms = [stage for stage in self.stages
+                     if stage.platform and stage.parent is None]
+        if platforms:
+            from .registry import default_platform
+
+            host_platform = default_platform()
+            for stage in platforms:
+                if stage.platform != host_platform:
+                    self.logging.warning(
+                        "[WARNING] 'FROM --platform=%s %s': the facts are "
+                        "gathered for the platform of this host (%s)",
+                        stage.platform, stage.image, host_platform)
 
     def save(self, path, patch=True):
         """Save a patched version of the Dockerfile."""
-        with open(path, 'w') as fhandler:
-            fhandler.write(self.to_str(patch=patch))
+        # newline='': the end of lines are written as they were loaded
+        with open(path, 'w', encoding='utf-8', newline='') as fhandler:
+            self.write_to(fhandler, patch=patch)
+
+    def save_if_changed(self, path, patch=True):
+        """Save the Dockerfile unless 'path' already has the same content.
+
+        The content is compared by digest (the patched Dockerfile is
+        streamed, not built in memory).
+
+        Return: True if the file was written.
+
+        """
+        digest = hashlib.sha256()
+        for item in self.iter_lines(patch=patch):
+            digest.update(item.encode('utf-8'))
+        if digest.hexdigest() == file_digest(path):
+            return False
+
+        self.save(path, patch=patch)
+        return True
 
     def get_images(self, image=None):
         """Get all values of FROM in the Dockerfile."""
 
         result = []
         image_names = set()
-        for item in self.structure:
-            if item['instruction'].upper() != 'FROM':
-                continue
-
-            if image and item['value'] != image:
+        for index in self.from_index:
+            item = self.structure[index]
+            if image and item.value != image:
                 continue
 
             result.append(item)
-            image_names.add(item['value'])
+            image_names.add(item.value)
 
         self.logging.debug("[DOCKERFILE PATCHER] Base images detected in "
                            "the Dockerfile: %s", str(list(image_names)))
         return result
 
+    def get_base_images(self):
+        """Return the external images of the Dockerfile (without duplicates).
+
+        The stage aliases ('FROM build') are resolved to the image of their
+        first ancestor, 'scratch' is skipped and the ARGs are substituted.
+
+        """
+        return list(OrderedDict.fromkeys(stage.root_image
+                                         for stage in self.stages
+                                         if stage.root_image))
+
     def add_patch(self, image, content, patch_name=None):
         """Patch an image with a Dockerfile content.
 
@@ -88,316 +256,1781 @@ class DockerfilePatcher(object):
         Same thing with 'image' parameter.
 
         """
+        image = image.strip()
         if image in self.patches:
             raise KeyError("The image '{}' exists already.".format(image))
 
         self.logging.debug("[DOCKERFILE PATCHER] Patch for '%s' created:\n%s",
                            image, content)
 
-        image = image.strip()
-        self.patches.append({'image': image,
-                             'patch_name': patch_name,
-                             'content': content})
+        # the comment before and after the patch
+        patch_comment = "#" + ('-' * 8) + " '" + image + \
+            "' dockerfile-patch"
+        if patch_name:
+            patch_comment += ': ' + patch_name
+        patch_comment += ' ' + ('-' * 8)
+
+        self.patches[image] = {'image': image,
+                               'patch_name': patch_name,
+                               'content': content,
+                               'text': '\n' + patch_comment + '\n' +
+                                       content + '\n' + patch_comment +
+                                       '\n' * 2}
+
+    def iter_lines(self, patch=True):
+        """Yield the patched version of the Dockerfile (piece by piece)."""
+        structure = self.structure
+        start = 0
+        for stage in self.stages if patch else ():
+            index = stage.index
+            for position in range(start, index + 1):
+                yield structure[position].content
+            start = index + 1
+
+            # the derived stages ('FROM base') inherit the patch of their
+            # parent stage: only the stages of external images are patched
+            if stage.parent is not None:
+                continue
+            patch_item = self.patches.get(stage.root_image)
+            if patch_item:
+                yield patch_item['text']
+
+        for position in range(start, len(structure)):
+            yield structure[position].content
+
+    def write_to(self, fhandler, patch=True):
+        """Write the patched version of the Dockerfile to a file object."""
+        for item in self.iter_lines(patch=patch):
+            fhandler.write(item)
 
     def to_str(self, patch=True):
         """Return a patched version of the Dockerfile."""
-        result = ''
+        return ''.join(self.iter_lines(patch=patch))
 
-        # the endlines of all FROM (first endline=0)
-        endlines = {}
-        for item in self.get_images():
-            endlines[item['endline']] = item['value']
 
-        for item in self.structure:
-            result += item['content']
+class FactCache(object):
+    """Persistent on-disk cache of the facts gathered from Docker images.
 
-            if not patch:
-                continue
+    Each entry is a JSON file named after a key derived from the image
+    content digest and the content of the fact scripts. The entries are
+    written atomically (temporary file + rename), which makes the cache safe
+    to share between parallel processes running on the same host.
+
+    """
+
+    def __init__(self, path=None, max_entries=1024, max_age=7 * 24 * 3600):
+        """Init the cache.
+
+        path: the directory where the facts are stored (default:
+        $XDG_CACHE_HOME/dockerfile-patch/facts).
+        max_entries: the maximum number of entries kept by evict().
+        max_age: entries older than 'max_age' seconds are ignored and
+        deleted.
 
-            if item['instruction'] == 'FROM':
-                # baseimage = item['value']
-                for patch_item in self.patches:
-                    patch_comment = "#" + ('-' * 8) + " '" + \
-                        item['value'] + \
-                        "' dockerfile-patch"
+        """
+        if not path:
+            path = default_cache_dir('facts')
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.logging = logging.getLogger(__name__ + '.' +
+                                         self.__class__.__name__)
 
-                    if patch_item['patch_name']:
-                        patch_comment += ': ' + patch_item['patch_name']
+    @staticmethod
+    def key(image_id, fact_scripts, engine='container'):
+        """Return the cache key of an image.
 
-                    patch_comment += ' '
-                    patch_comment += ('-' * 8)
+        image_id: the content digest of the image ('Id' of docker inspect)
+        fact_scripts: the content of the fact scripts (list of strings)
+        engine: the fact engine that gathered the facts
+
+        """
+        scripts_hash = hashlib.sha256()
+        if engine != 'container':
+            scripts_hash.update(engine.encode('utf-8') + b'\0')
+        for content in fact_scripts:
+            scripts_hash.update(hashlib.sha256(content.encode('utf-8'))
+                                .hexdigest().encode('ascii'))
+
+        result = hashlib.sha256()
+        result.update(image_id.encode('utf-8'))
+        result.update(b'\0')
+        result.update(scripts_hash.hexdigest().encode('ascii'))
+        return result.hexdigest()
+
+    def _entry_path(self, key):
+        """Return the path of a cache entry."""
+        return os.path.join(self.path, key + '.json')
+
+    def get(self, key):
+        """Return the facts stored in the cache (or None)."""
+        path = self._entry_path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                self.logging.debug('[FACT CACHE] Expired entry: %s', path)
+                os.unlink(path)
+                return None
+
+            with open(path, 'r') as fhandler:
+                facts = json.load(fhandler)
+        except (OSError, ValueError):
+            return None
+
+        # the modification time is used by evict() (least recently used)
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        self.logging.debug('[FACT CACHE] Hit: %s', path)
+        return facts
+
+    def set(self, key, facts):
+        """Store the facts in the cache."""
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', prefix='.',
+                                            dir=self.path)
+            with os.fdopen(fd, 'w') as fhandler:
+                json.dump(facts, fhandler, default=str)
+            os.replace(tmp_path, self._entry_path(key))
+        except OSError as err:
+            self.logging.debug('[FACT CACHE] Unable to write the entry '
+                               '%s: %s', key, str(err))
+            return
+
+        self.logging.debug('[FACT CACHE] Stored: %s',
+                           self._entry_path(key))
+        self.evict()
+
+    def _lock(self):
+        """Return a file handler locked exclusively (for evict/purge)."""
+        os.makedirs(self.path, exist_ok=True)
+        fhandler = open(os.path.join(self.path, '.lock'), 'w')
+        fcntl.flock(fhandler, fcntl.LOCK_EX)
+        return fhandler
+
+    def _entries(self):
+        """Return the list of entries [(mtime, path), ...] (oldest first)."""
+        result = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.json') or name.startswith('.'):
+                continue
 
-                    result += '\n'
-                    result += patch_comment
-                    result += '\n' + patch_item['content'] + '\n'
-                    result += patch_comment
-                    result += '\n' * 2
+            path = os.path.join(self.path, name)
+            try:
+                result.append((os.path.getmtime(path), path))
+            except OSError:
+                # deleted by another process
+                continue
 
+        result.sort()
         return result
 
+    def evict(self):
+        """Delete the expired entries and the least recently used ones."""
+        try:
+            with self._lock():
+                entries = self._entries()
+                now = time.time()
+                expired = [path for mtime, path in entries
+                           if now - mtime > self.max_age]
+                alive = [path for mtime, path in entries
+                         if now - mtime <= self.max_age]
+                if len(alive) > self.max_entries:
+                    expired += alive[:len(alive) - self.max_entries]
+
+                for path in expired:
+                    self.logging.debug('[FACT CACHE] Evicted: %s', path)
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+        except OSError as err:
+            self.logging.debug('[FACT CACHE] Unable to evict: %s', str(err))
+
+    def purge(self):
+        """Delete all entries."""
+        if not os.path.isdir(self.path):
+            return
+
+        with self._lock():
+            for _, path in self._entries():
+                self.logging.debug('[FACT CACHE] Purged: %s', path)
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+
+class OutputCache(FactCache):
+    """Persistent cache of the inputs of the patched Dockerfiles.
+
+    Each entry is keyed by the path of a patched Dockerfile and stores
+    {'inputs': digest, 'output': digest} (see dockerfile_patch_batch()).
+    The default path is $XDG_CACHE_HOME/dockerfile-patch/outputs.
+
+    """
+
+    def __init__(self, path=None, max_entries=4096, max_age=30 * 24 * 3600):
+        """Init the cache (see FactCache)."""
+        FactCache.__init__(self, path=path or default_cache_dir('outputs'),
+                           max_entries=max_entries, max_age=max_age)
+
+    @staticmethod
+    def key(output_path):
+        """Return the cache key of a patched Dockerfile."""
+        return hashlib.sha256(os.path.abspath(output_path).encode('utf-8')) \
+            .hexdigest()
+
+
+def make_tar_archive(directory, files):
+    """Return an in-memory tar archive (bytes).
+
+    directory: the directory of the files in the archive
+    files: {'file name': 'content'} (the files are executable)
+
+    """
+    fileobj = io.BytesIO()
+    with tarfile.open(fileobj=fileobj, mode='w') as archive:
+        dir_info = tarfile.TarInfo(directory.strip('/'))
+        dir_info.type = tarfile.DIRTYPE
+        dir_info.mode = 0o755
+        dir_info.mtime = time.time()
+        archive.addfile(dir_info)
+
+        for name, content in files.items():
+            data = content.encode('utf-8')
+            file_info = tarfile.TarInfo(os.path.join(directory.strip('/'),
+                                                     name))
+            file_info.size = len(data)
+            file_info.mode = 0o755
+            file_info.mtime = dir_info.mtime
+            archive.addfile(file_info, io.BytesIO(data))
+
+    return fileobj.getvalue()
+
 
 class DockerFact(object):
     """Patch and build a Dockerfile."""
 
-    def __init__(self):
-        """Build a Yaml."""
-        # these files will be deleted
-        self.tmpfiles = []
+    def __init__(self, fact_cache=None, fact_engine='container',
+                 pull_policy='always', docker_client=None,
+                 instrumentation=None, registry_client=None,
+                 pull_timeout=None, run_timeout=None,
+                 retries=DEFAULT_RETRIES, max_daemon_ops=None):
+        """Build a Yaml.
+
+        fact_cache: a FactCache instance (None = the cache is disabled)
+        fact_engine: 'container', 'static' (the default facts are read
+        from the image files without starting a container) or 'registry'
+        (the default facts are read from the image manifest and config
+        without pulling the image). With 'static' and 'registry', the other
+        fact scripts are still started in a container.
+        pull_policy: 'always', 'if-not-present' or 'never'
+        docker_client: a docker.DockerClient (default: from the environment,
+        connected when the first fact is gathered)
+        instrumentation: an Instrumentation that receives the timings of
+        each stage (pull, inspect, run, ...)
+        registry_client: a registry.RegistryClient (fact engine 'registry')
+        pull_timeout: the deadline of the pull of an image, retries included
+        (seconds, None = no deadline)
+        run_timeout: the deadline of the fact scripts in a container (the
+        container is killed after it, None = no deadline)
+        retries: the number of retries after a transient error of the Docker
+        daemon or of a registry
+        max_daemon_ops: the maximum number of concurrent Docker daemon
+        operations, shared by all threads (None = no limit)
+
+        """
+        # these containers will be deleted
+        self.containers = set()
+        # reentrant: cancel() can be called by a signal handler
+        self._lock = threading.RLock()
+
+        if fact_engine not in FACT_ENGINES:
+            raise ValueError("Unknown fact engine: '{}'".format(fact_engine))
+        if pull_policy not in PULL_POLICIES:
+            raise ValueError("Unknown pull policy: '{}'".format(pull_policy))
+
+        # facts already gathered {'image id': facts}
+        self.facts_by_id = {}
+        # facts returned by gather_facts() {'image': facts} (--dump-facts)
+        self.facts_by_image = OrderedDict()
+        # the content digest of the images {'image': 'image id'} (the
+        # manifest digest with the fact engine 'registry')
+        self.image_ids = {}
+        self._image_locks = {}
         # List of script paths and content: {'path': 'content'}
         self.fact_scripts_paths = OrderedDict()
-        # init docker clients
-        self.docker_client = docker.client.from_env()
+        # The facts declared by the scripts {'path': frozenset or None}
+        self.fact_scripts_provides = {}
+        # persistent cache of facts
+        self.fact_cache = fact_cache
+        self.fact_engine = fact_engine
+        self.pull_policy = pull_policy
+        self.pull_timeout = pull_timeout
+        self.run_timeout = run_timeout
+        self.retries = retries
+        self._daemon_semaphore = threading.BoundedSemaphore(max_daemon_ops) \
+            if max_daemon_ops else None
+        self._cancelled = threading.Event()
+        _ACTIVE_FACTERS.add(self)
+        if instrumentation is None:
+            instrumentation = Instrumentation()
+        self.instrumentation = instrumentation
+        # the docker client is created by the property docker_client
+        self._docker_client = docker_client
+        if registry_client is None and fact_engine == 'registry':
+            from .registry import RegistryClient
+
+            registry_client = RegistryClient()
+        self.registry_client = registry_client
         self.logging = logging.getLogger(__name__ + '.' +
                                          self.__class__.__name__)
 
+    @property
+    def docker_client(self):
+        """The Docker client (connected on first use)."""
+        if self._docker_client is None:
+            import docker
+            import requests.exceptions
+
+            with self._lock:
+                if self._docker_client is None:
+                    try:
+                        with self.instrumentation.timer('docker_connect'):
+                            self._docker_client = docker.client.from_env()
+                    except (docker.errors.DockerException,
+                            requests.exceptions.RequestException) as err:
+                        raise DockerfilePatchError(
+                            'unable to connect to the Docker daemon. {}'
+                            .format(str(err)))
+
+        return self._docker_client
+
+    def cancel(self):
+        """Stop the fact gathering and delete the running containers.
+
+        The gathering in progress in the other threads fails with a
+        DockerfilePatchError.
+
+        """
+        self._cancelled.set()
+        self.cleanup()
+
+    def _check_cancelled(self):
+        """Raise DockerfilePatchError if the fact gathering was cancelled."""
+        if self._cancelled.is_set():
+            raise DockerfilePatchError('the fact gathering was cancelled')
+
+    @contextlib.contextmanager
+    def _daemon_operation(self):
+        """Limit the number of concurrent Docker daemon operations."""
+        self._check_cancelled()
+        if self._daemon_semaphore is None:
+            yield
+            return
+
+        with self._daemon_semaphore:
+            self._check_cancelled()
+            yield
+
+    def _retry(self, operation, image, function, *args, deadline=None):
+        """Call function(*args) and retry it after the transient errors.
+
+        deadline: no attempt is started after this time.monotonic() value
+
+        """
+        delay = RETRY_DELAY
+        for attempt in range(self.retries + 1):
+            try:
+                return function(*args)
+            except Exception as err:  # pylint: disable=broad-except
+                if attempt >= self.retries or self._cancelled.is_set() or \
+                        not transient_error(err) or \
+                        (deadline is not None and
+                         time.monotonic() + delay >= deadline):
+                    raise
+
+                sys.stderr.write('[RETRY] {} {} in {:.1f}s ({}/{}): {}\n'
+                                 .format(operation, image, delay,
+                                         attempt + 1, self.retries,
+                                         str(err)))
+                sys.stderr.flush()
+                self.instrumentation.count('retries', image=image)
+                self._cancelled.wait(delay)
+                # a random part avoids the retries of all threads at once
+                delay *= random.uniform(2, 2.5)
+
     def add_fact_script(self, path):
-        """Docstring."""
+        """Add a fact script (or reload it if it was modified)."""
         with open(path, 'r') as fhandler:
-            self.fact_scripts_paths[os.path.abspath(path)] = fhandler.read()
+            content = fhandler.read()
+
+        path = os.path.abspath(path)
+        if path in self.fact_scripts_paths and \
+                self.fact_scripts_paths[path] != content:
+            # the facts gathered with the previous script are outdated
+            with self._lock:
+                self.facts_by_id.clear()
+        self.fact_scripts_paths[path] = content
+        self.fact_scripts_provides[path] = script_provides(content)
+
+    def required_scripts(self, required_facts=None):
+        """Return the fact scripts that provide some facts.
+
+        required_facts: the facts used by the patches (None = all the
+        facts, see referenced_facts())
+
+        The scripts that don't declare their facts ('# provides: ...') run
+        when a required fact isn't declared by any script.
+
+        Return: {'path': 'content'}
 
-    def gather_facts(self, image, tmp_dir='.'):
+        """
+        if required_facts is None:
+            return self.fact_scripts_paths
+
+        wanted = set(required_facts) - IMAGE_FACTS
+        if NAMESPACES_FACT in wanted:
+            # {{ scripts.name.fact }}
+            return self.fact_scripts_paths
+
+        provides = {}
+        for path in self.fact_scripts_paths:
+            provides[path] = self.fact_scripts_provides[path]
+            if path == DEFAULT_FACTS_SCRIPT and provides[path] is not None:
+                provides[path] = provides[path] | \
+                    ENGINE_FACTS.get(self.fact_engine, frozenset())
+
+        declared = set()
+        for item in provides.values():
+            declared.update(item or ())
+        undeclared = wanted - declared
+
+        return OrderedDict(
+            (path, content)
+            for path, content in self.fact_scripts_paths.items()
+            if (undeclared if provides[path] is None
+                else provides[path] & wanted))
+
+    def gather_facts(self, image, tmp_dir=None, required_facts=None):
         """Run the facter script in an image name.
 
-        Return: the stdout of the facter script started inside the container
-        'image'.
+        Return: the facts gathered by the facter scripts started inside the
+        container 'image'.
+
+        tmp_dir: unused (the fact scripts are copied into the container
+        without temporary files).
+        required_facts: only the scripts that provide these facts run (None
+        = all the scripts, see required_scripts()). No container is started
+        when no script is needed.
 
-        tmp_prefix: the directory where the temporary file will be created
-        (default = '.').
+        The facts are memorized by image content digest: two image names
+        that resolve to the same image (e.g. 'ubuntu:22.04' and
+        'ubuntu:jammy') are only probed once.
 
         """
-        # TODO: simplify this function (separate it into parts)
-        stdout = ''
-        tmp_prefix = 'dockerfile-patch-'
-
-        # create a temporary directory that will contain the facter script
-        host_mpoint = tempfile.mkdtemp(suffix='.tmp',
-                                       prefix=tmp_prefix,
-                                       dir=tmp_dir)
-        self.tmpfiles.append(host_mpoint)
-        self.logging.debug('[FACTS] Temporary dir created: %s%s',
-                           host_mpoint, os.sep)
-
-        # Guest mount point (volume that points to the local host_mpoint)
-        guest_dir = os.path.join('/',
-                                 os.path.basename(host_mpoint))
-        self.logging.debug('[FACTS] Volume in the running '
-                           'Docker container:'
-                           ' %s%s', guest_dir, os.sep)
-
-        # Write all scripts to the directory
+        import docker.errors
+        import requests.exceptions
+        from .registry import RegistryError
+
+        self._check_cancelled()
+        try:
+            facts = self._gather_facts(
+                image, self.required_scripts(required_facts))
+        except (docker.errors.DockerException, RegistryError,
+                requests.exceptions.RequestException) as err:
+            self._check_cancelled()
+            raise DockerfilePatchError("unable to gather the facts of the "
+                                       "image '{}'. {}".format(image,
+                                                               str(err)))
+
+        with self._lock:
+            self.facts_by_image[image] = facts
+        return dict(facts)
+
+    def _gather_facts(self, image, selected_scripts):
+        """Gather the facts of an image (see gather_facts()).
+
+        selected_scripts: the fact scripts that run {'path': 'content'}
+
+        """
+        timer = self.instrumentation.timer
+        engine = self.fact_engine
+
+        if engine == 'registry':
+            from .registry import default_platform, gather_registry_facts, \
+                image_manifest
+
+            # The manifest digest identifies the image (no pull)
+            with timer('manifest', image):
+                manifest = self._retry('manifest', image, image_manifest,
+                                       image, self.registry_client)
+            image_id = manifest[1]
+            target_platform = default_platform()
+            engine += ':' + target_platform
+        else:
+            # Pull the image
+            self.pull_image(image)
+
+            # of 'USER xx' is used, we will switch to root/
+            self.logging.debug("[FACTS] docker inspect '%s'", image)
+            with timer('inspect', image):
+                inspect_image = self._retry('inspect', image,
+                                            self._inspect_image, image)
+            image_id = inspect_image['Id']
+            image_user = inspect_image['Config']['User'].strip()
+
+        with self._lock:
+            self.image_ids[image] = image_id
+
+        # the facts depend on the selected scripts
+        memo_key = (image_id, tuple(selected_scripts))
+        with self._image_lock(image_id):
+            if memo_key in self.facts_by_id:
+                self.logging.debug("[FACTS] '%s' is %s (facts already "
+                                   "gathered)", image, image_id)
+                return dict(self.facts_by_id[memo_key])
+
+            facts = None
+
+            # The facts of the same image content are stored in the cache
+            cache_key = None
+            if self.fact_cache is not None:
+                cache_key = self.fact_cache.key(
+                    image_id, list(selected_scripts.values()),
+                    engine=engine)
+                with timer('fact_cache', image):
+                    facts = self.fact_cache.get(cache_key)
+                if facts:
+                    self.instrumentation.count('fact_cache_hits',
+                                               image=image)
+                    self.logging.debug('[FACTS] System facts loaded from '
+                                       'the cache: %s', str(facts))
+                else:
+                    self.instrumentation.count('fact_cache_misses',
+                                               image=image)
+
+            if not facts:
+                facts = {}
+                scripts = selected_scripts
+                # the namespaces don't depend on the selected scripts
+                namespaces = script_namespaces(self.fact_scripts_paths)
+                skipped = len(self.fact_scripts_paths) - len(scripts)
+                if skipped:
+                    self.logging.debug("[FACTS] %d fact script(s) not "
+                                       "needed by the patches", skipped)
+                    self.instrumentation.count('fact_scripts_skipped',
+                                               skipped, image=image)
+                if self.fact_engine == 'static' and \
+                        DEFAULT_FACTS_SCRIPT in scripts:
+                    with timer('static_facts', image):
+                        static_facts = self._retry(
+                            'save', image, self._static_facts, image,
+                            inspect_image)
+                    facts.update(static_facts)
+                    facts[NAMESPACES_FACT] = {
+                        namespaces[DEFAULT_FACTS_SCRIPT]:
+                        dict(static_facts)}
+                    scripts = OrderedDict(
+                        (path, content) for path, content in scripts.items()
+                        if path != DEFAULT_FACTS_SCRIPT)
+                elif self.fact_engine == 'registry':
+                    with timer('registry_facts', image):
+                        registry_facts, _ = self._retry(
+                            'registry', image, gather_registry_facts,
+                            image, self.registry_client, target_platform,
+                            DEFAULT_FACTS_SCRIPT in scripts, manifest)
+                    image_user = registry_facts.pop('docker_image_user')
+                    if DEFAULT_FACTS_SCRIPT in scripts:
+                        facts.update(registry_facts)
+                        facts[NAMESPACES_FACT] = {
+                            namespaces[DEFAULT_FACTS_SCRIPT]:
+                            dict(registry_facts)}
+                        scripts = OrderedDict(
+                            (path, content)
+                            for path, content in scripts.items()
+                            if path != DEFAULT_FACTS_SCRIPT)
+                    if scripts:
+                        # the other fact scripts need the image
+                        self.pull_image(image)
+
+                if scripts:
+                    stdout = self._retry('run', image,
+                                         self._run_fact_scripts, image,
+                                         scripts)
+                    with timer('parse_facts', image):
+                        try:
+                            script_facts = parse_output(
+                                stdout, [namespaces[path]
+                                         for path in scripts])
+                        except ValueError as err:
+                            raise DockerfilePatchError(
+                                "unable to parse the facts of the image "
+                                "'{}'. {}".format(image, str(err)))
+                    by_script = facts.pop(NAMESPACES_FACT, {})
+                    by_script.update(script_facts.pop(NAMESPACES_FACT, {}))
+                    facts.update(script_facts)
+                    if by_script:
+                        facts[NAMESPACES_FACT] = by_script
+
+                if not facts and selected_scripts:
+                    self.logging.debug("[FACTS] ERROR: unable to gather "
+                                       "facts.")
+                    raise DockerfilePatchError(
+                        "unable to gather the facts of the image "
+                        "'{}'".format(image))
+
+                # A fact added by dockerfile_patch
+                if image_user:
+                    facts['docker_image_user'] = image_user
+                else:
+                    facts['docker_image_user'] = 'root'
+
+                self.logging.debug('[FACTS] System facts gathered: %s',
+                                   str(facts))
+
+                if cache_key is not None:
+                    self.fact_cache.set(cache_key, facts)
+
+            self.facts_by_id[memo_key] = facts
+            return dict(facts)
+
+    def pull_image(self, image):
+        """Pull an image according to the pull policy.
+
+        The transient errors are retried until the deadline of the pull
+        (pull_timeout).
+
+        Return: True if the image was pulled.
+
+        """
+        import docker.errors
+
+        pull_policy = self.pull_policy
+        if pull_policy == 'always' and '@sha256:' in image:
+            # an image pinned by digest can never change
+            pull_policy = 'if-not-present'
+
+        if pull_policy != 'always':
+            try:
+                with self._daemon_operation():
+                    self.docker_client.images.get(image)
+            except docker.errors.ImageNotFound:
+                if pull_policy == 'never':
+                    raise DockerfilePatchError(
+                        "the image '{}' is not present locally (pull "
+                        "policy: never)".format(image))
+            else:
+                sys.stderr.write('[SKIP] docker pull {} (present locally, '
+                                 'pull policy: {})\n'.format(image,
+                                                             pull_policy))
+                sys.stderr.flush()
+                return False
+
+        # self.logging.debug("[FACTS] docker pull '%s'", image)
+        sys.stderr.write('[RUN] docker pull {}\n'.format(image))
+        sys.stderr.flush()
+
+        deadline = None
+        if self.pull_timeout:
+            deadline = time.monotonic() + self.pull_timeout
+
+        with self.instrumentation.timer('pull', image):
+            layers = self._retry('pull', image, self._pull, image, deadline,
+                                 deadline=deadline)
+
+        self.instrumentation.count('images_pulled', image=image)
+        self.instrumentation.count('bytes_pulled', sum(layers.values()),
+                                   image=image)
+        return True
+
+    def _pull(self, image, deadline=None):
+        """Pull an image (one attempt).
+
+        The deadline (a time.monotonic() value) is checked after each
+        progress event of the Docker daemon.
+
+        Return: the size of the downloaded layers {'layer id': bytes}
+
+        """
+        layers = {}
+        with self._daemon_operation():
+            for event in self.docker_client.api.pull(image, stream=True,
+                                                     decode=True):
+                if 'error' in event:
+                    message = "unable to pull the image '{}'. {}".format(
+                        image, event['error'])
+                    if any(item in event['error'].lower()
+                           for item in TRANSIENT_MESSAGES):
+                        raise TransientError(message)
+                    raise DockerfilePatchError(message)
+
+                self._check_cancelled()
+                if deadline is not None and time.monotonic() > deadline:
+                    raise DockerfilePatchError(
+                        "the pull of the image '{}' didn't finish in {}s"
+                        .format(image, self.pull_timeout))
+
+                progress = event.get('progressDetail') or {}
+                if event.get('status') == 'Downloading' and \
+                        progress.get('total'):
+                    layers[event.get('id')] = progress['total']
+
+        return layers
+
+    def _inspect_image(self, image):
+        """Return the output of 'docker inspect'."""
+        with self._daemon_operation():
+            return self.docker_client.api.inspect_image(image)
+
+    def _static_facts(self, image, inspect_image):
+        """Return the default facts read from the image files."""
+        with self._daemon_operation():
+            return gather_static_facts(self.docker_client, image,
+                                       inspect_image)
+
+    def _image_lock(self, image_id):
+        """Return the lock that serializes the gathering of an image."""
+        with self._lock:
+            return self._image_locks.setdefault(image_id, threading.Lock())
+
+    def _run_fact_scripts(self, image, scripts=None):
+        """Run the fact scripts in a container and return their output.
+
+        The scripts are copied into the container as an in-memory tar
+        archive and started in parallel, each one in its own directory. The
+        facts are read from the container stdout (see protocol.py): nothing
+        is written to the host filesystem and no volume is mounted (this
+        also works with remote Docker daemons).
+
+        Return: the output of the main script (bytes, see parse_output())
+
+        scripts: {'path': 'content'} (default: all fact scripts)
+
+        """
+        if scripts is None:
+            scripts = self.fact_scripts_paths
+
+        # The directory where the scripts are copied in the container
+        guest_dir = '/dockerfile-patch'
+
+        # Add all scripts to the archive
         index = 0
+        archive_files = OrderedDict()
         guest_scripts = []
-        for scr_path, scr_content in self.fact_scripts_paths.items():
+        for scr_path, scr_content in scripts.items():
             index += 1
             facter_script_name = str(index).zfill(6) + "-" + \
                 os.path.basename(scr_path) + '-fact'
-            facter_script_path = os.path.join(host_mpoint,
-                                              facter_script_name)
-
-            with open(facter_script_path, 'w') as fhandler:
-                self.logging.debug('[FACTS] Fact script '
-                                   'written to %s:\n%s',
-                                   facter_script_path,
-                                   scr_content)
-                fhandler.write(scr_content)
-            os.chmod(facter_script_path, 0o755)
-
+            self.logging.debug('[FACTS] Fact script %s:\n%s',
+                               facter_script_name, scr_content)
+            archive_files[facter_script_name] = scr_content
             guest_scripts.append(os.path.join(guest_dir,
                                               facter_script_name))
 
-        # create the main script (this script will run all others)p
+        # create the main script (this script will run all others)
         main_script_name = 'main_facter.sh'
-        main_script_path = os.path.join(host_mpoint,
-                                        main_script_name)
-        main_script_content = "#!/bin/sh\n"
-        main_script_content += 'cd "' + guest_dir + '" || exit 1\n'
-        for item in guest_scripts:
-            main_script_content += item + " || exit 1\n"
-        with open(main_script_path, 'w') as fhandler:
-            self.logging.debug('[FACTS] Main facter '
-                               'script written to %s:\n%s',
-                               main_script_path,
-                               main_script_content)
-            fhandler.write(main_script_content)
-        os.chmod(main_script_path, 0o755)
-        guest_main_script = os.path.join(guest_dir, main_script_name)
-
-        # Pull the image
-        # self.logging.debug("[FACTS] docker pull '%s'", image)
-        sys.stderr.write('[RUN] docker pull {}\n'.format(image))
-        sys.stderr.flush()
-        self.docker_client.images.pull(image)
-
-        # of 'USER xx' is used, we will switch to root/
-        self.logging.debug("[FACTS] docker inspect '%s'", image)
-        inspect_image = self.docker_client.api.inspect_image(image)
-        image_user = inspect_image['Config']['User'].strip()
-
-        volumes = {os.path.abspath(host_mpoint): guest_dir}
-        self.docker_client.containers.run(image=image,
-                                          command=['/bin/sh',
-                                                   guest_main_script],
-                                          user='root',
-                                          remove=True,
-                                          stdout=True,
-                                          volumes=volumes)
-
-        facts_yaml = os.path.join(host_mpoint,
-                                  'facts.yaml')
+        main_script_content = main_script(guest_dir, guest_scripts)
+        self.logging.debug('[FACTS] Main facter script:\n%s',
+                           main_script_content)
+        archive_files[main_script_name] = main_script_content
+
+        timer = self.instrumentation.timer
+        with timer('container_start', image), self._daemon_operation():
+            container = self.docker_client.containers.create(
+                image=image,
+                command=['/bin/sh', os.path.join(guest_dir,
+                                                 main_script_name)],
+                user='root')
+            with self._lock:
+                self.containers.add(container)
+
         try:
-            with open(facts_yaml, 'r') as fhandler:
-                stdout = fhandler.read()
-        except IOError:
+            with timer('container_start', image), self._daemon_operation():
+                container.put_archive('/', make_tar_archive(guest_dir,
+                                                            archive_files))
+                container.start()
+            self.instrumentation.count('containers_started', image=image)
+
+            with timer('container_run', image):
+                with self._daemon_operation():
+                    status = self._wait_container(container, image)
+                with self._daemon_operation():
+                    stdout = container.logs(stdout=True, stderr=False)
+            if status.get('StatusCode', 0) != 0:
+                with self._daemon_operation():
+                    stderr = container.logs(stdout=False, stderr=True)
+                raise DockerfilePatchError(
+                    "the fact scripts failed in the image '{}' (exit code: "
+                    "{}):\n{}".format(image, status.get('StatusCode'),
+                                      stderr.decode('utf-8', 'replace')))
+        finally:
+            with timer('container_remove', image):
+                self._remove_container(container)
+
+        if not stdout.strip():
             self.logging.debug("[WARNING] The fact scripts "
-                               "didn't write any fact in '%s'.",
-                               facts_yaml)
+                               "didn't write any fact.")
 
-        facts = yaml.load(stdout)
+        return stdout
 
-        # A fact added by dockerfile_patch
-        if image_user:
-            facts['docker_image_user'] = image_user
-        else:
-            facts['docker_image_user'] = 'root'
+    def _wait_container(self, container, image):
+        """Wait for the end of a container (killed after run_timeout).
 
-        if not facts:
-            self.logging.debug("[FACTS] ERROR: unable to gather facts.")
-            sys.exit(1)
+        Return: the status of the container ({'StatusCode': ...})
 
-        self.logging.debug('[FACTS] System facts gathered: %s', str(facts))
+        """
+        import requests.exceptions
 
-        # delete temporary files
-        self._rm_tmpfiles()
+        if not self.run_timeout:
+            return container.wait()
 
-        return facts
+        try:
+            return container.wait(timeout=self.run_timeout)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
+            self._check_cancelled()
+            self.logging.debug('[FACTS] Killing the container %s (timeout)',
+                               container.id)
+            try:
+                container.kill()
+            except Exception:  # pylint: disable=broad-except
+                pass
+            self.instrumentation.count('containers_killed', image=image)
+            raise DockerfilePatchError(
+                "the fact scripts didn't finish in {}s in the image '{}'"
+                .format(self.run_timeout, image))
+
+    def _remove_container(self, container):
+        """Delete a container created by _run_fact_scripts()."""
+        import docker.errors
+
+        with self._lock:
+            self.containers.discard(container)
+
+        try:
+            container.remove(force=True)
+            self.logging.debug('[FACTS DELETE] Container deleted: %s',
+                               container.id)
+        except docker.errors.NotFound:
+            pass
+        except docker.errors.APIError as err:
+            self.logging.debug("[FACTS WARNING] The container %s wasn't "
+                               "deleted: %s", container.id, str(err))
+
+    def gather_facts_many(self, images, jobs=1, required_facts=None):
+        """Gather the facts of several images concurrently.
+
+        images: list of image names (duplicates are gathered once)
+        jobs: the maximum number of images gathered at the same time
+        required_facts: see gather_facts()
+
+        Return: an OrderedDict {'image': facts} that follows the order of
+        'images'.
+
+        """
+        images = list(OrderedDict.fromkeys(images))
+        if jobs <= 1 or len(images) <= 1:
+            return OrderedDict(
+                (image, self.gather_facts(image,
+                                          required_facts=required_facts))
+                for image in images)
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(self.gather_facts, image,
+                                       required_facts=required_facts)
+                       for image in images]
+            return OrderedDict((image, future.result())
+                               for image, future in zip(images, futures))
 
     def __del__(self):
         """Clean-up."""
-        self._rm_tmpfiles()
+        self.cleanup()
 
-    def _rm_tmpfiles(self):
-        """Delete temporary files."""
-        for path in self.tmpfiles:
-            if os.path.isdir(path):
-                self.logging.debug('[FACTS DELETE] Temporary '
-                                   'dir deleted: %s%s', path, os.sep)
-                shutil.rmtree(path)
-            elif os.path.exists(path):
-                self.logging.debug('[FACTS DELETE] Temporary '
-                                   'file deleted: %s', path)
-                os.unlink(path)
-            else:
-                self.logging.debug("[FACTS WARNING] Temporary file wasn't "
-                                   "found: %s", path)
+    def cleanup(self):
+        """Delete the containers that are still running."""
+        with self._lock:
+            containers = list(self.containers)
 
-        # it is empty now
-        self.tmpfiles = []
+        for container in containers:
+            self._remove_container(container)
 
 
-def dockerfile_patch(dockerfile_dir, jinja2_patches_paths, fact_scripts_paths):
-    """The command line interface.
+class FactsFile(object):
+    """Read the facts of the images from a file instead of Docker.
+
+    The file (YAML or JSON, e.g. written by --dump-facts) maps the image
+    names used in the FROM instructions to their facts:
+
+        ubuntu:latest:
+          osfamily: Debian
+          ...
+
+    A FactsFile can be used as the 'docker_facter' of
+    load_patched_dockerfile(): the Docker daemon is not needed unless an
+    image is missing from the file and a fallback DockerFact is given.
+
+    """
+
+    def __init__(self, path=None, facts=None, fallback=None,
+                 instrumentation=None):
+        """Load the facts.
+
+        path: a YAML or JSON file ('.json' is parsed as JSON), or the
+        SQLite store of --scan
+        facts: the facts {'image': facts} (instead of 'path')
+        fallback: a DockerFact that gathers the facts of the images missing
+        from the file (None = the missing images are errors)
+        instrumentation: an Instrumentation (default: the instrumentation
+        of the fallback)
+
+        """
+        self.path = path
+        self.fallback = fallback
+        if instrumentation is None:
+            instrumentation = fallback.instrumentation if fallback \
+                else Instrumentation()
+        self.instrumentation = instrumentation
+        # facts returned by gather_facts() {'image': facts} (--dump-facts)
+        self.facts_by_image = OrderedDict()
+        self.logging = logging.getLogger(__name__ + '.' +
+                                         self.__class__.__name__)
+
+        if facts is None:
+            facts = self._load(path)
+        self.facts = self._validate(facts)
+
+    def _load(self, path):
+        """Load the content of a facts file (or of a --scan store)."""
+        from .scan import FactStore, is_fact_store
+
+        if is_fact_store(path):
+            with FactStore(path) as store:
+                return store.facts()
+
+        try:
+            with open(path, 'r') as fhandler:
+                if path.endswith('.json'):
+                    return json.load(fhandler)
+
+                import yaml
+                try:
+                    return yaml.safe_load(fhandler)
+                except yaml.YAMLError as err:
+                    raise ValueError(str(err))
+        except (OSError, ValueError) as err:
+            raise DockerfilePatchError("unable to load the facts file '{}'. "
+                                       "{}".format(path, str(err)))
+
+    def _validate(self, facts):
+        """Check the structure of the facts {'image': {'fact': value}}."""
+        if facts is None:
+            facts = {}
+
+        if not isinstance(facts, dict) or \
+                not all(isinstance(item, dict) for item in facts.values()):
+            raise DockerfilePatchError("the facts file '{}' needs to map "
+                                       "the image names to their facts"
+                                       .format(self.path))
+
+        result = {}
+        for image, image_facts in facts.items():
+            image_facts = dict(image_facts)
+            # the files written by hand can omit the user
+            image_facts.setdefault('docker_image_user', 'root')
+            result[str(image)] = image_facts
+        return result
+
+    def add_fact_script(self, path):
+        """Add a fact script to the fallback (ignored without fallback)."""
+        if self.fallback is not None:
+            self.fallback.add_fact_script(path)
+
+    def gather_facts(self, image, tmp_dir=None, required_facts=None):
+        """Return the facts of an image (see DockerFact.gather_facts())."""
+        return self.gather_facts_many([image],
+                                      required_facts=required_facts)[image]
+
+    def gather_facts_many(self, images, jobs=1, required_facts=None):
+        """Return the facts of several images {'image': facts}.
+
+        The images missing from the file are gathered by the fallback
+        (concurrently, see DockerFact.gather_facts_many()). The file always
+        returns all the facts of an image (required_facts is passed to the
+        fallback).
+
+        """
+        images = list(OrderedDict.fromkeys(images))
+        missing = [image for image in images if image not in self.facts]
+        for image in images:
+            self.instrumentation.count('facts_file_misses'
+                                       if image in missing
+                                       else 'facts_file_hits', image=image)
+
+        gathered = {}
+        if missing:
+            if self.fallback is None:
+                raise DockerfilePatchError(
+                    "the facts of the images {} are not in the facts file "
+                    "'{}'".format(', '.join("'{}'".format(image)
+                                            for image in missing),
+                                  self.path))
+
+            self.logging.debug("[FACTS] Not in the facts file (gathered "
+                               "with Docker): %s", str(missing))
+            gathered = self.fallback.gather_facts_many(
+                missing, jobs=jobs, required_facts=required_facts)
+
+        result = OrderedDict()
+        for image in images:
+            result[image] = dict(gathered[image] if image in gathered
+                                 else self.facts[image])
+            self.facts_by_image[image] = result[image]
+        return result
+
+    def cleanup(self):
+        """Delete the containers of the fallback."""
+        if self.fallback is not None:
+            self.fallback.cleanup()
+
+
+def dump_facts(path, facts_by_image):
+    """Write the facts {'image': facts} to a file read by FactsFile.
+
+    path: a YAML or JSON file ('.json' is written as JSON)
+
+    """
+    facts = {image: dict(image_facts)
+             for image, image_facts in facts_by_image.items()}
+    if path.endswith('.json'):
+        content = json.dumps(facts, indent=2, sort_keys=True) + '\n'
+    else:
+        import yaml
+        content = yaml.safe_dump(facts, default_flow_style=False)
+
+    with open(path, 'w') as fhandler:
+        fhandler.write(content)
+
+
+def load_dockerfile(dockerfile_dir, build_args=None):
+    """Return a DockerfilePatcher with the Dockerfile of 'dockerfile_dir'."""
+    dockerfile = DockerfilePatcher(build_args=build_args)
+    try:
+        dockerfile.load(dockerfile_dir)
+    except (OSError, UnicodeDecodeError):
+        dockerfile_path = os.path.join(dockerfile_dir, 'Dockerfile')
+        raise DockerfilePatchError("unable to load the Dockerfile "
+                                   "located in '{}'".format(dockerfile_path))
+
+    return dockerfile
+
+
+_TEMPLATE_ENVS = {}
+_TEMPLATE_ENVS_LOCK = threading.Lock()
+
+
+def template_environment(bytecode_cache_dir=None):
+    """Return the Jinja2 environment shared by all the patches.
+
+    The compiled templates are kept in memory by the environment and in a
+    persistent bytecode cache (validated by the checksum of the template
+    source), so each template is compiled once per content.
+
+    bytecode_cache_dir: the directory of the bytecode cache (default:
+    ~/.cache/dockerfile-patch/jinja2)
+
+    """
+    from jinja2 import FileSystemBytecodeCache
+    from .patch_loader import PatchEnvironment, PatchLoader
+
+    if not bytecode_cache_dir:
+        bytecode_cache_dir = default_cache_dir('jinja2')
+
+    with _TEMPLATE_ENVS_LOCK:
+        if bytecode_cache_dir not in _TEMPLATE_ENVS:
+            bytecode_cache = None
+            try:
+                os.makedirs(bytecode_cache_dir, exist_ok=True)
+                if os.access(bytecode_cache_dir, os.W_OK):
+                    bytecode_cache = \
+                        FileSystemBytecodeCache(bytecode_cache_dir)
+            except OSError:
+                pass
+
+            _TEMPLATE_ENVS[bytecode_cache_dir] = \
+                PatchEnvironment(loader=PatchLoader([]),
+                                 bytecode_cache=bytecode_cache,
+                                 cache_size=-1)
+
+        return _TEMPLATE_ENVS[bytecode_cache_dir]
+
+
+def load_jinja_patches(jinja2_patches_paths, template_env=None,
+                       searchpath=None):
+    """Load multiple patches.
+
+    template_env: the Jinja2 environment (default: template_environment())
+    searchpath: the directories where the included templates that are not
+    next to the including template are searched (default: the directories
+    of jinja2_patches_paths)
+
+    Return: a list of {'path': path, 'content': source, 'template': template}
+
+    """
+    from jinja2 import TemplateError
+
+    logger = logging.getLogger(__name__)
+
+    if template_env is None:
+        template_env = template_environment()
+    if searchpath is None:
+        searchpath = OrderedDict.fromkeys(
+            os.path.dirname(os.path.abspath(item))
+            for item in jinja2_patches_paths)
+    template_env = template_env.scoped(searchpath)
+
+    jinja_patches_content = []
+    for item in jinja2_patches_paths:
+        abs_path = os.path.abspath(item)
+        try:
+            current_content, template = template_env.load_patch(abs_path)
+        except (OSError, TemplateError) as err:
+            raise DockerfilePatchError("unable to load the Jinja2 template "
+                                       "located in '{}'. {}".format(item,
+                                                                    str(err)))
+
+        jinja_patches_content.append({'path': item,
+                                      'content': current_content,
+                                      'template': template})
+
+        logger.debug("[FACTS] Jinja patch '%s' loaded:\n%s\n",
+                     item, current_content)
+
+    return jinja_patches_content
+
+
+def referenced_facts(jinja_patches_content):
+    """Return the facts used by the patches (static analysis).
+
+    The variables that the templates (and the templates they include or
+    import) use without defining them are facts.
+
+    jinja_patches_content: the list returned by load_jinja_patches()
+
+    Return: a frozenset, or None if the facts can't be known (e.g. {%
+    include variable %}): all the facts are needed.
+
+    """
+    from jinja2 import TemplateError
+    from jinja2.meta import find_referenced_templates, \
+        find_undeclared_variables
+
+    result = set()
+    seen = set()
+    pending = [(item['template'].environment, item['content'],
+                item['template'].name)
+               for item in jinja_patches_content]
+    while pending:
+        template_env, source, name = pending.pop()
+        try:
+            ast = template_env.parse(source)
+        except TemplateError:
+            return None
+        result.update(name for name in find_undeclared_variables(ast)
+                      if name not in template_env.globals)
+
+        for reference in find_referenced_templates(ast):
+            if reference is None:
+                # a dynamic name ({% include variable %})
+                return None
+            reference = template_env.join_path(reference, name)
+            if (template_env, reference) in seen:
+                continue
+            seen.add((template_env, reference))
+            try:
+                source, _, _ = template_env.loader.get_source(template_env,
+                                                              reference)
+            except (OSError, TemplateError):
+                return None
+            pending.append((template_env, source, reference))
+
+    return frozenset(result)
+
+
+def render_template(item, facts):
+    """Render one of the patches returned by load_jinja_patches()."""
+    return '\n#\n# ==> Patch: ' + item['path'] + '\n#\n' + \
+        item['template'].render(**facts).strip() + '\n'
+
+
+def join_patch(rendered, facts):
+    """Join the rendered patches of an image (see render_template())."""
+    patch = ''.join(rendered)
+
+    # to the user switch (USER root, ..., USER previous_user)
+    if facts['docker_image_user'] != 'root':
+        # change the user to root before the patch and go back to the
+        # Docker image's user after the patch
+        patch = '# dockerfile-patch: change the user to root\n' + \
+            'USER root\n' + patch + '\n' + \
+            '# dockerfile-patch: go back to the original user\n' + \
+            'USER ' + facts['docker_image_user'] + '\n'
+
+    return patch
+
+
+def render_patch(jinja_patches_content, facts):
+    """Render the Jinja2 patches with the facts of an image.
+
+    Params:
+        jinja_patches_content: the list returned by load_jinja_patches()
+        facts: the facts gathered from the image
+
+    """
+    return join_patch([render_template(item, facts)
+                       for item in jinja_patches_content], facts)
+
+
+def load_patched_dockerfile(dockerfile_dir, jinja2_patches_paths,
+                            fact_scripts_paths, fact_cache=None, jobs=1,
+                            fact_engine='container', pull_policy='always',
+                            template_env=None, docker_facter=None,
+                            instrumentation=None, build_args=None,
+                            all_facts=False):
+    """Load a Dockerfile and add the patches of its images.
+
+    Return: a DockerfilePatcher (use its methods save(), write_to() or
+    to_str() to get the patched Dockerfile)
 
     Params:
         dockerfile_dir: directory where the Dockerfile is stored
         jinja2_patches_paths: list of paths to Jinja2 templates
         fact_scripts_paths: list of paths to fact scripts
+        fact_cache: a FactCache instance (None = facts are always gathered)
+        jobs: the number of images whose facts are gathered concurrently
+        fact_engine: 'container', 'static' or 'registry' (see
+        DockerFact)
+        pull_policy: 'always', 'if-not-present' or 'never'
+        template_env: the Jinja2 environment of the patches (default:
+        template_environment())
+        docker_facter: a DockerFact shared with other calls, or a FactsFile
+        (the parameters fact_cache, fact_engine and pull_policy are ignored)
+        instrumentation: an Instrumentation that receives the timings
+        (default: the instrumentation of docker_facter)
+        build_args: the values of the ARGs used by the FROM lines
+        {'name': 'value'}
+        all_facts: run all the fact scripts (default: only the scripts that
+        provide the facts used by the patches, see referenced_facts())
 
     """
     logger = logging.getLogger(__name__)
 
-    dockerfile = DockerfilePatcher()
-    docker_facter = DockerFact()
+    if docker_facter is None:
+        docker_facter = DockerFact(fact_cache=fact_cache,
+                                   fact_engine=fact_engine,
+                                   pull_policy=pull_policy,
+                                   instrumentation=instrumentation)
+    if instrumentation is None:
+        instrumentation = docker_facter.instrumentation
+    timer = instrumentation.timer
 
     # Load the Dockerfile
-    try:
-        dockerfile.load(dockerfile_dir)
-    except OSError:
-        dockerfile_path = os.path.join(dockerfile_dir, 'Dockerfile')
-        sys.stderr.write("ERROR: unable to load the Dockerfile "
-                         "located in '{}'\n".format(dockerfile_path))
-        sys.exit(1)
+    with timer('load_dockerfile'):
+        dockerfile = load_dockerfile(dockerfile_dir, build_args)
 
     # Load the scripts' content into a dict {'path': 'script_content'}
     for item in fact_scripts_paths:
         docker_facter.add_fact_script(path=item)
 
     # Load multiple patches
-    jinja_patches_content = []
-    for item in jinja2_patches_paths:
-        try:
-            with open(item, 'r') as fhandler:
-                current_content = fhandler.read()
-                jinja_patches_content.append({'path': item,
-                                              'content': current_content})
-
-                logger.debug("[FACTS] Jinja patch '%s' loaded:\n%s\n",
-                             item, current_content)
-        except OSError as err:
-            sys.stderr.write("ERROR: unable to load the Jinja2 template "
-                             "located in '{}'. {}\n".format(item,
-                                                            str(err)))
-            sys.exit(1)
+    with timer('load_patches'):
+        jinja_patches_content = load_jinja_patches(jinja2_patches_paths,
+                                                   template_env=template_env)
 
     # Gathering facts from all Docker images
-    facts = {}
-    for item_image in dockerfile.get_images():
-        image_name = item_image['value']
-        if image_name in facts:
-            # Already gathered
-            continue
+    required_facts = None if all_facts \
+        else referenced_facts(jinja_patches_content)
+    image_names = dockerfile.get_base_images()
+    logger.debug("[MAIN] Gathering facts from the images: %s (facts used "
+                 "by the patches: %s)", str(image_names),
+                 'all' if required_facts is None
+                 else str(sorted(required_facts)))
+    with timer('gather_facts'):
+        facts = docker_facter.gather_facts_many(
+            image_names, jobs=jobs, required_facts=required_facts)
+
+    # Creating the patch for each image (in the order of the FROM lines)
+    for image_name, image_facts in facts.items():
+        with timer('render', image_name):
+            patch = render_patch(jinja_patches_content, image_facts)
+        dockerfile.add_patch(image_name, patch)
 
-        logger.debug("[MAIN] Gathering facts from the image '%s'", image_name)
-        facts[image_name] = docker_facter.gather_facts(image_name,
-                                                       tmp_dir=dockerfile_dir)
-
-        # Creating the patch for this image
-        patch = ''
-        for item_j2_data in jinja_patches_content:
-            template = Template(item_j2_data['content'])
-            patch += '\n'
-            patch += '#\n'
-            patch += '# ==> Patch: ' + item_j2_data['path'] + '\n'
-            patch += '#\n'
-            patch += template.render(**facts[image_name]).strip() + '\n'
-
-        # to the user switch (USER root, ..., USER previous_user)
-        if facts[image_name]['docker_image_user'] != 'root':
-            # change the user to root before the patch and go back to the
-            # Docker image's user after the patch
-            patch = '# dockerfile-patch: change the user to root\n' + \
-                'USER root\n' + patch + '\n' + \
-                '# dockerfile-patch: go back to the original user\n' + \
-                'USER ' + facts[image_name]['docker_image_user'] + '\n'
+    return dockerfile
 
-        dockerfile.add_patch(image_name, patch)
 
+def dockerfile_patch(dockerfile_dir, jinja2_patches_paths, fact_scripts_paths,
+                     **kwargs):
+    """The command line interface.
+
+    Return: the patched Dockerfile (a string). The parameters are the same
+    as load_patched_dockerfile().
+
+    """
     # Final result
-    return dockerfile.to_str()
+    return load_patched_dockerfile(dockerfile_dir, jinja2_patches_paths,
+                                   fact_scripts_paths, **kwargs).to_str()
+
+
+def find_dockerfile_dirs(patterns):
+    """Return the directories of the Dockerfiles matched by 'patterns'.
+
+    Each pattern is a directory, a path to a Dockerfile or a glob pattern
+    ('**' matches any number of sub-directories). The glob patterns only
+    match the directories that contain a 'Dockerfile' and the files named
+    'Dockerfile' (e.g. 'svc/*' skips 'svc/README.md').
+
+    """
+    result = []
+    for pattern in patterns:
+        if glob.escape(pattern) == pattern:
+            # not a glob pattern: the errors are reported by the loading
+            paths = [pattern]
+        else:
+            paths = [path
+                     for path in sorted(glob.glob(pattern, recursive=True))
+                     if os.path.isfile(os.path.join(path, 'Dockerfile')) or
+                     (os.path.basename(path) == 'Dockerfile' and
+                      os.path.isfile(path))]
+
+        for path in paths:
+            if os.path.isdir(path):
+                dockerfile_dir = path
+            else:
+                dockerfile_dir = os.path.dirname(path) or '.'
+
+            dockerfile_dir = os.path.normpath(dockerfile_dir)
+            if dockerfile_dir not in result:
+                result.append(dockerfile_dir)
+
+    return result
+
+
+def patch_sources(jinja_patches_content):
+    """Return the sources of the patches and of the templates they include.
+
+    Return: a list of (name, source), the patches first.
+
+    """
+    from jinja2 import TemplateError
+    from jinja2.meta import find_referenced_templates
+
+    result = []
+    seen = set()
+    pending = [(item['path'], item['content'], item['template'].environment,
+                item['template'].name)
+               for item in jinja_patches_content]
+    while pending:
+        name, source, template_env, parent = pending.pop(0)
+        result.append((name, source))
+        try:
+            references = find_referenced_templates(template_env.parse(source))
+        except TemplateError:
+            continue
+
+        for reference in references:
+            # None: a dynamic name ({% include variable %})
+            if reference is None:
+                continue
+            reference = template_env.join_path(reference, parent)
+            if reference in seen:
+                continue
+            seen.add(reference)
+            try:
+                reference_source = template_env.loader.get_source(
+                    template_env, reference)[0]
+            except (OSError, TemplateError):
+                continue
+            pending.append((reference, reference_source, template_env,
+                            reference))
+
+    return result
+
+
+def inputs_digest(dockerfile, jinja_patches_sources, facts):
+    """Return the digest of everything a patched Dockerfile depends on.
+
+    dockerfile: a DockerfilePatcher (without patches)
+    jinja_patches_sources: the list returned by patch_sources()
+    facts: the facts of the images {'image': facts}
+
+    """
+    result = hashlib.sha256()
+
+    def update(*values):
+        """Add values to the digest (separated)."""
+        for value in values:
+            result.update(value.encode('utf-8'))
+            result.update(b'\0')
+
+    update('dockerfile', ''.join(item.content
+                                 for item in dockerfile.structure))
+    for name, source in jinja_patches_sources:
+        update('patch', name, source)
+    for image in dockerfile.get_base_images():
+        update('facts', image, json.dumps(facts[image], sort_keys=True,
+                                          default=str))
+
+    return result.hexdigest()
+
+
+def file_digest(path):
+    """Return the sha256 of a file (None if it can't be read)."""
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as fhandler:
+            for chunk in iter(lambda: fhandler.read(64 * 1024), b''):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def dockerfile_patch_batch(dockerfile_dirs, jinja2_patches_paths,
+                           fact_scripts_paths, output_dir=None,
+                           output_name='Dockerfile.patched',
+                           fact_cache=None, jobs=1,
+                           fact_engine='container', pull_policy='always',
+                           template_env=None, docker_facter=None,
+                           instrumentation=None, output_paths=None,
+                           output_cache=None, build_args=None,
+                           all_facts=False, errors=None):
+    """Patch many Dockerfiles in the same process.
+
+    The Docker client, the Jinja2 patches and the facts are shared by all
+    Dockerfiles: each image is probed once, even when it is used by several
+    Dockerfiles or under several names (the facts are deduplicated by image
+    digest).
+
+    A patched Dockerfile whose content didn't change is not written again
+    (its modification time is kept).
+
+    Params:
+        dockerfile_dirs: directories where the Dockerfiles are stored
+        jinja2_patches_paths: list of paths to Jinja2 templates
+        fact_scripts_paths: list of paths to fact scripts
+        output_dir: the patched Dockerfiles are written to this directory
+        (same tree as the sources). None = next to the source Dockerfile.
+        output_name: the file name of the patched Dockerfiles written next
+        to their sources
+        fact_cache: a FactCache instance (None = facts are always gathered)
+        jobs: the number of images whose facts are gathered concurrently
+        fact_engine: 'container', 'static' or 'registry' (see
+        DockerFact)
+        pull_policy: 'always', 'if-not-present' or 'never'
+        template_env: the Jinja2 environment of the patches (default:
+        template_environment())
+        docker_facter: a DockerFact shared with other calls, or a FactsFile
+        (the parameters fact_cache, fact_engine and pull_policy are ignored)
+        instrumentation: an Instrumentation that receives the timings
+        (default: the instrumentation of docker_facter)
+        output_paths: the path of the patched Dockerfile of some
+        directories {'dockerfile_dir': 'path'} (instead of output_dir and
+        output_name)
+        output_cache: an OutputCache instance. The patches of a Dockerfile
+        aren't rendered when its inputs (Dockerfile, patches and facts) are
+        the same as the previous run and its output wasn't modified.
+        build_args: the values of the ARGs used by the FROM lines
+        {'name': 'value'}
+        all_facts: run all the fact scripts (default: only the scripts that
+        provide the facts used by the patches, see referenced_facts())
+        errors: a dict that receives the Dockerfiles that can't be loaded
+        {'dockerfile_dir': 'error'}: the other Dockerfiles are patched. None
+        = the first error is raised.
+
+    Return: an OrderedDict {'path of the patched Dockerfile': changed}
+    (changed: False if the file was left untouched).
+
+    """
+    logger = logging.getLogger(__name__)
+
+    if docker_facter is None:
+        docker_facter = DockerFact(fact_cache=fact_cache,
+                                   fact_engine=fact_engine,
+                                   pull_policy=pull_policy,
+                                   instrumentation=instrumentation)
+    if instrumentation is None:
+        instrumentation = docker_facter.instrumentation
+    timer = instrumentation.timer
+    output_paths = output_paths or {}
+
+    dockerfiles = OrderedDict()
+    with timer('load_dockerfile'):
+        for dockerfile_dir in dockerfile_dirs:
+            try:
+                dockerfiles[dockerfile_dir] = load_dockerfile(dockerfile_dir,
+                                                              build_args)
+            except DockerfilePatchError as err:
+                if errors is None:
+                    raise
+                logger.debug("[BATCH] '%s' skipped: %s", dockerfile_dir,
+                             str(err))
+                errors[dockerfile_dir] = str(err)
+
+    for item in fact_scripts_paths:
+        docker_facter.add_fact_script(path=item)
+
+    with timer('load_patches'):
+        jinja_patches_content = load_jinja_patches(jinja2_patches_paths,
+                                                   template_env=template_env)
+        jinja_patches_sources = patch_sources(jinja_patches_content) \
+            if output_cache is not None else None
+
+    # Gathering facts from all Docker images of all Dockerfiles
+    required_facts = None if all_facts \
+        else referenced_facts(jinja_patches_content)
+    image_names = [image
+                   for dockerfile in dockerfiles.values()
+                   for image in dockerfile.get_base_images()]
+    logger.debug("[BATCH] Gathering facts from the images: %s",
+                 str(list(OrderedDict.fromkeys(image_names))))
+    with timer('gather_facts'):
+        facts = docker_facter.gather_facts_many(
+            image_names, jobs=jobs, required_facts=required_facts)
+
+    # The patch of an image is rendered once (when it is needed)
+    patches = {}
+
+    def get_patch(image_name):
+        """Return the rendered patch of an image."""
+        if image_name not in patches:
+            with timer('render', image_name):
+                patches[image_name] = render_patch(jinja_patches_content,
+                                                   facts[image_name])
+        return patches[image_name]
+
+    root_dir = None
+    if output_dir and dockerfiles:
+        root_dir = os.path.commonpath([os.path.abspath(item)
+                                       for item in dockerfiles])
+        if len(dockerfiles) == 1:
+            root_dir = os.path.dirname(root_dir)
+
+    result = OrderedDict()
+    for dockerfile_dir, dockerfile in dockerfiles.items():
+        if dockerfile_dir in output_paths:
+            output_path = output_paths[dockerfile_dir]
+        elif output_dir:
+            output_path = os.path.join(
+                output_dir,
+                os.path.relpath(os.path.abspath(dockerfile_dir), root_dir),
+                'Dockerfile')
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        else:
+            output_path = os.path.join(dockerfile_dir, output_name)
+
+        # Short-circuit: the same inputs as the previous run
+        digest = None
+        if output_cache is not None:
+            digest = inputs_digest(dockerfile, jinja_patches_sources, facts)
+            entry = output_cache.get(output_cache.key(output_path))
+            if entry and entry.get('inputs') == digest and \
+                    entry.get('output') == file_digest(output_path):
+                logger.debug("[BATCH] '%s' is up to date: %s",
+                             dockerfile_dir, output_path)
+                instrumentation.count('outputs_unchanged')
+                result[output_path] = False
+                continue
+
+        for image_name in dockerfile.get_base_images():
+            dockerfile.add_patch(image_name, get_patch(image_name))
+
+        with timer('write'):
+            changed = dockerfile.save_if_changed(output_path)
+
+        if output_cache is not None:
+            output_cache.set(output_cache.key(output_path),
+                             {'inputs': digest,
+                              'output': file_digest(output_path)})
+
+        logger.debug("[BATCH] '%s' patched: %s (%s)", dockerfile_dir,
+                     output_path, 'changed' if changed else 'unchanged')
+        instrumentation.count('outputs_changed' if changed
+                              else 'outputs_unchanged')
+        result[output_path] = changed
+
+    return result
 
 
 def parse_args():
     """Parse the arguments."""
     # default template
     description = "Patch a Dockerfile with a Jinja2 template"
-    usage = "%(prog)s [--option] [dockerfile_path]"
+    usage = "%(prog)s [--option] [dockerfile_path ...]"
     parser = argparse.ArgumentParser(description=description,
                                      usage=usage)
-    parser.add_argument('path', type=str, nargs='?', default=None,
-                        help="The path where the 'Dockerfile' is located.")
-    parser.add_argument('-p', '--patch', action='append', required=True,
+    parser.add_argument('path', type=str, nargs='*', default=[],
+                        help="The path where the 'Dockerfile' is located. "
+                        "With --batch: several paths or glob patterns.")
+    parser.add_argument('-p', '--patch', action='append', default=[],
                         help='Path to the Jinja2 patch (can be '
                         'specified multiple times)')
     parser.add_argument('-o', '--output', default=None,
                         help='A file where the patched '
                         'Dockerfile will be saved')
+    parser.add_argument('-b', '--batch', action="store_true",
+                        default=False, help='Patch all the Dockerfiles '
+                        'matched by the paths in the same process')
+    parser.add_argument('--output-dir', default=None,
+                        help='--batch: a directory where the patched '
+                        'Dockerfiles will be saved (default: next to the '
+                        'source Dockerfiles)')
+    parser.add_argument('--output-name', default='Dockerfile.patched',
+                        help='--batch: the name of the patched Dockerfiles '
+                        'saved next to their sources '
+                        '(default: Dockerfile.patched)')
+    parser.add_argument('--watch', action="store_true", default=False,
+                        help='Keep running and save the patched Dockerfile '
+                        '(--output) again each time the Dockerfile, a patch '
+                        'or a fact script is modified')
+    parser.add_argument('--build', action="store_true", default=False,
+                        help='Build the patched Dockerfile: the build '
+                        'context is streamed to the Docker daemon with the '
+                        'patched Dockerfile added in memory')
+    parser.add_argument('-t', '--tag', action='append', default=[],
+                        metavar='NAME:TAG',
+                        help='--build: a tag of the image (can be specified '
+                        'multiple times)')
+    parser.add_argument('--serve', default=None, metavar='ADDRESS',
+                        help="Run a patch server on 'unix:/path/to/socket' "
+                        "or 'host:port' (POST /patch, GET /health)")
+    parser.add_argument('--profile', nargs='?', const='-', default=None,
+                        metavar='FILE',
+                        help='Write a JSON report with the timings of each '
+                        'stage to FILE (default: stderr)')
     parser.add_argument('-c', '--color', action="store_true",
                         default=False, help='Colorize the output '
                         'when --debug is activated')
     parser.add_argument('-d', '--debug', action="store_true",
                         default=False, help='Show more information '
                         'during the patching process')
+    parser.add_argument('--build-arg', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='The value of an ARG used by the FROM lines '
+                        '(can be specified multiple times)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='The number of Docker images whose facts are '
+                        'gathered concurrently (default: 4, 16 with --scan)')
+    parser.add_argument('--fact-engine', choices=FACT_ENGINES,
+                        default=None,
+                        help="'container': run the fact scripts in a "
+                        "container. 'static': read the default facts from "
+                        "the image files without starting a container. "
+                        "'registry': read the default facts from the image "
+                        "manifest and config without pulling the image "
+                        "(default: container, registry with --scan)")
+    parser.add_argument('--insecure-registry', action='append', default=[],
+                        metavar='REGISTRY',
+                        help="A registry reached with HTTP by the fact "
+                        "engine 'registry' (can be specified multiple "
+                        "times, localhost always is)")
+    parser.add_argument('--pull', choices=PULL_POLICIES, default='always',
+                        help='When the Docker images are pulled. The images '
+                        'pinned by digest are pulled only if they are not '
+                        'present (default: always)')
+    parser.add_argument('--pull-timeout', type=float, default=None,
+                        metavar='SECONDS',
+                        help='The deadline of the pull of each image, '
+                        'retries included (default: none)')
+    parser.add_argument('--run-timeout', type=float, default=None,
+                        metavar='SECONDS',
+                        help='The deadline of the fact scripts of each image '
+                        '(the container is killed after it, default: none)')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                        help='The number of retries after a transient error '
+                        'of the Docker daemon or of a registry (default: {})'
+                        .format(DEFAULT_RETRIES))
+    parser.add_argument('--max-daemon-ops', type=int, default=None,
+                        metavar='N',
+                        help='The maximum number of concurrent Docker daemon '
+                        'operations (default: no limit)')
+    parser.add_argument('--all-facts', action="store_true", default=False,
+                        help='Run all the fact scripts (default: only the '
+                        'scripts that declare a fact used by the patches, '
+                        'no container when the patches only use '
+                        'docker_image_user)')
+    parser.add_argument('--facts-file', default=None, metavar='FILE',
+                        help='Read the facts of the images from a YAML or '
+                        'JSON file (e.g. written by --dump-facts) or from '
+                        'the store of --scan instead of Docker')
+    parser.add_argument('--facts-fallback', action="store_true",
+                        default=False, help='--facts-file: gather the facts '
+                        'of the images missing from the file with Docker '
+                        '(default: the missing images are errors)')
+    parser.add_argument('--scan', default=None, metavar='IMAGE_LIST',
+                        help="Gather the facts of the images of a list (one "
+                        "per line, '-' = stdin) into the store --scan-store. "
+                        "An interrupted scan continues where it stopped")
+    parser.add_argument('--scan-store', default='dockerfile-patch-scan.db',
+                        metavar='FILE',
+                        help='--scan: the SQLite store of the facts '
+                        '(default: dockerfile-patch-scan.db)')
+    parser.add_argument('--dump-facts', default=None, metavar='FILE',
+                        help="Write the facts of the Dockerfile's images to "
+                        "a YAML or JSON file ('.json')")
+    parser.add_argument('--cache-dir', default=None,
+                        help='The directory where the gathered facts and '
+                        'the compiled Jinja2 patches are cached '
+                        '(default: ~/.cache/dockerfile-patch)')
+    parser.add_argument('--no-cache', action="store_true",
+                        default=False, help='Always gather the facts and '
+                        'render the patches (the caches are neither read '
+                        'nor written)')
+    parser.add_argument('--purge-cache', action="store_true",
+                        default=False, help='Delete all cached facts '
+                        'before patching the Dockerfile')
+    parser.add_argument('--exit-code', action="store_true",
+                        default=False, help='Exit with the status 2 when a '
+                        'patched Dockerfile (--output, --batch) was created '
+                        'or modified')
 
     args = parser.parse_args()
+    if args.scan and (args.patch or args.path or args.batch or args.serve or
+                      args.watch or args.build or args.output or
+                      args.facts_file or args.dump_facts):
+        parser.error('--scan only gathers the facts of the images')
+    if not args.patch and not args.scan:
+        parser.error('the following arguments are required: -p/--patch')
+    # --scan: many images are gathered without pulling them (the pulled
+    # images would fill the disk)
+    if args.fact_engine is None:
+        args.fact_engine = 'registry' if args.scan else 'container'
+    if args.jobs is None:
+        args.jobs = 16 if args.scan else 4
+    if len(args.path) > 1 and not args.batch:
+        parser.error('several Dockerfile paths require --batch')
+    if args.batch and args.output:
+        parser.error('--batch saves the Dockerfiles with --output-dir')
+    if args.serve and (args.batch or args.path or args.output or
+                       args.dump_facts):
+        parser.error('--serve receives the Dockerfiles from its clients')
+    if args.watch and (args.batch or args.serve or not args.output):
+        parser.error('--watch saves a single Dockerfile with --output')
+    if args.build and (args.batch or args.serve or args.watch):
+        parser.error('--build builds a single Dockerfile')
+    if args.tag and not args.build:
+        parser.error('--tag requires --build')
+    if args.facts_fallback and not args.facts_file:
+        parser.error('--facts-fallback requires --facts-file')
+    if args.retries < 0:
+        parser.error('--retries expects a positive number')
+    if args.max_daemon_ops is not None and args.max_daemon_ops < 1:
+        parser.error('--max-daemon-ops expects a number >= 1')
+    if any('=' not in item for item in args.build_arg):
+        parser.error('--build-arg expects NAME=VALUE')
+
     debug_format = '%(asctime)s %(name)s: %(message)s'
     if args.debug:
         debug_level = logging.DEBUG
@@ -420,7 +2053,9 @@ def parse_args():
 
 
 def garbage_collector(signum, frame):
-    """Garbage collection."""
+    """Cancel the fact gathering, delete the containers and exit."""
+    for docker_facter in list(_ACTIVE_FACTERS):
+        docker_facter.cancel()
     gc.collect()
     if signum == signal.SIGINT:
         sys.stderr.write("Interrupted.\n".format())
@@ -429,49 +2064,241 @@ def garbage_collector(signum, frame):
         sys.exit(0)
 
 
-def main():
-    """The program starts here."""
+def write_profile(path, instrumentation):
+    """Write the JSON report of the instrumentation ('-' = stderr)."""
+    report = json.dumps(instrumentation.report(), indent=2) + '\n'
+    if path == '-':
+        sys.stderr.write('[PROFILE]\n' + report)
+        sys.stderr.flush()
+    else:
+        with open(path, 'w') as fhandler:
+            fhandler.write(report)
 
-    args = parse_args()
 
-    signal.signal(signal.SIGINT, garbage_collector)
-    signal.signal(signal.SIGTERM, garbage_collector)
+def run(args, instrumentation=None):
+    """Run the command line (the arguments returned by parse_args()).
+
+    Return: True if a patched Dockerfile was created or modified (--output,
+    --batch).
 
-    # default facts gatherer
-    default_facts = os.path.join(os.path.dirname(__file__),
-                                 'data', 'default-facts.sh')
+    """
+    if instrumentation is None:
+        instrumentation = Instrumentation()
 
     # Default parameters
     if args.path:
-        dockerfile_dir = args.path
+        dockerfile_dir = args.path[0]
     else:
         dockerfile_dir = '.'
 
-    # launch the pbuild script
-    output = dockerfile_patch(dockerfile_dir=dockerfile_dir,
-                              jinja2_patches_paths=args.patch,
-                              fact_scripts_paths=[default_facts])
-
-    if args.output:
-        sys.stderr.write('[SUCCESS] Patched Dockerfile: {}\n'
-                         .format(args.output))
-        with open(args.output, 'w') as fhandler:
-            fhandler.write(output)
+    build_args = dict(item.split('=', 1) for item in args.build_arg)
+    # --dump-facts writes all the facts of the images
+    all_facts = args.all_facts or bool(args.dump_facts)
+
+    # persistent fact cache
+    cache_dir = args.cache_dir or default_cache_dir()
+    fact_cache = FactCache(path=os.path.join(cache_dir, 'facts'))
+    output_cache = OutputCache(path=os.path.join(cache_dir, 'outputs'))
+    template_env = template_environment(os.path.join(cache_dir, 'jinja2'))
+    if args.purge_cache:
+        fact_cache.purge()
+        output_cache.purge()
+    if args.no_cache:
+        fact_cache = None
+        output_cache = None
+
+    registry_client = None
+    if args.fact_engine == 'registry':
+        from .registry import RegistryClient
+
+        registry_client = RegistryClient(args.insecure_registry)
+
+    docker_facter = DockerFact(fact_cache=fact_cache,
+                               fact_engine=args.fact_engine,
+                               pull_policy=args.pull,
+                               instrumentation=instrumentation,
+                               registry_client=registry_client,
+                               pull_timeout=args.pull_timeout,
+                               run_timeout=args.run_timeout,
+                               retries=args.retries,
+                               max_daemon_ops=args.max_daemon_ops)
+    # --build uses the Docker client of this DockerFact
+    live_facter = docker_facter
+    if args.facts_file:
+        docker_facter = FactsFile(
+            args.facts_file,
+            fallback=docker_facter if args.facts_fallback else None,
+            instrumentation=instrumentation)
+
+    if args.scan:
+        from .scan import FactStore, read_image_list, scan_images
+
+        images = read_image_list(args.scan)
+        docker_facter.add_fact_script(DEFAULT_FACTS_SCRIPT)
+        with FactStore(args.scan_store) as store:
+            result = scan_images(images, docker_facter, store,
+                                 jobs=args.jobs)
+        sys.stderr.write('[SUCCESS] Scan: {} gathered, {} failed, {} '
+                         'already in the store ({})\n'
+                         .format(result['ok'], result['failed'],
+                                 result['skipped'], args.scan_store))
+        sys.stderr.flush()
+        return False
+
+    if args.serve:
+        from .server import PatchService, create_server, serve, \
+            request_shutdown
+
+        service = PatchService(jinja2_patches_paths=args.patch,
+                               fact_scripts_paths=[DEFAULT_FACTS_SCRIPT],
+                               jobs=args.jobs,
+                               template_env=template_env,
+                               docker_facter=docker_facter,
+                               all_facts=all_facts)
+        server = create_server(args.serve, service)
+
+        def shutdown(signum, frame):
+            """Graceful shutdown."""
+            request_shutdown(server)
+
+        signal.signal(signal.SIGINT, shutdown)
+        signal.signal(signal.SIGTERM, shutdown)
+        serve(server)
+        return False
+
+    if args.watch:
+        from .watch import PatchWatcher
+
+        watcher = PatchWatcher(dockerfile_dir, args.output, args.patch,
+                               [DEFAULT_FACTS_SCRIPT], docker_facter,
+                               template_env=template_env, jobs=args.jobs,
+                               build_args=build_args,
+                               instrumentation=instrumentation,
+                               all_facts=all_facts)
+        watcher.watch()
+        return False
+
+    if args.build:
+        from .build import build_image
+
+        dockerfile = load_patched_dockerfile(
+            dockerfile_dir=dockerfile_dir,
+            jinja2_patches_paths=args.patch,
+            fact_scripts_paths=[DEFAULT_FACTS_SCRIPT],
+            jobs=args.jobs,
+            template_env=template_env,
+            docker_facter=docker_facter,
+            instrumentation=instrumentation,
+            build_args=build_args,
+            all_facts=all_facts)
+        if args.dump_facts:
+            dump_facts(args.dump_facts, docker_facter.facts_by_image)
+
+        changed = False
+        if args.output:
+            with instrumentation.timer('write'):
+                changed = dockerfile.save_if_changed(args.output)
+
+        context_dir = dockerfile_dir if os.path.isdir(dockerfile_dir) \
+            else os.path.dirname(dockerfile_dir) or '.'
+        image_id = build_image(live_facter.docker_client, context_dir,
+                               dockerfile.to_str(), tags=args.tag,
+                               build_args=build_args,
+                               instrumentation=instrumentation)
+        sys.stderr.write('[SUCCESS] Built image: {}\n'.format(image_id))
+        sys.stderr.flush()
+        return changed
+
+    if args.batch or args.output:
+        # the patched Dockerfiles are only written when they change
+        # --batch: the Dockerfiles that can't be loaded are reported (the
+        # others are patched)
+        errors = OrderedDict() if args.batch else None
+        if args.batch:
+            dockerfile_dirs = find_dockerfile_dirs(args.path or ['.'])
+        else:
+            dockerfile_dirs = [dockerfile_dir]
+        outputs = dockerfile_patch_batch(
+            dockerfile_dirs=dockerfile_dirs,
+            jinja2_patches_paths=args.patch,
+            fact_scripts_paths=[DEFAULT_FACTS_SCRIPT],
+            output_dir=args.output_dir,
+            output_name=args.output_name,
+            output_paths={dockerfile_dir: args.output} if args.output
+            else None,
+            jobs=args.jobs,
+            template_env=template_env,
+            docker_facter=docker_facter,
+            instrumentation=instrumentation,
+            output_cache=output_cache,
+            build_args=build_args,
+            all_facts=all_facts,
+            errors=errors)
+        for path, changed in outputs.items():
+            sys.stderr.write('[{}] Patched Dockerfile: {}\n'
+                             .format('SUCCESS' if changed else 'UNCHANGED',
+                                     path))
+        for path, error in (errors or {}).items():
+            sys.stderr.write('[ERROR] {}: {}\n'.format(path, error))
+        sys.stderr.flush()
+        if args.dump_facts:
+            dump_facts(args.dump_facts, docker_facter.facts_by_image)
+        if errors:
+            raise DockerfilePatchError('{} of {} Dockerfiles could not be '
+                                       'loaded'.format(len(errors),
+                                                       len(dockerfile_dirs)))
 
         # sys.stderr.write('\n[TIP] You can build it with: docker build -f '
         #                  + args.output + ' -t ' +
         #                  os.path.basename(os.path.abspath(dockerfile_dir)) +
         #                  ':latest ' +
         #                  dockerfile_dir + '\n')
-    else:
-        sys.stderr.write('[SUCCESS] Patched Dockerfile:\n')
+        return any(outputs.values())
 
-        sys.stdout.write(output)
+    # launch the pbuild script
+    dockerfile = load_patched_dockerfile(
+        dockerfile_dir=dockerfile_dir,
+        jinja2_patches_paths=args.patch,
+        fact_scripts_paths=[DEFAULT_FACTS_SCRIPT],
+        jobs=args.jobs,
+        template_env=template_env,
+        docker_facter=docker_facter,
+        instrumentation=instrumentation,
+        build_args=build_args,
+        all_facts=all_facts)
+    timer = instrumentation.timer
+
+    if args.dump_facts:
+        dump_facts(args.dump_facts, docker_facter.facts_by_image)
+
+    sys.stderr.write('[SUCCESS] Patched Dockerfile:\n')
+    with timer('write'):
+        dockerfile.write_to(sys.stdout)
 
     sys.stderr.flush()
     sys.stdout.flush()
+    return False
+
+
+def main():
+    """The program starts here."""
+
+    args = parse_args()
+
+    signal.signal(signal.SIGINT, garbage_collector)
+    signal.signal(signal.SIGTERM, garbage_collector)
+
+    instrumentation = Instrumentation()
+    try:
+        changed = run(args, instrumentation)
+    except DockerfilePatchError as err:
+        sys.stderr.write('ERROR: {}\n'.format(str(err)))
+        sys.exit(1)
+    finally:
+        if args.profile:
+            write_profile(args.profile, instrumentation)
 
-    sys.exit(0)
+    sys.exit(2 if changed and args.exit_code else 0)
 
 
 if __name__ == '__main__':
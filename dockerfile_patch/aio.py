@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Asher256 <asher256@gmail.com>
+# License: LGPL 2.1
+#
+# Github repo: https://github.com/Asher256/dockerfile-patch/
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""The asyncio API of dockerfile-patch.
+
+The Docker operations and the file operations run in a thread pool: the
+event loop is never blocked. The coroutines of the same AsyncPatcher share
+one DockerFact (one Docker client, the facts already gathered and the fact
+cache), so concurrent patch jobs probe each image once:
+
+    async with AsyncPatcher() as patcher:
+        results = await asyncio.gather(
+            patcher.patch_dockerfile('app1', ['patch.j2']),
+            patcher.patch_dockerfile('app2', ['patch.j2']))
+
+The errors are raised (DockerfilePatchError), the process never exits.
+
+"""
+
+
+import asyncio
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from . import (DEFAULT_FACTS_SCRIPT, DockerFact, load_dockerfile,
+               load_jinja_patches, referenced_facts, render_patch,
+               template_environment)
+
+
+class AsyncPatcher(object):
+    """Patch Dockerfiles from coroutines with a shared DockerFact."""
+
+    def __init__(self, fact_scripts_paths=None, docker_facter=None,
+                 jobs=4, template_env=None, all_facts=False, **kwargs):
+        """Init the patcher.
+
+        fact_scripts_paths: list of paths to fact scripts (default: the
+        default fact script)
+        docker_facter: a DockerFact or a FactsFile (default: a new
+        DockerFact created with the keyword arguments, e.g. fact_cache,
+        fact_engine, pull_policy, run_timeout...)
+        jobs: the maximum number of blocking operations (images probed,
+        files loaded) running at the same time, shared by all coroutines
+        template_env: the Jinja2 environment of the patches (default:
+        template_environment())
+        all_facts: run all the fact scripts (default: only the scripts that
+        provide the facts used by the patches)
+
+        """
+        if fact_scripts_paths is None:
+            fact_scripts_paths = [DEFAULT_FACTS_SCRIPT]
+        if docker_facter is None:
+            docker_facter = DockerFact(**kwargs)
+        for path in fact_scripts_paths:
+            docker_facter.add_fact_script(path)
+
+        self.docker_facter = docker_facter
+        self.template_env = template_env
+        self.all_facts = all_facts
+        # the facts of the images {('image', required facts):
+        # asyncio.Future} (the coroutines that need the same facts of an
+        # image wait for the same gathering)
+        self.facts = {}
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(1, jobs),
+            thread_name_prefix='dockerfile-patch')
+
+    async def _run(self, function, *args, **kwargs):
+        """Run a blocking function in the thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(function, *args, **kwargs))
+
+    async def gather_facts(self, image, required_facts=None):
+        """Return the facts of an image (see DockerFact.gather_facts()).
+
+        The facts are gathered once per image name and kept in memory (a
+        failed gathering is attempted again by the next call).
+
+        """
+        key = (image, required_facts)
+        future = self.facts.get(key)
+        if future is None:
+            future = asyncio.ensure_future(
+                self._run(self.docker_facter.gather_facts, image,
+                          required_facts=required_facts))
+            self.facts[key] = future
+
+        try:
+            facts = await asyncio.shield(future)
+        except Exception:
+            if self.facts.get(key) is future:
+                del self.facts[key]
+            raise
+        return dict(facts)
+
+    async def gather_facts_many(self, images, required_facts=None):
+        """Gather the facts of several images concurrently.
+
+        Return: an OrderedDict {'image': facts} that follows the order of
+        'images'.
+
+        """
+        images = list(OrderedDict.fromkeys(images))
+        facts = await asyncio.gather(*[self.gather_facts(image,
+                                                         required_facts)
+                                       for image in images])
+        return OrderedDict(zip(images, facts))
+
+    async def load_patched_dockerfile(self, dockerfile_dir,
+                                      jinja2_patches_paths, build_args=None):
+        """Load a Dockerfile and add the patches of its images.
+
+        Return: a DockerfilePatcher (see load_patched_dockerfile())
+
+        """
+        if self.template_env is None:
+            self.template_env = await self._run(template_environment)
+
+        dockerfile, jinja_patches_content = await asyncio.gather(
+            self._run(load_dockerfile, dockerfile_dir, build_args),
+            self._run(load_jinja_patches, jinja2_patches_paths,
+                      template_env=self.template_env))
+
+        required_facts = None if self.all_facts \
+            else await self._run(referenced_facts, jinja_patches_content)
+        facts = await self.gather_facts_many(dockerfile.get_base_images(),
+                                             required_facts)
+        patches = await self._run(
+            lambda: [(image, render_patch(jinja_patches_content, image_facts))
+                     for image, image_facts in facts.items()])
+        for image, patch in patches:
+            dockerfile.add_patch(image, patch)
+        return dockerfile
+
+    async def patch_dockerfile(self, dockerfile_dir, jinja2_patches_paths,
+                               build_args=None):
+        """Return the patched Dockerfile of 'dockerfile_dir' (a string).
+
+        jinja2_patches_paths: list of paths to Jinja2 templates
+        build_args: the values of the ARGs used by the FROM lines
+        {'name': 'value'}
+
+        """
+        dockerfile = await self.load_patched_dockerfile(
+            dockerfile_dir, jinja2_patches_paths, build_args=build_args)
+        return dockerfile.to_str()
+
+    async def aclose(self):
+        """Delete the running containers and stop the thread pool."""
+        await self._run(self.docker_facter.cleanup)
+        self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        """Return the patcher."""
+        return self
+
+    async def __aexit__(self, *args):
+        """Close the patcher."""
+        await self.aclose()
+
+
+async def patch_dockerfile(dockerfile_dir, jinja2_patches_paths,
+                           fact_scripts_paths=None, build_args=None,
+                           **kwargs):
+    """Return the patched Dockerfile of 'dockerfile_dir' (a string).
+
+    The keyword arguments are the ones of AsyncPatcher. Use an AsyncPatcher
+    to share the facts between several Dockerfiles.
+
+    """
+    async with AsyncPatcher(fact_scripts_paths, **kwargs) as patcher:
+        return await patcher.patch_dockerfile(dockerfile_dir,
+                                              jinja2_patches_paths,
+                                              build_args=build_args)
+
+
+async def gather_facts_many(images, fact_scripts_paths=None, **kwargs):
+    """Return the facts of several images {'image': facts}.
+
+    The keyword arguments are the ones of AsyncPatcher.
+
+    """
+    async with AsyncPatcher(fact_scripts_paths, **kwargs) as patcher:
+        return await patcher.gather_facts_many(images)
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Asher256 <asher256@gmail.com>
+# License: LGPL 2.1
+#
+# Github repo: https://github.com/Asher256/dockerfile-patch/
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Build a patched Dockerfile without writing it to disk (--build).
+
+The build context is streamed to the Docker daemon as a tar archive that is
+generated while it is uploaded (chunked transfer): the files excluded by
+'.dockerignore' are skipped and the patched Dockerfile is added to the
+archive from memory, like 'docker build -f' does with a Dockerfile outside of
+the context.
+
+"""
+
+
+import io
+import os
+import sys
+import time
+import logging
+import tarfile
+
+from . import DockerfilePatchError
+from .instrumentation import Instrumentation
+
+
+# The name of the patched Dockerfile in the build context (it is excluded by
+# the '.dockerignore' of the context: 'COPY . .' doesn't copy it)
+DOCKERFILE_NAME = '.dockerfile-patch.Dockerfile'
+
+# The size of the chunks sent to the Docker daemon
+CHUNK_SIZE = 256 * 1024
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def read_dockerignore(context_dir):
+    """Return the patterns of the '.dockerignore' of a build context."""
+    try:
+        with open(os.path.join(context_dir, '.dockerignore'), 'r') \
+                as fhandler:
+            lines = fhandler.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+    return [line.strip() for line in lines
+            if line.strip() and not line.strip().startswith('#')]
+
+
+def context_files(context_dir, patterns):
+    """Return the paths of the build context (sorted, relative).
+
+    The '.dockerignore' patterns are applied like 'docker build' does
+    (docker.utils.build.exclude_paths()).
+
+    """
+    from docker.utils.build import exclude_paths
+
+    return sorted(exclude_paths(os.path.abspath(context_dir), list(patterns),
+                                dockerfile=DOCKERFILE_NAME))
+
+
+def tar_header(info):
+    """Return the header of a tar member."""
+    return info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+
+
+def tar_padding(size):
+    """Return the padding after the content of a tar member."""
+    remainder = size % tarfile.BLOCKSIZE
+    return b'\0' * (tarfile.BLOCKSIZE - remainder) if remainder else b''
+
+
+def iter_context(context_dir, files, extra_files):
+    """Yield the tar archive of a build context (pieces of bytes).
+
+    files: the paths of the files of context_dir (see context_files())
+    extra_files: the files added from memory {'name': 'content'}
+
+    The content of the files is read by chunks: the memory used doesn't
+    depend on the size of the files.
+
+    """
+    root = os.path.abspath(context_dir)
+    # gettarinfo() needs a TarFile (nothing is written to it)
+    stub = tarfile.open(fileobj=io.BytesIO(), mode='w')
+
+    for path in files:
+        full_path = os.path.join(root, path)
+        info = stub.gettarinfo(full_path, arcname=path)
+        if info is None:
+            # sockets
+            continue
+
+        if not info.isfile():
+            yield tar_header(info)
+            continue
+
+        try:
+            fhandler = open(full_path, 'rb')
+        except OSError as err:
+            raise DockerfilePatchError("unable to read the file '{}' of the "
+                                       "build context. {}"
+                                       .format(full_path, str(err)))
+        with fhandler:
+            yield tar_header(info)
+            remaining = info.size
+            while remaining:
+                chunk = fhandler.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise DockerfilePatchError(
+                        "the file '{}' of the build context was modified "
+                        "during the build".format(full_path))
+                remaining -= len(chunk)
+                yield chunk
+        yield tar_padding(info.size)
+
+    for name, content in extra_files.items():
+        data = content.encode('utf-8')
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mode = 0o644
+        info.mtime = time.time()
+        yield tar_header(info)
+        yield data
+        yield tar_padding(info.size)
+
+    # the end of the archive
+    yield b'\0' * (tarfile.BLOCKSIZE * 2)
+
+
+def chunked(pieces, size=CHUNK_SIZE):
+    """Group small pieces of bytes into chunks of about 'size' bytes."""
+    buffer = []
+    buffered = 0
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= size:
+            yield b''.join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def image_reference(tag):
+    """Split a tag into (repository, tag): 'app:1.0' => ('app', '1.0')."""
+    name, separator, version = tag.rpartition(':')
+    if not separator or '/' in version:
+        return tag, 'latest'
+    return name, version
+
+
+def build_event(event, output):
+    """Write a build log event to 'output'.
+
+    Return: the ID of the image (the last event of a successful build) or
+    None.
+
+    """
+    if 'error' in event:
+        message = (event.get('errorDetail') or {}).get('message') or \
+            event['error']
+        raise DockerfilePatchError('the build failed. ' + message.strip())
+
+    if 'stream' in event:
+        output.write(event['stream'])
+        output.flush()
+    elif 'status' in event:
+        output.write(' '.join(str(event[key])
+                              for key in ('id', 'status', 'progress')
+                              if event.get(key)) + '\n')
+        output.flush()
+
+    return (event.get('aux') or {}).get('ID')
+
+
+def build_image(docker_client, context_dir, dockerfile_content, tags=None,
+                build_args=None, output=None, instrumentation=None):
+    """Build a patched Dockerfile and return the ID of the image.
+
+    docker_client: a docker.DockerClient (e.g. DockerFact.docker_client)
+    context_dir: the directory of the build context
+    dockerfile_content: the patched Dockerfile (a string)
+    tags: the tags of the image ['name:tag', ...]
+    build_args: the ARGs of the build {'name': 'value'}
+    output: the build logs are written to this file object as they arrive
+    (default: sys.stdout)
+    instrumentation: an Instrumentation (timings of the build)
+
+    """
+    from docker.errors import DockerException
+    from requests.exceptions import RequestException
+
+    if output is None:
+        output = sys.stdout
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+    tags = list(tags or [])
+
+    patterns = read_dockerignore(context_dir)
+    extra_files = {
+        DOCKERFILE_NAME: dockerfile_content,
+        # the patched Dockerfile isn't part of the files of the context
+        '.dockerignore': '\n'.join((patterns or ['.dockerignore']) +
+                                   [DOCKERFILE_NAME]) + '\n'}
+    # the files of the context replaced by extra_files
+    files = [path for path in context_files(context_dir, patterns)
+             if path not in extra_files]
+    LOGGER.debug('[BUILD] Build context %s: %d files', context_dir,
+                 len(files))
+
+    sys.stderr.write('[RUN] docker build {}{}\n'.format(
+        context_dir, ''.join(' -t ' + tag for tag in tags)))
+    sys.stderr.flush()
+
+    image_id = None
+    try:
+        with instrumentation.timer('build'):
+            events = docker_client.api.build(
+                fileobj=chunked(iter_context(context_dir, files,
+                                             extra_files)),
+                custom_context=True, dockerfile=DOCKERFILE_NAME,
+                tag=tags[0] if tags else None,
+                buildargs=build_args or None, rm=True, decode=True)
+            for event in events:
+                image_id = build_event(event, output) or image_id
+    except (DockerException, RequestException) as err:
+        raise DockerfilePatchError('the build of {} failed. {}'
+                                   .format(context_dir, str(err)))
+
+    if image_id is None:
+        raise DockerfilePatchError('the build of {} returned no image'
+                                   .format(context_dir))
+
+    for tag in tags[1:]:
+        repository, version = image_reference(tag)
+        try:
+            docker_client.api.tag(image_id, repository, version)
+        except DockerException as err:
+            raise DockerfilePatchError("unable to tag the image '{}' as "
+                                       "'{}'. {}".format(image_id, tag,
+                                                         str(err)))
+
+    return image_id
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -9,6 +9,8 @@
 # This source code follows the Google style guide for shell scripts:
 # https://google.github.io/styleguide/shell.xml
 #
+# provides: osfamily operatingsystem kernelrelease architecture
+#
 
 set -u
 set -e
@@ -33,13 +35,13 @@ if [ "$operatingsystem" = "Linux" ]; then
   fi
 fi
 
-# Output in the Yaml format
-{
-  echo "osfamily: $osfamily"
-  echo "operatingsystem: $operatingsystem"
-  echo "kernelrelease: $kernelrelease"
-  echo "architecture: $architecture"
-} >> facts.yaml
+# Output: NUL-delimited key=value pairs (the values can contain any
+# character but NUL)
+printf '%s=%s\000' \
+  osfamily "$osfamily" \
+  operatingsystem "$operatingsystem" \
+  kernelrelease "$kernelrelease" \
+  architecture "$architecture" > facts.nul
 
 exit 0
 
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Asher256 <asher256@gmail.com>
+# License: LGPL 2.1
+#
+# Github repo: https://github.com/Asher256/dockerfile-patch/
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""A compact model of the Dockerfile instructions.
+
+The Dockerfile is parsed in one pass into Instruction records. Every line of
+the original text belongs to exactly one record (blank lines and comments
+included), so joining the 'content' of the records gives back the original
+Dockerfile byte for byte.
+
+"""
+
+
+import re
+
+
+# The parser directives are comments at the top of the Dockerfile
+ESCAPE_DIRECTIVE = re.compile(r'^#\s*escape\s*=\s*(\S)\s*$', re.IGNORECASE)
+DIRECTIVE = re.compile(r'^#\s*[a-zA-Z][a-zA-Z0-9_-]*\s*=')
+
+# RUN <<EOT, COPY <<-"EOT" /file, ... (the words that start with '<<' in
+# the instructions that support the heredocs, like BuildKit)
+HEREDOC = re.compile(r'<<(-?)(["\']?)([a-zA-Z_][a-zA-Z0-9_]*)\2')
+HEREDOC_INSTRUCTIONS = ('RUN', 'COPY', 'ADD')
+
+# The 'instruction' of the records that are not instructions
+COMMENT = 'COMMENT'
+BLANK = 'BLANK'
+
+
+class Instruction(object):
+    """An instruction of a Dockerfile (or a comment, or blank lines).
+
+    instruction: the upper case instruction ('FROM', 'RUN', ...), COMMENT
+    or BLANK
+    value: the arguments of the instruction (the continuation lines are
+    joined and the comments inside the instruction are removed)
+    content: the original text (with the end of lines)
+    startline, endline: the line numbers (starting at 0)
+
+    The records support item['value'] like the dicts of
+    DockerfileParser.structure.
+
+    """
+
+    __slots__ = ('instruction', 'value', 'content', 'startline', 'endline')
+
+    def __init__(self, instruction, value, content, startline, endline):
+        """Init the record."""
+        self.instruction = instruction
+        self.value = value
+        self.content = content
+        self.startline = startline
+        self.endline = endline
+
+    def __getitem__(self, key):
+        """Return an attribute (compatibility with dict items)."""
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __repr__(self):
+        """Return the representation of the record."""
+        return 'Instruction({!r}, {!r}, lines {}-{})'.format(
+            self.instruction, self.value, self.startline, self.endline)
+
+
+def heredoc_terminators(instruction, value):
+    """Return the heredocs of an instruction [(terminator, strip_tabs)]."""
+    if instruction not in HEREDOC_INSTRUCTIONS:
+        return []
+
+    result = []
+    for word in value.split():
+        match = HEREDOC.match(word)
+        if match:
+            result.append((match.group(3), match.group(1) == '-'))
+    return result
+
+
+def parse_dockerfile(content):
+    """Parse a Dockerfile (a string).
+
+    Return: (records, from_index)
+        records: a list of Instruction
+        from_index: the indexes of the FROM records
+
+    """
+    records = []
+    from_index = []
+    escape = '\\'
+    directives = True
+
+    lines = content.splitlines(True)
+    number = 0
+    count = len(lines)
+    while number < count:
+        line = lines[number]
+        stripped = line.strip()
+        start = number
+        number += 1
+
+        if not stripped:
+            # consecutive blank lines are one record
+            while number < count and not lines[number].strip():
+                number += 1
+            records.append(Instruction(BLANK, '', ''.join(lines[start:number]),
+                                       start, number - 1))
+            directives = False
+            continue
+
+        if stripped.startswith('#'):
+            if directives and DIRECTIVE.match(stripped):
+                match = ESCAPE_DIRECTIVE.match(stripped)
+                if match:
+                    escape = match.group(1)
+            else:
+                directives = False
+            records.append(Instruction(COMMENT, stripped[1:].strip(), line,
+                                       start, start))
+            continue
+
+        directives = False
+
+        # The continuation lines (the comments inside are ignored)
+        parts = []
+        current = stripped
+        while current.endswith(escape):
+            parts.append(current[:-1])
+            current = None
+            while number < count:
+                next_line = lines[number].strip()
+                number += 1
+                if next_line and not next_line.startswith('#'):
+                    current = next_line
+                    break
+            if current is None:
+                break
+        if current is not None:
+            parts.append(current)
+
+        fields = ''.join(parts).split(None, 1)
+        if not fields:
+            # an escape character without instruction (e.g. at the end of
+            # the file): ignored like Docker does, the lines are kept
+            records.append(Instruction(BLANK, '', ''.join(lines[start:number]),
+                                       start, number - 1))
+            continue
+
+        instruction = fields[0].upper()
+        value = fields[1].strip() if len(fields) > 1 else ''
+
+        # The heredocs are part of the instruction
+        for terminator, strip_tabs in heredoc_terminators(instruction,
+                                                          value):
+            while number < count:
+                heredoc_line = lines[number].rstrip('\r\n')
+                number += 1
+                if strip_tabs:
+                    heredoc_line = heredoc_line.lstrip('\t')
+                if heredoc_line == terminator:
+                    break
+
+        if instruction == 'FROM':
+            from_index.append(len(records))
+        records.append(Instruction(instruction, value,
+                                   ''.join(lines[start:number]),
+                                   start, number - 1))
+
+    return records, from_index
+
+
+class Stage(object):
+    """A stage of a multi-stage Dockerfile (a FROM instruction).
+
+    index: the index of the FROM record
+    image: the image of the FROM line (the ARGs are substituted)
+    alias: the name of the stage ('FROM image AS name', lower case) or None
+    platform: the value of --platform (None if unknown). The facts are
+    gathered for the platform of the host: it is only used to warn about
+    the other platforms
+    parent: the Stage built upon ('FROM name' of a previous stage) or None
+    root_image: the external image of the stage (the image of the first
+    ancestor) or None for 'scratch'
+
+    """
+
+    __slots__ = ('index', 'image', 'alias', 'platform', 'parent',
+                 'root_image')
+
+    def __init__(self, index, image, alias=None, platform=None,
+                 parent=None, root_image=None):
+        """Init the stage."""
+        self.index = index
+        self.image = image
+        self.alias = alias
+        self.platform = platform
+        self.parent = parent
+        self.root_image = root_image
+
+    def __repr__(self):
+        """Return the representation of the stage."""
+        return 'Stage({!r}, alias={!r}, root_image={!r})'.format(
+            self.image, self.alias, self.root_image)
+
+
+# $NAME, ${NAME}, ${NAME:-default} and ${NAME:+alternative}
+VARIABLE = re.compile(r'\$(?:([a-zA-Z_][a-zA-Z0-9_]*)|'
+                      r'\{([a-zA-Z_][a-zA-Z0-9_]*)(?::([-+])([^}]*))?\})')
+
+
+def substitute_args(text, args):
+    """Replace the variables of 'text' with the values of 'args' {name: value}.
+
+    The unset variables are replaced by an empty string (like Docker).
+
+    """
+    def replace(match):
+        """Return the value of a variable."""
+        name = match.group(1) or match.group(2)
+        value = args.get(name)
+        if match.group(3) == '-':
+            return value if value else match.group(4)
+        if match.group(3) == '+':
+            return match.group(4) if value else ''
+        return value or ''
+
+    if '$' not in text:
+        return text
+    return VARIABLE.sub(replace, text)
+
+
+def unquote(value):
+    """Remove the quotes around a value."""
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'':
+        return value[1:-1]
+    return value
+
+
+def parse_arg(value, args, build_args):
+    """Add the variables of an ARG instruction to 'args'."""
+    for item in value.split():
+        name, has_default, default = item.partition('=')
+        if name in build_args:
+            args[name] = build_args[name]
+        elif has_default:
+            args[name] = substitute_args(unquote(default), args)
+
+
+def parse_from(value):
+    """Split the value of a FROM instruction.
+
+    Return: (image, alias, {'flag': value})
+
+    """
+    flags = {}
+    fields = value.split()
+    while fields and fields[0].startswith('--'):
+        flag, _, flag_value = fields.pop(0)[2:].partition('=')
+        flags[flag.lower()] = flag_value
+
+    image = fields[0] if fields else ''
+    alias = None
+    if len(fields) >= 3 and fields[1].upper() == 'AS':
+        alias = fields[2]
+    return image, alias, flags
+
+
+def build_stages(records, from_index, build_args=None):
+    """Return the stages of a Dockerfile (a list of Stage).
+
+    records, from_index: returned by parse_dockerfile()
+    build_args: the values of the ARGs {'name': 'value'} (like
+    'docker build --build-arg')
+
+    The ARGs declared before the first FROM are substituted in the FROM
+    lines. The stages built upon a previous stage ('FROM name') are
+    resolved to the external image of their first ancestor.
+
+    Raise ValueError if the image of a FROM line is empty (e.g. 'FROM
+    ${UNSET}').
+
+    """
+    build_args = build_args or {}
+
+    # the global ARGs (declared before the first FROM)
+    args = {}
+    for record in records[:from_index[0] if from_index else len(records)]:
+        if record.instruction == 'ARG':
+            parse_arg(record.value, args, build_args)
+
+    stages = []
+    aliases = {}
+    for index in from_index:
+        image, alias, flags = parse_from(records[index].value)
+        image = substitute_args(image, args)
+        if not image:
+            raise ValueError("the image of the FROM instruction at line {} "
+                             "is empty: {}".format(
+                                 records[index].startline + 1,
+                                 records[index].value))
+
+        platform = flags.get('platform')
+        if platform is not None:
+            platform = substitute_args(platform, args) or None
+
+        stage = Stage(index, image,
+                      alias=alias.lower() if alias else None,
+                      platform=platform)
+        parent = aliases.get(image.lower())
+        if parent is not None:
+            stage.parent = parent
+            stage.root_image = parent.root_image
+        elif image.lower() != 'scratch':
+            stage.root_image = image
+
+        if stage.alias:
+            aliases[stage.alias] = stage
+        stages.append(stage)
+
+    return stages
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Asher256 <asher256@gmail.com>
+# License: LGPL 2.1
+#
+# Github repo: https://github.com/Asher256/dockerfile-patch/
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Per-stage timings and counters of the patching process.
+
+The stages are timed with Instrumentation.timer() and the counters (cache
+hits, bytes pulled, ...) are incremented with Instrumentation.count(). Each
+measure is sent to the hooks added with Instrumentation.add_hook() (e.g. to
+export the measures to a metrics system) and summarized by report().
+
+"""
+
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+
+class Instrumentation(object):
+    """Collect the timings and the counters of the patching process."""
+
+    def __init__(self):
+        """Init the instrumentation."""
+        self.logging = logging.getLogger(__name__ + '.' +
+                                         self.__class__.__name__)
+        self.started = time.time()
+        self.hooks = []
+        # [{'stage': 'pull', 'image': 'ubuntu', 'duration': 1.2}, ...]
+        self.timings = []
+        # {'name': value}
+        self.counters = OrderedDict()
+        # {'image': {'name': value}}
+        self.image_counters = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """Call hook(event) for each measure.
+
+        The events are dicts: {'type': 'timing', 'stage': name, 'image':
+        image or None, 'duration': seconds} or {'type': 'counter', 'name':
+        name, 'image': image or None, 'value': increment}.
+
+        """
+        self.hooks.append(hook)
+
+    def _emit(self, event):
+        """Send an event to the hooks."""
+        for hook in self.hooks:
+            try:
+                hook(event)
+            except Exception:  # pylint: disable=broad-except
+                self.logging.exception('[INSTRUMENTATION] Hook failed')
+
+    @contextmanager
+    def timer(self, stage, image=None):
+        """Measure the wall-clock time of a stage (context manager)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self.lock:
+                self.timings.append({'stage': stage,
+                                     'image': image,
+                                     'duration': duration})
+            self.logging.debug('[PROFILE] %s%s: %.3fs', stage,
+                               " '{}'".format(image) if image else '',
+                               duration)
+            self._emit({'type': 'timing',
+                        'stage': stage,
+                        'image': image,
+                        'duration': duration})
+
+    def count(self, name, value=1, image=None):
+        """Increment a counter (e.g. 'fact_cache_hits', 'bytes_pulled')."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            if image:
+                counters = self.image_counters.setdefault(image,
+                                                          OrderedDict())
+                counters[name] = counters.get(name, 0) + value
+
+        self._emit({'type': 'counter',
+                    'name': name,
+                    'image': image,
+                    'value': value})
+
+    def report(self):
+        """Return a summary of the measures (JSON serializable)."""
+        with self.lock:
+            timings = list(self.timings)
+            counters = OrderedDict(self.counters)
+            image_counters = OrderedDict(
+                (image, OrderedDict(values))
+                for image, values in self.image_counters.items())
+
+        stages = OrderedDict()
+        images = OrderedDict()
+        for item in timings:
+            stage = stages.setdefault(item['stage'],
+                                      OrderedDict((('count', 0),
+                                                   ('total', 0.0),
+                                                   ('max', 0.0))))
+            stage['count'] += 1
+            stage['total'] += item['duration']
+            stage['max'] = max(stage['max'], item['duration'])
+
+            if item['image']:
+                image = images.setdefault(item['image'], OrderedDict())
+                image[item['stage']] = image.get(item['stage'], 0.0) + \
+                    item['duration']
+
+        for stage in stages.values():
+            stage['mean'] = stage['total'] / stage['count']
+
+        for image, values in image_counters.items():
+            images.setdefault(image, OrderedDict()).update(values)
+
+        return OrderedDict((('wall_time', time.time() - self.started),
+                            ('stages', stages),
+                            ('images', images),
+                            ('counters', counters)))
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
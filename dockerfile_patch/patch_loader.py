@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Asher256 <asher256@gmail.com>
+# License: LGPL 2.1
+#
+# Github repo: https://github.com/Asher256/dockerfile-patch/
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""The Jinja2 loader and environment of the patches.
+
+This module imports Jinja2: it is imported by template_environment() when
+the first patch is loaded.
+
+"""
+
+
+import os
+import threading
+
+from jinja2 import Environment, FileSystemLoader
+
+
+class PatchLoader(FileSystemLoader):
+    """Load the Jinja2 patches by path.
+
+    The absolute paths are loaded directly. The other names (e.g.
+    {% include 'common.j2' %} not found next to the including template, see
+    PatchEnvironment) are searched in the search path: the directories of
+    the patches loaded together (see PatchEnvironment.scoped()).
+
+    """
+
+    def get_source(self, environment, template):
+        """Return (source, filename, uptodate) of a template."""
+        if not os.path.isabs(template):
+            return super().get_source(environment, template)
+
+        with open(template, 'r') as fhandler:
+            source = fhandler.read()
+        mtime = os.path.getmtime(template)
+
+        def uptodate():
+            """Return True if the file has not been modified."""
+            try:
+                return os.path.getmtime(template) == mtime
+            except OSError:
+                return False
+
+        return source, template, uptodate
+
+
+class PatchEnvironment(Environment):
+    """The Jinja2 environment of the patches.
+
+    A relative name included by a patch ({% include 'common.j2' %}) is
+    resolved in the directory of the including template first: two patches
+    of different directories include their own 'common.j2'. The other
+    directories searched are those of the environment returned by
+    scoped(): the patches loaded together don't see the directories of
+    unrelated patches.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Init the environment."""
+        Environment.__init__(self, *args, **kwargs)
+        self._lock = threading.Lock()
+        # {searchpath: PatchEnvironment}
+        self._scopes = {}
+        # the compiled patches {'path': (source, template)}
+        self._patches = {}
+
+    def scoped(self, searchpath):
+        """Return the environment that searches the directories 'searchpath'.
+
+        The environments are memorized (one per search path) and share the
+        bytecode cache.
+
+        """
+        key = tuple(os.path.abspath(path) for path in searchpath)
+        with self._lock:
+            if key not in self._scopes:
+                self._scopes[key] = PatchEnvironment(
+                    loader=PatchLoader(list(key)),
+                    bytecode_cache=self.bytecode_cache, cache_size=-1)
+            return self._scopes[key]
+
+    def clear_cache(self):
+        """Forget the compiled templates (of the scoped environments too)."""
+        with self._lock:
+            environments = [self] + list(self._scopes.values())
+        for environment in environments:
+            with environment._lock:
+                environment._patches.clear()
+            if environment.cache is not None:
+                environment.cache.clear()
+
+    def load_patch(self, path):
+        """Return (source, template) of a patch (an absolute path).
+
+        The file is read once, and the template is only compiled again when
+        its source changes.
+
+        """
+        source, filename, uptodate = self.loader.get_source(self, path)
+        with self._lock:
+            cached = self._patches.get(path)
+        if cached is not None and cached[0] == source:
+            return cached
+
+        code = None
+        bucket = None
+        if self.bytecode_cache is not None:
+            bucket = self.bytecode_cache.get_bucket(self, path, filename,
+                                                    source)
+            code = bucket.code
+        if code is None:
+            code = self.compile(source, path, filename)
+            if bucket is not None:
+                bucket.code = code
+                self.bytecode_cache.set_bucket(bucket)
+
+        template = self.template_class.from_code(self, code,
+                                                 self.make_globals(None),
+                                                 uptodate)
+        with self._lock:
+            self._patches[path] = (source, template)
+        return source, template
+
+    def join_path(self, template, parent):
+        """Return the name of a template included by 'parent'."""
+        if os.path.isabs(template) or not os.path.isabs(parent):
+            return template
+
+        path = os.path.normpath(os.path.join(os.path.dirname(parent),
+                                             template))
+        return path if os.path.isfile(path) else template
+
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
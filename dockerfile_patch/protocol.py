@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Asher256 <asher256@gmail.com>
+# License: LGPL 2.1
+#
+# Github repo: https://github.com/Asher256/dockerfile-patch/
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""The protocol between the fact scripts and dockerfile-patch.
+
+Each fact script runs in its own directory (the current directory of the
+script) and writes its facts in one of these files:
+- 'facts.json': a JSON object
+- 'facts.nul': NUL-delimited pairs 'key=value\\0key=value\\0' (the values are
+  strings)
+- 'facts.yaml': YAML (the historical format, slower to parse)
+
+The scripts are started in parallel by the main script, which writes the
+fact files to stdout. Each file is preceded by a header line:
+
+    DOCKERFILE-PATCH-FACTS <protocol> <script index> <format> <size>\\n
+
+"""
+
+
+import re
+import json
+import posixpath
+
+
+FACTS_PROTOCOL = 2
+
+HEADER = b'DOCKERFILE-PATCH-FACTS'
+
+# (format, file name) in the order of preference
+FACT_FILES = (('json', 'facts.json'),
+              ('nul', 'facts.nul'),
+              ('yaml', 'facts.yaml'))
+
+# The facts of each script are also available in facts['scripts'][name]
+NAMESPACES_FACT = 'scripts'
+
+# The declaration of the facts written by a script
+PROVIDES_RE = re.compile(r'^\s*#\s*provides:(.*)$', re.MULTILINE)
+
+
+def script_namespace(path):
+    """Return the namespace of a fact script.
+
+    Example: 'default-facts.sh' => 'default_facts'
+
+    """
+    name = posixpath.basename(path).split('.', 1)[0]
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name) or 'script'
+
+
+def script_namespaces(paths):
+    """Return the unique namespaces of fact scripts {'path': 'namespace'}.
+
+    The scripts with the same name get the suffix '_<index>' (index: the
+    position of the script in 'paths', starting at 1), e.g. 'a/facts.sh'
+    => 'facts' and 'b/facts.sh' => 'facts_2'.
+
+    """
+    result = {}
+    used = set()
+    for index, path in enumerate(paths, 1):
+        namespace = script_namespace(path)
+        if namespace in used:
+            namespace = '{}_{}'.format(namespace, index)
+            while namespace in used:
+                namespace += '_'
+        used.add(namespace)
+        result[path] = namespace
+    return result
+
+
+def script_provides(content):
+    """Return the facts declared by a fact script ('# provides: ...').
+
+    Return: a frozenset, or None if the script doesn't declare its facts.
+
+    """
+    declarations = PROVIDES_RE.findall(content)
+    if not declarations:
+        return None
+    return frozenset(name
+                     for declaration in declarations
+                     for name in re.split(r'[\s,]+', declaration)
+                     if name)
+
+
+def main_script(guest_dir, guest_scripts):
+    """Return the main script that runs the fact scripts in parallel.
+
+    guest_dir: the directory of the scripts in the container
+    guest_scripts: the paths of the scripts in the container (the index of
+    a script in the output is its position in this list, starting at 1)
+
+    """
+    lines = ['#!/bin/sh',
+             'cd "{}" || exit 1'.format(guest_dir),
+             'DOCKERFILE_PATCH_FACTS_PROTOCOL={}'.format(FACTS_PROTOCOL),
+             'export DOCKERFILE_PATCH_FACTS_PROTOCOL',
+             '',
+             '# the stdout of the fact scripts goes to stderr: the stdout of',
+             '# the container is the facts',
+             'pids=""']
+    for index, path in enumerate(guest_scripts, 1):
+        work_dir = 'work/{:06d}'.format(index)
+        lines += ['mkdir -p "{}" || exit 1'.format(work_dir),
+                  '(cd "{}" && exec "{}") >&2 &'.format(work_dir, path),
+                  'pids="$pids $!"']
+
+    lines += ['',
+              'status=0',
+              'for pid in $pids; do',
+              '  wait "$pid" || status=1',
+              'done',
+              '[ "$status" -eq 0 ] || exit 1',
+              '',
+              'emit() {',
+              '  if [ -f "work/$1/$3" ]; then',
+              "    printf '{} {} %s %s %s\\n' \"$1\" \"$2\" "
+              "\"$(wc -c < \"work/$1/$3\" | tr -d ' ')\""
+              .format(HEADER.decode('ascii'), FACTS_PROTOCOL),
+              '    cat "work/$1/$3"',
+              '  fi',
+              '}']
+    for index in range(1, len(guest_scripts) + 1):
+        for fact_format, name in FACT_FILES:
+            lines.append('emit {:06d} {} {}'.format(index, fact_format, name))
+
+    return '\n'.join(lines) + '\n'
+
+
+def yaml_loader():
+    """Return the fastest safe YAML loader (LibYAML if it is installed)."""
+    import yaml
+
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def parse_facts(content, fact_format):
+    """Parse the content of a fact file (bytes) into a dict.
+
+    Raise: ValueError if the content is invalid.
+
+    """
+    if fact_format == 'json':
+        facts = json.loads(content.decode('utf-8'))
+    elif fact_format == 'nul':
+        facts = {}
+        for item in content.decode('utf-8', 'replace').split('\0'):
+            key, separator, value = item.partition('=')
+            key = key.strip()
+            if separator and key:
+                facts[key] = value
+    elif fact_format == 'yaml':
+        import yaml
+
+        try:
+            facts = yaml.load(content, Loader=yaml_loader())
+        except yaml.YAMLError as err:
+            raise ValueError(str(err))
+    else:
+        raise ValueError("unknown fact format '{}'".format(fact_format))
+
+    if facts is None:
+        return {}
+    if not isinstance(facts, dict):
+        raise ValueError('the facts need to be a mapping (got: {})'
+                         .format(type(facts).__name__))
+    return facts
+
+
+def parse_output(output, namespaces):
+    """Parse the output of the main script (bytes).
+
+    namespaces: the unique namespace of each script (in the order of the
+    scripts, see script_namespaces())
+
+    Return: the facts of all scripts merged (the later scripts win) and
+    facts['scripts'] = {'namespace': the facts of the script}.
+
+    An output without header is parsed as 'facts.yaml' (first protocol).
+
+    Raise: ValueError if the output is invalid.
+
+    """
+    if not output.startswith(HEADER):
+        return parse_facts(output, 'yaml')
+
+    facts = {}
+    by_script = {}
+    position = 0
+    while position < len(output):
+        end = output.find(b'\n', position)
+        if end < 0:
+            raise ValueError('truncated fact header')
+        fields = output[position:end].split()
+        if len(fields) != 5 or fields[0] != HEADER:
+            raise ValueError('invalid fact header: {!r}'
+                             .format(output[position:end]))
+
+        protocol, index, fact_format, size = fields[1:]
+        if int(protocol) > FACTS_PROTOCOL:
+            raise ValueError('unsupported fact protocol: {}'
+                             .format(int(protocol)))
+        if not 1 <= int(index) <= len(namespaces) or int(size) < 0:
+            raise ValueError('invalid fact header: {!r}'
+                             .format(output[position:end]))
+
+        start = end + 1
+        position = start + int(size)
+        if position > len(output):
+            raise ValueError('truncated facts of the script {} ({} bytes '
+                             'instead of {})'.format(int(index),
+                                                     len(output) - start,
+                                                     int(size)))
+        script_facts = parse_facts(output[start:position],
+                                   fact_format.decode('ascii'))
+
+        namespace = namespaces[int(index) - 1]
+        by_script.setdefault(namespace, {}).update(script_facts)
+        facts.update(script_facts)
+
+    if by_script:
+        facts[NAMESPACES_FACT] = by_script
+    return facts
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
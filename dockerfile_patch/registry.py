@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Asher256 <asher256@gmail.com>
+# License: LGPL 2.1
+#
+# Github repo: https://github.com/Asher256/dockerfile-patch/
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Gather the default facts of an image from its registry (no pull).
+
+Only the manifest and the image config (a few KB) are downloaded. The
+osfamily is read from the base layer, which is streamed until the end of its
+'/etc' directory (the download is stopped early).
+
+"""
+
+
+import os
+import json
+import base64
+import logging
+import platform
+import tarfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from . import TRANSIENT_STATUS
+from .static_facts import (OS_RELEASE_FILES, OSFAMILY_FILES, apply_layers,
+                           compute_facts, scan_layer)
+
+
+DOCKER_HUB = 'registry-1.docker.io'
+
+MEDIA_TYPES = {
+    'docker_list':
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'docker_manifest':
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'oci_index': 'application/vnd.oci.image.index.v1+json',
+    'oci_manifest': 'application/vnd.oci.image.manifest.v1+json',
+}
+INDEX_TYPES = (MEDIA_TYPES['docker_list'], MEDIA_TYPES['oci_index'])
+
+# 'uname -m' => Docker architecture
+DOCKER_ARCHITECTURES = {'x86_64': 'amd64',
+                        'aarch64': 'arm64',
+                        'armv7l': 'arm',
+                        'i686': '386'}
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RegistryError(Exception):
+    """An error returned by a registry.
+
+    transient: True if the error is temporary (the request can be retried)
+
+    """
+
+    def __init__(self, message, transient=False):
+        """Init the error."""
+        super().__init__(message)
+        self.transient = transient
+
+
+def default_platform():
+    """Return the platform of this host ('linux/amd64', ...)."""
+    machine = platform.machine()
+    return 'linux/' + DOCKER_ARCHITECTURES.get(machine, machine)
+
+
+def parse_reference(image):
+    """Split an image reference.
+
+    Return: (registry, repository, reference)
+
+    'ubuntu' => ('registry-1.docker.io', 'library/ubuntu', 'latest')
+    'localhost:5000/app@sha256:...' => ('localhost:5000', 'app',
+    'sha256:...')
+
+    """
+    name, _, digest = image.partition('@')
+    registry = DOCKER_HUB
+    first, _, rest = name.partition('/')
+    if rest and ('.' in first or ':' in first or first == 'localhost'):
+        registry = first
+        name = rest
+
+    tag = 'latest'
+    last_slash = name.rfind('/')
+    if name.rfind(':') > last_slash:
+        name, tag = name.rsplit(':', 1)
+
+    if registry == DOCKER_HUB and '/' not in name:
+        name = 'library/' + name
+    if registry in ('docker.io', 'index.docker.io'):
+        registry = DOCKER_HUB
+
+    return registry, name, digest or tag
+
+
+def platform_name(item):
+    """Return the platform of a manifest list entry ('linux/arm/v7')."""
+    info = item.get('platform') or {}
+    result = '{}/{}'.format(info.get('os', 'unknown'),
+                            info.get('architecture', 'unknown'))
+    if info.get('variant'):
+        result += '/' + info['variant']
+    return result
+
+
+class RedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Follow the redirects without leaking the credentials.
+
+    The blobs are often redirected to another host (a CDN, presigned S3
+    URLs): the 'Authorization' header is only kept on the same host.
+
+    """
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        """Return the request of the redirect (see HTTPRedirectHandler)."""
+        request = super().redirect_request(req, fp, code, msg, headers,
+                                           newurl)
+        if request is not None and \
+                urllib.parse.urlsplit(newurl).netloc.lower() != \
+                urllib.parse.urlsplit(req.full_url).netloc.lower():
+            request.remove_header('Authorization')
+        return request
+
+
+def docker_credentials(registry):
+    """Return the credentials of ~/.docker/config.json ('user:password')."""
+    path = os.path.join(os.environ.get('DOCKER_CONFIG',
+                                       os.path.expanduser('~/.docker')),
+                        'config.json')
+    try:
+        with open(path, 'r') as fhandler:
+            auths = json.load(fhandler).get('auths', {})
+    except (OSError, ValueError):
+        return None
+
+    for key in (registry, 'https://' + registry,
+                'https://index.docker.io/v1/'
+                if registry == DOCKER_HUB else None):
+        if key and auths.get(key, {}).get('auth'):
+            return base64.b64decode(auths[key]['auth']).decode('utf-8')
+    return None
+
+
+class RegistryClient(object):
+    """A minimal client of the Docker Registry HTTP API V2."""
+
+    def __init__(self, insecure_registries=None, timeout=30):
+        """Init the client.
+
+        insecure_registries: the registries reached with HTTP (the
+        registries on localhost always are)
+        timeout: the timeout of the requests (seconds)
+
+        """
+        self.insecure_registries = set(insecure_registries or [])
+        self.timeout = timeout
+        # {(registry, repository): 'Bearer token'}
+        self.tokens = {}
+        self.lock = threading.Lock()
+        self.opener = urllib.request.build_opener(RedirectHandler)
+
+    def _base_url(self, registry):
+        """Return the URL of the registry API."""
+        host = registry.rsplit(':', 1)[0]
+        insecure = registry in self.insecure_registries or \
+            host in ('localhost', '127.0.0.1', '::1')
+        return '{}://{}/v2/'.format('http' if insecure else 'https',
+                                    registry)
+
+    def _token(self, registry, repository, challenge):
+        """Get a token with the 'WWW-Authenticate' challenge of a 401."""
+        scheme, _, params = challenge.partition(' ')
+        credentials = docker_credentials(registry)
+        if scheme.lower() == 'basic':
+            if not credentials:
+                raise RegistryError('{}: authentication required'
+                                    .format(registry))
+            return 'Basic ' + base64.b64encode(
+                credentials.encode('utf-8')).decode('ascii')
+
+        values = {}
+        for item in urllib.request.parse_http_list(params):
+            key, _, value = item.partition('=')
+            values[key.strip().lower()] = value.strip().strip('"')
+
+        if not values.get('realm'):
+            raise RegistryError('{}: invalid authentication challenge: {}'
+                                .format(registry, challenge))
+
+        query = {'scope': 'repository:{}:pull'.format(repository)}
+        if values.get('service'):
+            query['service'] = values['service']
+        request = urllib.request.Request(
+            values['realm'] + '?' + urllib.parse.urlencode(query))
+        if credentials:
+            request.add_header('Authorization', 'Basic ' + base64.b64encode(
+                credentials.encode('utf-8')).decode('ascii'))
+
+        try:
+            with self.opener.open(request, timeout=self.timeout) as resp:
+                content = json.loads(resp.read().decode('utf-8'))
+        except urllib.error.HTTPError as err:
+            raise RegistryError('{}: HTTP {} {}'.format(
+                values['realm'], err.code, err.reason),
+                transient=err.code in TRANSIENT_STATUS)
+        except (urllib.error.URLError, OSError) as err:
+            raise RegistryError('{}: {}'.format(values['realm'], str(err)),
+                                transient=True)
+        except ValueError as err:
+            raise RegistryError('{}: invalid token ({})'.format(
+                values['realm'], str(err)))
+        return 'Bearer ' + (content.get('token') or
+                            content.get('access_token', ''))
+
+    def open(self, registry, repository, path, accept=None):
+        """Send a GET request to the registry (authenticated if needed).
+
+        Return: the response (a file object)
+
+        """
+        url = self._base_url(registry) + repository + '/' + path
+        for attempt in (1, 2):
+            request = urllib.request.Request(url)
+            if accept:
+                request.add_header('Accept', ', '.join(accept))
+            with self.lock:
+                token = self.tokens.get((registry, repository))
+            if token:
+                request.add_header('Authorization', token)
+
+            try:
+                return self.opener.open(request, timeout=self.timeout)
+            except urllib.error.HTTPError as err:
+                challenge = err.headers.get('WWW-Authenticate')
+                err.close()
+                if err.code != 401 or not challenge or attempt == 2:
+                    raise RegistryError('{}: HTTP {} {}'.format(
+                        url, err.code, err.reason),
+                        transient=err.code in TRANSIENT_STATUS)
+                token = self._token(registry, repository, challenge)
+                with self.lock:
+                    self.tokens[(registry, repository)] = token
+            except (urllib.error.URLError, OSError) as err:
+                raise RegistryError('{}: {}'.format(url, str(err)),
+                                    transient=True)
+
+    def get_json(self, registry, repository, path, accept=None):
+        """Return (the JSON content, the headers) of a request."""
+        with self.open(registry, repository, path, accept) as response:
+            try:
+                content = json.loads(response.read().decode('utf-8'))
+            except ValueError as err:
+                raise RegistryError('{}/{}: invalid JSON ({})'.format(
+                    repository, path, str(err)))
+            return content, response.headers
+
+    def manifest(self, registry, repository, reference):
+        """Return (the manifest or the manifest list, its digest)."""
+        manifest, headers = self.get_json(
+            registry, repository, 'manifests/' + reference,
+            accept=list(MEDIA_TYPES.values()))
+        if not isinstance(manifest, dict):
+            raise RegistryError('{}/manifests/{}: invalid manifest'
+                                .format(repository, reference))
+        if manifest.get('schemaVersion') == 1:
+            raise RegistryError('{}/manifests/{}: the manifests of schema '
+                                'version 1 are not supported'
+                                .format(repository, reference))
+        digest = headers.get('Docker-Content-Digest') or reference
+        return manifest, digest
+
+    def blob(self, registry, repository, digest):
+        """Return a blob (a file object to read and close)."""
+        return self.open(registry, repository, 'blobs/' + digest)
+
+
+def descriptor_digest(descriptor, name):
+    """Return the digest of a descriptor of a manifest ('config', ...)."""
+    digest = descriptor.get('digest') if isinstance(descriptor, dict) \
+        else None
+    if not isinstance(digest, str) or not digest:
+        raise RegistryError('invalid manifest: {} without digest'
+                            .format(name))
+    return digest
+
+
+def base_layer_scanned(path, files):
+    """Return True when the files of the base layer before 'path' are enough.
+
+    The layers built by Docker are in directory walk order: after the
+    directory '/etc', only /usr/lib/os-release is still needed, when
+    /etc/os-release is a symbolic link and no osfamily file was found.
+
+    """
+    if path.split('/', 1)[0] <= 'etc':
+        return False
+
+    if any(name in files for name, _ in OSFAMILY_FILES) or \
+            files.get('etc/os-release', ('file',))[0] != 'link':
+        return True
+    return path.split('/') > OS_RELEASE_FILES[-1].split('/')
+
+
+def scan_base_layer(client, registry, repository, layer):
+    """Read the distribution files of a layer (streamed, stopped early).
+
+    The download is stopped when the stream is past the files needed by
+    compute_facts() (see base_layer_scanned()).
+
+    """
+    digest = descriptor_digest(layer, 'layer')
+    with client.blob(registry, repository, digest) as response:
+        try:
+            return scan_layer(response, stop=base_layer_scanned)
+        except tarfile.TarError as err:
+            # e.g. a zstd layer
+            raise RegistryError('unable to read the layer {} of {}/{}. {}'
+                                .format(digest, registry, repository,
+                                        str(err)))
+
+
+def gather_registry_facts(image, client=None, target_platform=None,
+                          scan_layers=True, manifest=None):
+    """Gather the default facts of an image from its registry.
+
+    client: a RegistryClient (default: a new client)
+    target_platform: the platform of the facts ('linux/amd64', default:
+    the platform of this host)
+    scan_layers: read the osfamily from the base layer (otherwise:
+    'unknown')
+    manifest: (manifest, digest) if it was already downloaded with
+    client.manifest()
+
+    Return: (facts, digest). The facts of the configs of all platforms of
+    a multi-arch image are in facts['platforms'] {'linux/arm64': facts}.
+
+    """
+    if client is None:
+        client = RegistryClient()
+    if target_platform is None:
+        target_platform = default_platform()
+
+    registry, repository, _ = parse_reference(image)
+    if manifest is None:
+        manifest = image_manifest(image, client)
+    manifest, digest = manifest
+
+    if manifest.get('mediaType') in INDEX_TYPES or 'manifests' in manifest:
+        platforms = {}
+        selected = None
+        for item in manifest.get('manifests') or []:
+            if not isinstance(item, dict):
+                raise RegistryError('invalid manifest list of {}'
+                                    .format(image))
+            name = platform_name(item)
+            if name.startswith('unknown/'):
+                # attestations
+                continue
+
+            item_manifest, _ = client.manifest(registry, repository,
+                                               descriptor_digest(
+                                                   item, 'manifest'))
+            # the facts of the config (the layers are not read)
+            platforms[name] = platform_facts(client, registry, repository,
+                                             item_manifest,
+                                             scan_layers=False)
+            del platforms[name]['osfamily'], platforms[name]['kernelrelease']
+            if selected is None or name == target_platform or \
+                    (name.startswith(target_platform + '/') and
+                     selected[0] != target_platform):
+                selected = (name, item_manifest)
+
+        if selected is None:
+            raise RegistryError("'{}' has no image".format(image))
+
+        facts = platform_facts(client, registry, repository, selected[1],
+                               scan_layers=scan_layers)
+        facts['platforms'] = platforms
+    else:
+        facts = platform_facts(client, registry, repository, manifest,
+                               scan_layers=scan_layers)
+
+    facts['image_digest'] = digest
+    return facts, digest
+
+
+def image_manifest(image, client):
+    """Return (the manifest of an image, its digest)."""
+    registry, repository, reference = parse_reference(image)
+    LOGGER.debug("[REGISTRY FACTS] %s: manifest of %s:%s", registry,
+                 repository, reference)
+    return client.manifest(registry, repository, reference)
+
+
+def platform_facts(client, registry, repository, manifest,
+                   scan_layers=True):
+    """Return the facts of a single-platform manifest."""
+    with client.blob(registry, repository,
+                     descriptor_digest(manifest.get('config'),
+                                       'config')) as response:
+        try:
+            config = json.loads(response.read().decode('utf-8'))
+        except ValueError as err:
+            raise RegistryError('invalid image config ({})'.format(str(err)))
+    if not isinstance(config, dict):
+        raise RegistryError('invalid image config')
+
+    files = {}
+    layers = manifest.get('layers') or []
+    if scan_layers and layers:
+        files = apply_layers([scan_base_layer(client, registry, repository,
+                                              layers[0])])
+
+    image_config = config.get('config') or {}
+    facts = compute_facts(files, {'Os': config.get('os', 'linux'),
+                                  'Architecture':
+                                  config.get('architecture', 'unknown'),
+                                  'Variant': config.get('variant')})
+    facts['docker_image_user'] = (image_config.get('User') or '').strip() \
+        or 'root'
+    facts['image_env'] = dict(item.split('=', 1)
+                              for item in image_config.get('Env') or []
+                              if '=' in item)
+    facts['image_labels'] = dict(image_config.get('Labels') or {})
+    return facts
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Asher256 <asher256@gmail.com>
+# License: LGPL 2.1
+#
+# Github repo: https://github.com/Asher256/dockerfile-patch/
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Gather the facts of many images into a SQLite store (--scan).
+
+The facts of each image are written as soon as they are gathered: an
+interrupted scan continues where it stopped (the images already in the store
+are skipped, the failed images are gathered again). The facts are stored once
+per image digest:
+
+    images(image, digest, status, error, scanned)
+    facts(digest, facts)    -- compact JSON
+
+The store can be queried with sqlite3 and read by --facts-file.
+
+"""
+
+
+import sys
+import json
+import time
+import sqlite3
+import logging
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from . import DockerfilePatchError
+
+
+# The first bytes of a SQLite database
+SQLITE_MAGIC = b'SQLite format 3\0'
+
+STORE_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS facts (
+    digest TEXT PRIMARY KEY,
+    facts TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS images (
+    image TEXT PRIMARY KEY,
+    digest TEXT,
+    status TEXT NOT NULL,
+    error TEXT,
+    scanned REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_digest ON images (digest);
+CREATE INDEX IF NOT EXISTS images_status ON images (status);
+'''
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def is_fact_store(path):
+    """Return True if 'path' is a SQLite database."""
+    try:
+        with open(path, 'rb') as fhandler:
+            return fhandler.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+    except OSError:
+        return False
+
+
+class FactStore(object):
+    """The facts of the scanned images (a SQLite database).
+
+    The store is used by the thread that opened it.
+
+    """
+
+    def __init__(self, path):
+        """Open (or create) the store."""
+        self.path = path
+        try:
+            self.connection = sqlite3.connect(path)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            with self.connection:
+                self.connection.executescript(SCHEMA)
+                self.connection.execute(
+                    'INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)',
+                    ('version', str(STORE_VERSION)))
+            version = self.connection.execute(
+                "SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+        except sqlite3.Error as err:
+            raise DockerfilePatchError("unable to open the fact store '{}'. "
+                                       "{}".format(path, str(err)))
+
+        if int(version) > STORE_VERSION:
+            raise DockerfilePatchError("the fact store '{}' was written by a "
+                                       "newer version (store version: {})"
+                                       .format(path, version))
+
+    def scanned(self):
+        """Return the images whose facts are in the store (a set)."""
+        return set(row[0] for row in self.connection.execute(
+            "SELECT image FROM images WHERE status = 'ok'"))
+
+    def add(self, image, digest, facts):
+        """Store the facts of an image."""
+        content = json.dumps(facts, sort_keys=True, separators=(',', ':'))
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO facts (digest, facts) VALUES (?, ?)',
+                (digest, content))
+            self.connection.execute(
+                'INSERT OR REPLACE INTO images (image, digest, status, '
+                "error, scanned) VALUES (?, ?, 'ok', NULL, ?)",
+                (image, digest, time.time()))
+
+    def add_failure(self, image, error):
+        """Record an image whose facts couldn't be gathered."""
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO images (image, digest, status, '
+                "error, scanned) VALUES (?, NULL, 'failed', ?, ?)",
+                (image, error, time.time()))
+
+    def facts(self):
+        """Return the facts of the scanned images {'image': facts}."""
+        return OrderedDict(
+            (image, json.loads(content))
+            for image, content in self.connection.execute(
+                'SELECT images.image, facts.facts FROM images '
+                'JOIN facts ON facts.digest = images.digest '
+                "WHERE images.status = 'ok' ORDER BY images.image"))
+
+    def summary(self):
+        """Return the number of images of each status {'status': count}."""
+        return dict(self.connection.execute(
+            'SELECT status, COUNT(*) FROM images GROUP BY status'))
+
+    def close(self):
+        """Close the store."""
+        self.connection.close()
+
+    def __enter__(self):
+        """Return the store."""
+        return self
+
+    def __exit__(self, *args):
+        """Close the store."""
+        self.close()
+
+
+def read_image_list(path):
+    """Return the images of a list (one per line, '-' = stdin).
+
+    The empty lines and the lines starting with '#' are ignored.
+
+    """
+    try:
+        if path == '-':
+            lines = sys.stdin.read().splitlines()
+        else:
+            with open(path, 'r') as fhandler:
+                lines = fhandler.read().splitlines()
+    except OSError as err:
+        raise DockerfilePatchError("unable to read the image list '{}'. {}"
+                                   .format(path, str(err)))
+
+    return list(OrderedDict.fromkeys(
+        line.strip() for line in lines
+        if line.strip() and not line.strip().startswith('#')))
+
+
+def scan_images(images, docker_facter, store, jobs=16):
+    """Gather the facts of the images into a FactStore.
+
+    images: list of image names
+    docker_facter: the DockerFact that gathers the facts (all its fact
+    scripts run)
+    store: a FactStore (the images already in the store are skipped)
+    jobs: the number of images gathered at the same time
+
+    The failures are recorded in the store (the scan goes on).
+
+    Return: {'ok': count, 'failed': count, 'skipped': count}
+
+    """
+    done = store.scanned()
+    pending = [image for image in images if image not in done]
+    result = {'ok': 0, 'failed': 0, 'skipped': len(images) - len(pending)}
+    if result['skipped']:
+        sys.stderr.write('[SCAN] {} images already in the store\n'
+                         .format(result['skipped']))
+
+    def gather(image):
+        """Return (the image id, the facts) of an image."""
+        facts = docker_facter.gather_facts(image)
+        return docker_facter.image_ids[image], facts
+
+    total = len(pending)
+    images_iter = iter(pending)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        while True:
+            # a bounded number of submitted images (fast interruption)
+            while len(running) < max(1, jobs) * 2:
+                image = next(images_iter, None)
+                if image is None:
+                    break
+                running[executor.submit(gather, image)] = image
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                image = running.pop(future)
+                try:
+                    image_id, facts = future.result()
+                except Exception as err:  # pylint: disable=broad-except
+                    store.add_failure(image, str(err))
+                    result['failed'] += 1
+                    status = 'FAILED'
+                    LOGGER.debug('[SCAN] %s: %s', image, str(err))
+                else:
+                    store.add(image, image_id, facts)
+                    result['ok'] += 1
+                    status = 'OK'
+
+                sys.stderr.write('[SCAN] {}/{} {} {}\n'.format(
+                    result['ok'] + result['failed'], total, status, image))
+                sys.stderr.flush()
+
+    return result
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Asher256 <asher256@gmail.com>
+# License: LGPL 2.1
+#
+# Github repo: https://github.com/Asher256/dockerfile-patch/
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""A long-running dockerfile-patch server (HTTP over TCP or a Unix socket).
+
+The server keeps the Docker client, the compiled Jinja2 patches and the
+gathered facts in memory. Endpoints:
+
+- POST /patch: {"dockerfile": "FROM ...", "patches": ["name.j2", ...]}
+  returns the patched Dockerfile ("patches" is optional, default: all).
+- GET /health: the server statistics (JSON).
+
+"""
+
+
+import os
+import json
+import stat
+import time
+import logging
+import threading
+import socketserver
+from collections import OrderedDict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from . import (DockerFact, DockerfilePatcher, DockerfilePatchError,
+               load_jinja_patches, referenced_facts, render_patch,
+               template_environment)
+
+
+# The maximum size of a request body
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+
+
+class PatchService(object):
+    """Patch Dockerfiles with a warm Docker client and warm caches."""
+
+    def __init__(self, jinja2_patches_paths, fact_scripts_paths,
+                 fact_cache=None, jobs=1, fact_engine='container',
+                 pull_policy='always', template_env=None,
+                 docker_facter=None, all_facts=False):
+        """Init the service.
+
+        The patches that can be requested are the Jinja2 templates of
+        'jinja2_patches_paths' (requested by file name). The other
+        parameters are the same as dockerfile_patch() ('docker_facter' can
+        be a FactsFile). The facts gathered are the ones used by all the
+        patches, analyzed at startup.
+
+        """
+        self.logging = logging.getLogger(__name__ + '.' +
+                                         self.__class__.__name__)
+        self.jobs = jobs
+        self.template_env = template_env or template_environment()
+
+        # {'file name': 'path'}
+        self.patches_paths = OrderedDict()
+        for path in jinja2_patches_paths:
+            self.patches_paths[os.path.basename(path)] = path
+        # the included templates are searched in the directories of all the
+        # patches of the service (whatever the requested patches)
+        self.searchpath = list(OrderedDict.fromkeys(
+            os.path.dirname(os.path.abspath(path))
+            for path in jinja2_patches_paths))
+        # compile the templates now (errors are reported at startup)
+        jinja_patches_content = load_jinja_patches(
+            jinja2_patches_paths, template_env=self.template_env,
+            searchpath=self.searchpath)
+        self.required_facts = None if all_facts \
+            else referenced_facts(jinja_patches_content)
+
+        if docker_facter is None:
+            docker_facter = DockerFact(fact_cache=fact_cache,
+                                       fact_engine=fact_engine,
+                                       pull_policy=pull_policy)
+        self.docker_facter = docker_facter
+        for item in fact_scripts_paths:
+            self.docker_facter.add_fact_script(path=item)
+
+        # the facts of each image name {'image': facts}
+        self.facts = {}
+
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stats = {'requests': 0,
+                      'errors': 0,
+                      'in_flight': 0,
+                      'facts_hits': 0,
+                      'facts_misses': 0}
+
+    def _count(self, name, value=1):
+        """Increment a statistic."""
+        with self.lock:
+            self.stats[name] += value
+
+    def get_stats(self):
+        """Return the statistics of the service."""
+        with self.lock:
+            result = dict(self.stats)
+            result['images'] = len(self.facts)
+
+        lookups = result['facts_hits'] + result['facts_misses']
+        result['facts_hit_rate'] = \
+            float(result['facts_hits']) / lookups if lookups else 0.0
+        result['uptime'] = time.time() - self.started
+        result['status'] = 'ok'
+        return result
+
+    def get_facts(self, image_names):
+        """Return the facts of the images {'image': facts} (memorized)."""
+        with self.lock:
+            missing = [image for image in OrderedDict.fromkeys(image_names)
+                       if image not in self.facts]
+
+        self._count('facts_hits', len(set(image_names)) - len(missing))
+        self._count('facts_misses', len(missing))
+        if missing:
+            facts = self.docker_facter.gather_facts_many(
+                missing, jobs=self.jobs, required_facts=self.required_facts)
+            with self.lock:
+                self.facts.update(facts)
+
+        with self.lock:
+            return OrderedDict((image, self.facts[image])
+                               for image in image_names)
+
+    def patch(self, dockerfile_content, patches=None):
+        """Return the patched version of 'dockerfile_content'.
+
+        patches: list of the file names of the patches (default: all)
+
+        """
+        if patches is None:
+            patches = list(self.patches_paths)
+
+        self._count('requests')
+        self._count('in_flight')
+        try:
+            unknown = [name for name in patches
+                       if name not in self.patches_paths]
+            if unknown:
+                raise DockerfilePatchError("unknown patches: {}"
+                                           .format(', '.join(unknown)))
+
+            dockerfile = DockerfilePatcher()
+            dockerfile.loads(dockerfile_content)
+
+            jinja_patches_content = load_jinja_patches(
+                [self.patches_paths[name] for name in patches],
+                template_env=self.template_env, searchpath=self.searchpath)
+
+            image_names = dockerfile.get_base_images()
+            for image_name, image_facts in \
+                    self.get_facts(image_names).items():
+                dockerfile.add_patch(image_name,
+                                     render_patch(jinja_patches_content,
+                                                  image_facts))
+
+            return dockerfile.to_str()
+        except Exception:
+            self._count('errors')
+            raise
+        finally:
+            self._count('in_flight', -1)
+
+    def close(self):
+        """Delete the containers that are still running."""
+        self.docker_facter.cleanup()
+
+
+class PatchRequestHandler(BaseHTTPRequestHandler):
+    """Handle the HTTP requests of the PatchServer."""
+
+    def address_string(self):
+        """Return the client address (empty with Unix sockets)."""
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        """Log the requests with the logging module."""
+        self.server.service.logging.debug('[SERVER] %s - %s',
+                                          self.address_string(),
+                                          format % args)
+
+    def _send(self, code, content, content_type='application/json'):
+        """Send a response."""
+        if not isinstance(content, str):
+            content = json.dumps(content, indent=2, sort_keys=True) + '\n'
+        data = content.encode('utf-8')
+
+        self.send_response(code)
+        self.send_header('Content-Type', content_type + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """GET /health."""
+        if self.path.rstrip('/') in ('/health', '/stats'):
+            self._send(200, self.server.service.get_stats())
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """POST /patch."""
+        if self.path.rstrip('/') != '/patch':
+            self._send(404, {'error': 'not found'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length < 0:
+                raise ValueError('invalid Content-Length')
+            if length > MAX_REQUEST_SIZE:
+                raise ValueError('the request is too large')
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            if not isinstance(request, dict):
+                raise TypeError('a JSON object is expected')
+            dockerfile_content = request['dockerfile']
+            patches = request.get('patches')
+            if not isinstance(dockerfile_content, str):
+                raise TypeError("'dockerfile' must be a string")
+            if patches is not None and \
+                    (not isinstance(patches, list) or
+                     not all(isinstance(name, str) for name in patches)):
+                raise TypeError("'patches' must be a list of strings")
+        except (ValueError, KeyError, TypeError) as err:
+            self._send(400, {'error': 'invalid request: {}'.format(err)})
+            return
+
+        try:
+            result = self.server.service.patch(dockerfile_content, patches)
+        except DockerfilePatchError as err:
+            self._send(422, {'error': str(err)})
+        except Exception as err:  # pylint: disable=broad-except
+            self.server.service.logging.exception('[SERVER] Request failed')
+            self._send(500, {'error': str(err)})
+        else:
+            self._send(200, result, content_type='text/plain')
+
+
+class PatchServer(socketserver.ThreadingMixIn, HTTPServer):
+    """A threaded HTTP server (TCP)."""
+
+    daemon_threads = False
+    block_on_close = True
+
+    def __init__(self, address, service):
+        """Init the server."""
+        self.service = service
+        HTTPServer.__init__(self, address, PatchRequestHandler)
+
+
+class UnixPatchServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+    """A threaded HTTP server (Unix socket)."""
+
+    daemon_threads = False
+    block_on_close = True
+
+    def __init__(self, path, service):
+        """Init the server (a stale socket file is replaced)."""
+        self.service = service
+        try:
+            mode = os.lstat(path).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise DockerfilePatchError("'{}' exists and is not a Unix "
+                                           "socket".format(path))
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path,
+                                               PatchRequestHandler)
+
+    def server_close(self):
+        """Close the server and delete the socket file."""
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+def create_server(address, service):
+    """Create a server listening to 'address'.
+
+    address: 'unix:/path/to/socket' or 'host:port'
+
+    """
+    if address.startswith('unix:'):
+        return UnixPatchServer(address[len('unix:'):], service)
+
+    host, _, port = address.rpartition(':')
+    try:
+        return PatchServer((host or '127.0.0.1', int(port)), service)
+    except ValueError:
+        raise DockerfilePatchError("invalid server address: '{}'"
+                                   .format(address))
+
+
+def serve(server):
+    """Serve the requests until shutdown() is called (e.g. by a signal)."""
+    service = server.service
+    service.logging.info('[SERVER] Listening on %s',
+                         str(server.server_address))
+    try:
+        server.serve_forever()
+    finally:
+        # wait for the requests in flight, then clean up
+        server.server_close()
+        service.close()
+        service.logging.info('[SERVER] Stopped')
+
+
+def request_shutdown(server):
+    """Stop a server from a signal handler (without blocking)."""
+    threading.Thread(target=server.shutdown).start()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Asher256 <asher256@gmail.com>
+# License: LGPL 2.1
+#
+# Github repo: https://github.com/Asher256/dockerfile-patch/
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Gather the default facts of a Docker image without running a container.
+
+The files needed by 'default-facts.sh' are read straight out of the image
+layers ('docker save' stream) and the other facts come from the image config.
+
+"""
+
+
+import io
+import json
+import logging
+import posixpath
+import tarfile
+
+
+# The files read from the image filesystem (without the leading '/')
+OSFAMILY_FILES = (('etc/alpine-release', 'Alpine'),
+                  ('etc/debian_version', 'Debian'),
+                  ('etc/redhat-release', 'RedHat'),
+                  ('etc/SuSE-release', 'SuSE'),
+                  ('etc/arch-release', 'Archlinux'))
+OS_RELEASE_FILES = ('etc/os-release', 'usr/lib/os-release')
+TARGET_FILES = tuple(path for path, _ in OSFAMILY_FILES) + OS_RELEASE_FILES
+
+# /etc/os-release ID (or ID_LIKE) => osfamily
+OS_RELEASE_FAMILIES = {'alpine': 'Alpine',
+                       'debian': 'Debian',
+                       'ubuntu': 'Debian',
+                       'rhel': 'RedHat',
+                       'centos': 'RedHat',
+                       'fedora': 'RedHat',
+                       'suse': 'SuSE',
+                       'opensuse': 'SuSE',
+                       'sles': 'SuSE',
+                       'arch': 'Archlinux'}
+
+# Docker architecture (and variant) => 'uname -m'
+UNAME_MACHINES = {'amd64': 'x86_64',
+                  '386': 'i686',
+                  'arm64': 'aarch64',
+                  'arm/v5': 'armv5l',
+                  'arm/v6': 'armv6l',
+                  'arm/v7': 'armv7l',
+                  'arm': 'armv7l',
+                  'ppc64le': 'ppc64le',
+                  'ppc64': 'ppc64',
+                  's390x': 's390x',
+                  'mips64le': 'mips64',
+                  'riscv64': 'riscv64'}
+
+# Layers bigger than this are streamed, the others are read in memory
+SMALL_MEMBER_SIZE = 1024 * 1024
+
+WHITEOUT_PREFIX = '.wh.'
+WHITEOUT_OPAQUE = '.wh..wh..opq'
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ChunksReader(io.RawIOBase):
+    """A file object that reads an iterator of bytes (HTTP stream)."""
+
+    def __init__(self, chunks):
+        """Init the reader."""
+        super().__init__()
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def readable(self):
+        """The stream is readable."""
+        return True
+
+    def readinto(self, buf):
+        """Read the next bytes of the stream into 'buf'."""
+        while not self.buffer:
+            try:
+                self.buffer = next(self.chunks)
+            except StopIteration:
+                return 0
+
+        size = min(len(buf), len(self.buffer))
+        buf[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+
+def normalize_path(path):
+    """Return a tar member path without './' and '/' prefixes."""
+    return posixpath.normpath('/' + path).lstrip('/')
+
+
+def scan_layer(fileobj, targets=TARGET_FILES, stop=None):
+    """Read the target files of a layer (tar stream).
+
+    stop: stop(path, files) returns True to stop reading before 'path'
+    (for the sorted layers, the rest of the stream is not downloaded)
+
+    Return: {'files': {path: ('file', content) or ('link', target)},
+             'whiteouts': [path, ...], 'opaque': [directory, ...]}
+
+    """
+    result = {'files': {}, 'whiteouts': [], 'opaque': []}
+    with tarfile.open(fileobj=fileobj, mode='r|*') as layer:
+        for member in layer:
+            path = normalize_path(member.name)
+            if stop is not None and stop(path, result['files']):
+                break
+            dirname, basename = posixpath.split(path)
+
+            if basename == WHITEOUT_OPAQUE:
+                result['opaque'].append(dirname)
+            elif basename.startswith(WHITEOUT_PREFIX):
+                result['whiteouts'].append(
+                    posixpath.join(dirname,
+                                   basename[len(WHITEOUT_PREFIX):]))
+            elif path not in targets:
+                continue
+            elif member.issym():
+                result['files'][path] = ('link', member.linkname)
+            elif member.isfile():
+                result['files'][path] = ('file',
+                                         layer.extractfile(member).read())
+
+    return result
+
+
+def apply_layers(layers):
+    """Merge the scanned layers (the first one is the lowest)."""
+    files = {}
+    for layer in layers:
+        for directory in layer['opaque']:
+            for path in list(files):
+                if path.startswith(directory + '/'):
+                    del files[path]
+
+        for path in layer['whiteouts']:
+            for item in list(files):
+                if item == path or item.startswith(path + '/'):
+                    del files[item]
+
+        files.update(layer['files'])
+
+    return files
+
+
+def resolve_file(files, path, depth=8):
+    """Return the content of 'path' (symbolic links are followed)."""
+    while depth:
+        depth -= 1
+        item = files.get(path)
+        if item is None:
+            return None
+
+        kind, value = item
+        if kind == 'file':
+            return value
+
+        if value.startswith('/'):
+            path = normalize_path(value)
+        else:
+            path = normalize_path(posixpath.join(posixpath.dirname(path),
+                                                 value))
+
+    return None
+
+
+def read_image_files(chunks, targets=TARGET_FILES):
+    """Read the target files from a 'docker save' tar stream.
+
+    chunks: an iterator of bytes (e.g. docker_client.api.get_image(image))
+
+    The stream is read once: the layers are scanned when they arrive and
+    the manifest (that gives the order of the layers) is applied at the end.
+
+    Return: {path: ('file', content) or ('link', target)}
+
+    """
+    scanned = {}
+    manifest = None
+    with tarfile.open(fileobj=io.BufferedReader(ChunksReader(chunks)),
+                      mode='r|') as image_tar:
+        for member in image_tar:
+            if not member.isfile():
+                continue
+
+            name = normalize_path(member.name)
+            fileobj = image_tar.extractfile(member)
+            if member.size <= SMALL_MEMBER_SIZE:
+                content = fileobj.read()
+                if name == 'manifest.json':
+                    manifest = json.loads(content.decode('utf-8'))
+                    continue
+
+                fileobj = io.BytesIO(content)
+
+            try:
+                scanned[name] = scan_layer(fileobj, targets)
+            except tarfile.TarError:
+                # not a layer (image config, index.json, ...)
+                continue
+
+    if not manifest:
+        raise ValueError("'manifest.json' wasn't found in the image")
+
+    try:
+        layer_names = manifest[0]['Layers']
+    except (IndexError, KeyError, TypeError):
+        raise ValueError("invalid 'manifest.json' in the image")
+
+    layers = [scanned.get(normalize_path(name),
+                          {'files': {}, 'whiteouts': [], 'opaque': []})
+              for name in layer_names]
+    return apply_layers(layers)
+
+
+def parse_os_release(content):
+    """Parse the content of /etc/os-release into a dict."""
+    result = {}
+    for line in content.decode('utf-8', 'replace').splitlines():
+        line = line.strip()
+        if not line or line.startswith('#') or '=' not in line:
+            continue
+
+        key, value = line.split('=', 1)
+        value = value.strip()
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'':
+            value = value[1:-1]
+        result[key.strip()] = value
+
+    return result
+
+
+def uname_machine(architecture, variant=None):
+    """Convert a Docker architecture into the output of 'uname -m'."""
+    if variant and architecture + '/' + variant in UNAME_MACHINES:
+        return UNAME_MACHINES[architecture + '/' + variant]
+
+    return UNAME_MACHINES.get(architecture, architecture)
+
+
+def compute_facts(files, inspect_image, kernelrelease='unknown'):
+    """Compute the facts of 'default-facts.sh'.
+
+    files: the files read by read_image_files()
+    inspect_image: the output of docker inspect
+    kernelrelease: the kernel of the Docker daemon ('uname -r' in a
+    container)
+
+    """
+    image_os = inspect_image.get('Os', 'linux')
+    operatingsystem = {'linux': 'Linux',
+                       'windows': 'Windows'}.get(image_os, image_os)
+
+    osfamily = 'unknown'
+    if operatingsystem == 'Linux':
+        for path, family in OSFAMILY_FILES:
+            if resolve_file(files, path) is not None:
+                osfamily = family
+                break
+        else:
+            # distributions without the historical files (e.g. openSUSE)
+            for path in OS_RELEASE_FILES:
+                content = resolve_file(files, path)
+                if content is None:
+                    continue
+
+                os_release = parse_os_release(content)
+                for item in ([os_release.get('ID', '')] +
+                             os_release.get('ID_LIKE', '').split()):
+                    if item in OS_RELEASE_FAMILIES:
+                        osfamily = OS_RELEASE_FAMILIES[item]
+                        break
+                break
+
+    return {'osfamily': osfamily,
+            'operatingsystem': operatingsystem,
+            'kernelrelease': kernelrelease,
+            'architecture': uname_machine(inspect_image.get('Architecture',
+                                                            'unknown'),
+                                          inspect_image.get('Variant'))}
+
+
+def gather_static_facts(docker_client, image, inspect_image):
+    """Gather the facts of 'default-facts.sh' without running a container.
+
+    The image needs to be present in the Docker daemon (pulled).
+
+    """
+    from . import DockerfilePatchError
+
+    LOGGER.debug("[STATIC FACTS] docker save '%s' (streamed)", image)
+    try:
+        files = read_image_files(docker_client.api.get_image(image))
+    except (tarfile.TarError, ValueError) as err:
+        raise DockerfilePatchError("unable to read the files of the image "
+                                   "'{}'. {}".format(image, str(err)))
+    LOGGER.debug("[STATIC FACTS] Files found in '%s': %s", image,
+                 str(sorted(files)))
+
+    try:
+        kernelrelease = docker_client.version().get('KernelVersion',
+                                                    'unknown')
+    except Exception:  # pylint: disable=broad-except
+        kernelrelease = 'unknown'
+
+    return compute_facts(files, inspect_image, kernelrelease)
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
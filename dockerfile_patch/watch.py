@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Asher256 <asher256@gmail.com>
+# License: LGPL 2.1
+#
+# Github repo: https://github.com/Asher256/dockerfile-patch/
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Patch a Dockerfile again each time one of its inputs is modified.
+
+The Dockerfile, the Jinja2 patches (and the templates they include) and the
+fact scripts are watched with inotify (if the optional module inotify_simple
+is installed) or by polling. The facts and the rendered patches are kept in
+memory:
+- a modified patch is rendered again (for each image)
+- the facts are gathered again when the FROM lines, the fact scripts or the
+  facts used by the patches change
+
+"""
+
+
+import os
+import sys
+import time
+import logging
+from collections import OrderedDict
+
+from . import (DockerfilePatchError, file_digest, join_patch,
+               load_dockerfile, load_jinja_patches, referenced_facts,
+               render_template, template_environment)
+
+
+# The interval between two checks of the files (polling)
+POLL_INTERVAL = 0.1
+
+# The modifications that happen during this delay are grouped (seconds)
+SETTLE_DELAY = 0.01
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def file_state(path):
+    """Return the state of a file (None if it doesn't exist)."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+class PollingWatcher(object):
+    """Detect the modified files by polling their state."""
+
+    def __init__(self, interval=POLL_INTERVAL):
+        """Init the watcher (interval: seconds between two checks)."""
+        self.interval = interval
+        # {'path': state}
+        self.states = {}
+
+    def set_paths(self, paths):
+        """Set the watched files (absolute paths)."""
+        self.states = {path: self.states[path] if path in self.states
+                       else file_state(path)
+                       for path in paths}
+
+    def read(self, timeout=None):
+        """Wait for modifications and return the modified paths (a set).
+
+        timeout: seconds (None = wait until a file is modified). An empty
+        set is returned after the timeout.
+
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            changed = self._poll()
+            if changed:
+                time.sleep(SETTLE_DELAY)
+                return changed | self._poll()
+            if deadline is not None and time.time() >= deadline:
+                return changed
+            time.sleep(self.interval)
+
+    def _poll(self):
+        """Return the paths modified since the previous check."""
+        changed = set()
+        for path, state in self.states.items():
+            current = file_state(path)
+            if current != state:
+                self.states[path] = current
+                changed.add(path)
+        return changed
+
+    def close(self):
+        """Stop watching."""
+
+
+class InotifyWatcher(object):
+    """Detect the modified files with inotify (requires inotify_simple).
+
+    The directories of the files are watched: the editors that save a file
+    by renaming a new file are supported.
+
+    """
+
+    def __init__(self):
+        """Init the watcher (raise ImportError without inotify_simple)."""
+        from inotify_simple import INotify, flags
+
+        self.inotify = INotify()
+        self.mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | \
+            flags.CREATE | flags.DELETE
+        self.paths = set()
+        # {watch descriptor: 'directory'}
+        self.directories = {}
+
+    def set_paths(self, paths):
+        """Set the watched files (absolute paths)."""
+        self.paths = set(paths)
+        watched = set(self.directories.values())
+        for directory in set(os.path.dirname(path) for path in self.paths):
+            if directory not in watched and os.path.isdir(directory):
+                descriptor = self.inotify.add_watch(directory, self.mask)
+                self.directories[descriptor] = directory
+
+    def read(self, timeout=None):
+        """Wait for modifications and return the modified paths (a set).
+
+        timeout: seconds (None = wait until a file is modified). An empty
+        set is returned after the timeout.
+
+        """
+        events = self.inotify.read(
+            timeout=None if timeout is None else int(timeout * 1000),
+            read_delay=int(SETTLE_DELAY * 1000))
+        changed = set()
+        for event in events:
+            directory = self.directories.get(event.wd)
+            if directory is None or not event.name:
+                continue
+            path = os.path.join(directory, event.name)
+            if path in self.paths:
+                changed.add(path)
+        return changed
+
+    def close(self):
+        """Stop watching."""
+        self.inotify.close()
+
+
+def file_watcher():
+    """Return an InotifyWatcher, or a PollingWatcher without inotify."""
+    try:
+        return InotifyWatcher()
+    except (ImportError, OSError) as err:
+        LOGGER.debug('[WATCH] inotify unavailable (%s): polling every '
+                     '%.1fs', str(err), POLL_INTERVAL)
+        return PollingWatcher()
+
+
+def template_files(item):
+    """Return the files of a patch (the patch and the templates it includes).
+
+    item: an item returned by load_jinja_patches()
+
+    The included templates that can't be found are returned in each
+    directory where they are searched, starting with the directory of the
+    including template (their creation is detected).
+
+    """
+    from jinja2 import TemplateError, TemplateNotFound
+    from jinja2.meta import find_referenced_templates
+
+    template_env = item['template'].environment
+    result = set([os.path.abspath(item['path'])])
+    seen = set()
+    pending = [(item['content'], item['template'].name)]
+    while pending:
+        source, name = pending.pop()
+        try:
+            references = find_referenced_templates(template_env.parse(source))
+        except TemplateError:
+            continue
+
+        for reference in references:
+            # None: a dynamic name ({% include variable %})
+            if reference is None:
+                continue
+            resolved = template_env.join_path(reference, name)
+            if resolved in seen:
+                continue
+            seen.add(resolved)
+            try:
+                source, filename, _ = template_env.loader.get_source(
+                    template_env, resolved)
+            except TemplateNotFound:
+                directories = getattr(template_env.loader, 'searchpath', [])
+                if os.path.isabs(name):
+                    directories = [os.path.dirname(name)] + directories
+                result.update(os.path.join(directory, reference)
+                              for directory in directories)
+                continue
+            except (OSError, TemplateError):
+                continue
+            result.add(os.path.abspath(filename))
+            pending.append((source, filename))
+
+    return result
+
+
+class PatchWatcher(object):
+    """Keep a patched Dockerfile up to date with its inputs."""
+
+    def __init__(self, dockerfile_dir, output_path, jinja2_patches_paths,
+                 fact_scripts_paths, docker_facter, template_env=None,
+                 jobs=1, build_args=None, instrumentation=None,
+                 all_facts=False):
+        """Init the watcher.
+
+        output_path: the path of the patched Dockerfile. The other
+        parameters are the same as load_patched_dockerfile()
+        ('docker_facter' is required and can be a FactsFile).
+
+        """
+        self.dockerfile_dir = dockerfile_dir
+        self.dockerfile_path = os.path.abspath(
+            os.path.join(dockerfile_dir, 'Dockerfile')
+            if os.path.isdir(dockerfile_dir) else dockerfile_dir)
+        self.output_path = output_path
+        self.patches_paths = [os.path.abspath(path)
+                              for path in jinja2_patches_paths]
+        self.fact_scripts_paths = [os.path.abspath(path)
+                                   for path in fact_scripts_paths]
+        self.docker_facter = docker_facter
+        self.template_env = template_env or template_environment()
+        self.jobs = jobs
+        self.build_args = build_args
+        self.all_facts = all_facts
+        if instrumentation is None:
+            instrumentation = docker_facter.instrumentation
+        self.instrumentation = instrumentation
+
+        self.dockerfile = None
+        # the facts of the images {'image': facts}
+        self.facts = {}
+        # the facts used by the patches (see referenced_facts())
+        self.required_facts = None
+        # the digests of the fact scripts {'path': digest}
+        self.scripts = {}
+        # the loaded patches (items of load_jinja_patches())
+        self.patches = [None] * len(self.patches_paths)
+        # the directories where the patches search the included templates
+        self.searchpath = list(OrderedDict.fromkeys(
+            os.path.dirname(path) for path in self.patches_paths))
+        # the files of each patch (the patch and its included templates)
+        self.patch_files = [set([path]) for path in self.patches_paths]
+        # the rendered patches {('image', index of the patch): text}
+        self.rendered = {}
+        # everything is loaded again after an error
+        self.failed = True
+
+    def paths(self):
+        """Return the watched files."""
+        result = set([self.dockerfile_path])
+        result.update(self.fact_scripts_paths)
+        for files in self.patch_files:
+            result.update(files)
+        return result
+
+    def _load_fact_scripts(self):
+        """Load the fact scripts.
+
+        Return: True if a script was modified since the previous call.
+
+        """
+        modified = False
+        for path in self.fact_scripts_paths:
+            self.docker_facter.add_fact_script(path)
+            digest = file_digest(path)
+            if path in self.scripts and self.scripts[path] != digest:
+                modified = True
+            self.scripts[path] = digest
+        return modified
+
+    def update(self, changed=None):
+        """Patch the Dockerfile again after the modification of files.
+
+        changed: the modified files (None = everything)
+
+        Return: True if the patched Dockerfile was written (False if its
+        content didn't change).
+
+        """
+        timer = self.instrumentation.timer
+        full = changed is None or self.failed
+        changed = set(changed or ())
+        self.failed = True
+
+        stale_images = set()
+        stale_patches = set()
+
+        # The fact scripts: the facts of all images are gathered again
+        if full or changed.intersection(self.fact_scripts_paths):
+            if self._load_fact_scripts():
+                LOGGER.debug('[WATCH] Fact scripts modified')
+                self.facts.clear()
+
+        # The Dockerfile: only the facts of the new images are gathered
+        if full or self.dockerfile_path in changed:
+            with timer('load_dockerfile'):
+                self.dockerfile = load_dockerfile(self.dockerfile_dir,
+                                                  self.build_args)
+
+        # The patches (and the patches including a modified template)
+        modified_patches = [index
+                            for index, files in enumerate(self.patch_files)
+                            if full or files & changed]
+        if modified_patches:
+            # the templates are reloaded even when their mtime didn't change
+            # (several writes in the same clock tick)
+            self.template_env.clear_cache()
+        for index in modified_patches:
+            with timer('load_patches'):
+                self.patches[index] = load_jinja_patches(
+                    [self.patches_paths[index]],
+                    template_env=self.template_env,
+                    searchpath=self.searchpath)[0]
+            self.patch_files[index] = template_files(self.patches[index])
+            stale_patches.add(index)
+
+        if modified_patches and not self.all_facts:
+            required_facts = referenced_facts(self.patches)
+            if required_facts != self.required_facts:
+                LOGGER.debug('[WATCH] Facts used by the patches: %s',
+                             'all' if required_facts is None
+                             else str(sorted(required_facts)))
+                self.required_facts = required_facts
+                self.facts.clear()
+
+        images = self.dockerfile.get_base_images()
+        missing = [image for image in images if image not in self.facts]
+        if missing:
+            LOGGER.debug('[WATCH] Gathering facts from the images: %s',
+                         str(missing))
+            with timer('gather_facts'):
+                self.facts.update(self.docker_facter.gather_facts_many(
+                    missing, jobs=self.jobs,
+                    required_facts=self.required_facts))
+            stale_images.update(missing)
+
+        # Render the stale patches only
+        rendered = {}
+        self.dockerfile.patches.clear()
+        for image in images:
+            facts = self.facts[image]
+            for index, item in enumerate(self.patches):
+                key = (image, index)
+                if key in self.rendered and image not in stale_images and \
+                        index not in stale_patches:
+                    rendered[key] = self.rendered[key]
+                    continue
+
+                with timer('render', image):
+                    rendered[key] = render_template(item, facts)
+
+            self.dockerfile.add_patch(
+                image, join_patch([rendered[(image, index)]
+                                   for index in range(len(self.patches))],
+                                  facts))
+        self.rendered = rendered
+
+        with timer('write'):
+            written = self.dockerfile.save_if_changed(self.output_path)
+        self.failed = False
+        return written
+
+    def watch(self, watcher=None):
+        """Patch the Dockerfile, then patch it again after each modification.
+
+        The errors (e.g. a template being edited) are printed and the files
+        are watched again. Run until interrupted.
+
+        watcher: an InotifyWatcher or a PollingWatcher (default:
+        file_watcher())
+
+        """
+        from jinja2 import TemplateError
+
+        if watcher is None:
+            watcher = file_watcher()
+
+        sys.stderr.write('[WATCH] {} => {} ({})\n'.format(
+            self.dockerfile_path, self.output_path,
+            'inotify' if isinstance(watcher, InotifyWatcher) else 'polling'))
+        changed = None
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    written = self.update(changed)
+                except (DockerfilePatchError, TemplateError, OSError) as err:
+                    sys.stderr.write('[ERROR] {}\n'.format(str(err)))
+                else:
+                    sys.stderr.write('[{}] Patched Dockerfile: {} ({:.1f} ms)'
+                                     '\n'.format('SUCCESS' if written
+                                                 else 'UNCHANGED',
+                                                 self.output_path,
+                                                 (time.perf_counter() -
+                                                  start) * 1000))
+                sys.stderr.flush()
+
+                watcher.set_paths(self.paths())
+                changed = set()
+                while not changed:
+                    changed = watcher.read()
+                LOGGER.debug('[WATCH] Modified: %s', str(sorted(changed)))
+        finally:
+            watcher.close()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
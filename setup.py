@@ -91,7 +91,7 @@ setup(
     # your project is installed. For an analysis of "install_requires" vs pip's
     # requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
-    install_requires=['dockerfile-parse>=0.0.7', 'PyYAML', 'Jinja2', 'docker'],
+    install_requires=['PyYAML', 'Jinja2', 'docker'],
 
     # List additional groups of dependencies here (e.g. development
     # dependencies). You can install these using the following syntax,
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Asher256 <asher256@gmail.com>
+# License: LGPL 2.1
+#
+# Github repo: https://github.com/Asher256/dockerfile-patch/
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Tests of the Dockerfile parser (dockerfile_patch.instructions)."""
+
+
+import os
+
+import pytest
+
+from dockerfile_patch.instructions import BLANK, COMMENT, parse_dockerfile
+
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def instructions(content):
+    """Return the (instruction, value) of the records of a Dockerfile."""
+    records, _ = parse_dockerfile(content)
+    return [(record.instruction, record.value) for record in records
+            if record.instruction not in (BLANK, COMMENT)]
+
+
+def check_round_trip(content):
+    """Check that the records give back the original Dockerfile."""
+    records, _ = parse_dockerfile(content)
+    assert ''.join(record.content for record in records) == content
+    # every line belongs to exactly one record
+    line = 0
+    for record in records:
+        assert record.startline == line
+        line = record.endline + 1
+    assert line == len(content.splitlines(True))
+
+
+DOCKERFILES = [
+    '',
+    'FROM alpine:3\n',
+    'FROM alpine:3',
+    'FROM alpine:3\r\nRUN echo a && \\\r\n    echo b\r\n\r\n',
+    '# escape=`\nFROM alpine:3\nRUN echo a `\n    echo b\n',
+    'FROM alpine:3\nRUN <<EOF\necho a\n\necho b\nEOF\n',
+    'FROM alpine:3\nRUN a \\\n# comment\n\n    b\n',
+    'FROM alpine:3\n\\\n',
+    'FROM alpine:3\nRUN a \\\n',
+    '\\\n\\\nFROM alpine:3\n',
+]
+
+
+@pytest.mark.parametrize('content', DOCKERFILES)
+def test_round_trip(content):
+    """The records keep every line of the Dockerfile."""
+    check_round_trip(content)
+
+
+def test_round_trip_file():
+    """The Dockerfile of the test directory."""
+    with open(os.path.join(TEST_DIR, 'Dockerfile'), 'r',
+              newline='') as fhandler:
+        check_round_trip(fhandler.read())
+
+
+def test_crlf():
+    """The CRLF end of lines are not part of the values."""
+    content = 'FROM alpine:3\r\nRUN echo a && \\\r\n    echo b\r\n'
+    assert instructions(content) == [('FROM', 'alpine:3'),
+                                     ('RUN', 'echo a && echo b')]
+
+
+def test_escape_directive():
+    """The escape directive changes the continuation character."""
+    content = '# escape=`\nFROM alpine:3\nRUN echo a `\n    echo b\n'
+    assert instructions(content) == [('FROM', 'alpine:3'),
+                                     ('RUN', 'echo a echo b')]
+
+
+def test_escape_directive_after_instruction():
+    """The directives are only read at the top of the Dockerfile."""
+    content = 'FROM alpine:3\n# escape=`\nRUN echo a `\n'
+    assert instructions(content) == [('FROM', 'alpine:3'),
+                                     ('RUN', 'echo a `')]
+
+
+def test_heredoc():
+    """The heredoc lines belong to their instruction."""
+    content = ('FROM alpine:3\nRUN <<EOF\nFROM debian\n\nEOF\n'
+               'COPY <<-"END" /file\n\tcontent\n\tEND\nUSER app\n')
+    records, from_index = parse_dockerfile(content)
+    assert from_index == [0]
+    assert instructions(content) == [('FROM', 'alpine:3'),
+                                     ('RUN', '<<EOF'),
+                                     ('COPY', '<<-"END" /file'),
+                                     ('USER', 'app')]
+    assert records[1].content == 'RUN <<EOF\nFROM debian\n\nEOF\n'
+
+
+@pytest.mark.parametrize('instruction', [
+    'LABEL a="x<<B"',
+    'RUN python -c "print(1<<x)"',
+])
+def test_not_heredoc(instruction):
+    """'<<' inside a word or outside of RUN/COPY/ADD is not a heredoc."""
+    content = 'FROM alpine:3\n{}\nFROM debian\nRUN a\nB\nx\n'.format(
+        instruction)
+    records, from_index = parse_dockerfile(content)
+    assert from_index == [0, 2]
+    assert [record.instruction for record in records] == [
+        'FROM', instruction.split()[0], 'FROM', 'RUN', 'B', 'X']
+
+
+def test_continuation_comments():
+    """The comments and blank lines inside an instruction are ignored."""
+    content = 'FROM alpine:3\nRUN a \\\n# comment\n\n    b\nUSER app\n'
+    records, _ = parse_dockerfile(content)
+    assert instructions(content) == [('FROM', 'alpine:3'),
+                                     ('RUN', 'a b'),
+                                     ('USER', 'app')]
+    assert (records[1].startline, records[1].endline) == (1, 4)
+
+
+def test_trailing_backslash():
+    """An instruction continued at the end of the file."""
+    assert instructions('FROM alpine:3\nRUN a \\\n') == [
+        ('FROM', 'alpine:3'), ('RUN', 'a')]
+
+
+def test_escape_only():
+    """A line with only the escape character is not an instruction."""
+    content = 'FROM alpine:3\n\\\n'
+    records, from_index = parse_dockerfile(content)
+    assert from_index == [0]
+    assert [record.instruction for record in records] == ['FROM', BLANK]
+    assert instructions('\\\nFROM alpine:3\n') == [('FROM', 'alpine:3')]
+
+
+def test_from_index():
+    """The indexes of the FROM records."""
+    content = '# comment\nFROM alpine:3 AS base\n\nfrom base\nRUN a\n'
+    records, from_index = parse_dockerfile(content)
+    assert from_index == [1, 3]
+    assert records[3].instruction == 'FROM'
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
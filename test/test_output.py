@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Asher256 <asher256@gmail.com>
+# License: LGPL 2.1
+#
+# Github repo: https://github.com/Asher256/dockerfile-patch/
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Tests of the patched Dockerfiles that are not rewritten when unchanged."""
+
+
+import os
+import sys
+import json
+
+import pytest
+
+import dockerfile_patch
+from dockerfile_patch import (DockerfilePatcher, FactsFile, OutputCache,
+                              dockerfile_patch_batch)
+
+
+FACTS = {'debian:12': {'osfamily': 'Debian', 'docker_image_user': 'root'}}
+
+# an old modification time (a rewritten file gets the current time)
+OLD_MTIME = 1000000000
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    """Return a directory with a Dockerfile, a patch and a facts file."""
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'xdg-cache'))
+    (tmp_path / 'app').mkdir()
+    (tmp_path / 'app' / 'Dockerfile').write_bytes(
+        b'FROM debian:12\r\nRUN echo a && \\\r\n    echo b\r\n')
+    (tmp_path / 'patch.j2').write_text('RUN echo {{ osfamily }}\n')
+    (tmp_path / 'facts.json').write_text(json.dumps(FACTS))
+    return tmp_path
+
+
+def patch_batch(project, output_cache=None):
+    """Patch app/Dockerfile and return the result of the batch."""
+    return dockerfile_patch_batch(
+        [str(project / 'app')], [str(project / 'patch.j2')], [],
+        docker_facter=FactsFile(facts=FACTS), output_cache=output_cache)
+
+
+def output_path(project):
+    """Return the path of the patched Dockerfile."""
+    return str(project / 'app' / 'Dockerfile.patched')
+
+
+def run_main(project, monkeypatch, *args):
+    """Run the command line and return its exit status."""
+    monkeypatch.setattr(sys, 'argv', [
+        'dockerfile-patch', '-p', str(project / 'patch.j2'),
+        '--facts-file', str(project / 'facts.json'),
+        '--cache-dir', str(project / 'cache')] + list(args))
+    with pytest.raises(SystemExit) as exc_info:
+        dockerfile_patch.main()
+    return exc_info.value.code
+
+
+def test_save_if_changed(tmp_path):
+    """The file is only written when its content changes."""
+    path = str(tmp_path / 'Dockerfile.patched')
+    dockerfile = DockerfilePatcher()
+    dockerfile.loads('FROM debian:12\n')
+    dockerfile.add_patch('debian:12', 'RUN a')
+
+    assert dockerfile.save_if_changed(path)
+    os.utime(path, (OLD_MTIME, OLD_MTIME))
+    assert not dockerfile.save_if_changed(path)
+    assert os.stat(path).st_mtime == OLD_MTIME
+
+    dockerfile.patches.clear()
+    dockerfile.add_patch('debian:12', 'RUN b')
+    assert dockerfile.save_if_changed(path)
+    assert 'RUN b' in open(path).read()
+
+
+@pytest.mark.parametrize('cached', [False, True])
+def test_unchanged_mtime(project, cached):
+    """An unchanged patched Dockerfile keeps its modification time."""
+    output_cache = OutputCache(str(project / 'cache')) if cached else None
+    path = output_path(project)
+
+    assert patch_batch(project, output_cache) == {path: True}
+    os.utime(path, (OLD_MTIME, OLD_MTIME))
+    assert patch_batch(project, output_cache) == {path: False}
+    assert os.stat(path).st_mtime == OLD_MTIME
+
+
+def test_crlf(project):
+    """The CRLF end of lines are kept and don't cause rewrites."""
+    path = output_path(project)
+    assert patch_batch(project) == {path: True}
+    with open(path, 'rb') as fhandler:
+        content = fhandler.read()
+    assert content.startswith(b'FROM debian:12\r\n')
+    assert content.endswith(b'RUN echo a && \\\r\n    echo b\r\n')
+    assert b'RUN echo Debian\n' in content
+
+    assert patch_batch(project) == {path: False}
+
+
+def test_exit_code(project, monkeypatch):
+    """--exit-code: 2 when the output is modified, 0 when unchanged."""
+    path = output_path(project)
+    args = ('--exit-code', '-o', path, str(project / 'app'))
+    assert run_main(project, monkeypatch, *args) == 2
+    assert run_main(project, monkeypatch, *args) == 0
+    # without --exit-code
+    os.unlink(path)
+    assert run_main(project, monkeypatch, '-o', path,
+                    str(project / 'app')) == 0
+    assert os.path.isfile(path)
+
+
+def test_edited_output(project):
+    """A hand-edited output invalidates the entry of the OutputCache."""
+    output_cache = OutputCache(str(project / 'cache'))
+    path = output_path(project)
+    assert patch_batch(project, output_cache) == {path: True}
+    with open(path, 'rb') as fhandler:
+        expected = fhandler.read()
+
+    with open(path, 'ab') as fhandler:
+        fhandler.write(b'RUN edited\n')
+    assert patch_batch(project, output_cache) == {path: True}
+    with open(path, 'rb') as fhandler:
+        assert fhandler.read() == expected
+    assert patch_batch(project, output_cache) == {path: False}
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Asher256 <asher256@gmail.com>
+# License: LGPL 2.1
+#
+# Github repo: https://github.com/Asher256/dockerfile-patch/
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Tests of the loading of the Jinja2 patches."""
+
+
+import builtins
+
+import pytest
+from jinja2 import TemplateNotFound
+
+from dockerfile_patch import (DockerfilePatchError, load_jinja_patches,
+                              render_patch, template_environment)
+
+
+@pytest.fixture
+def template_env(tmp_path):
+    """Return a Jinja2 environment with its own bytecode cache."""
+    return template_environment(str(tmp_path / 'jinja2'))
+
+
+def write(path, content):
+    """Create a file (and its directory)."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+    return str(path)
+
+
+def render(paths, template_env, facts=None, **kwargs):
+    """Load and render patches."""
+    facts = dict(facts or {}, docker_image_user='root')
+    return render_patch(load_jinja_patches(paths, template_env=template_env,
+                                           **kwargs), facts)
+
+
+def test_include_next_to_includer(tmp_path, template_env):
+    """Each patch includes the 'common.j2' of its own directory."""
+    first = write(tmp_path / 'a' / 'p.j2', "{% include 'common.j2' %}")
+    write(tmp_path / 'a' / 'common.j2', 'RUN a')
+    second = write(tmp_path / 'b' / 'p.j2', "{% include 'common.j2' %}")
+    write(tmp_path / 'b' / 'common.j2', 'RUN b')
+
+    result = render([first, second], template_env)
+    assert 'RUN a' in result and 'RUN b' in result
+
+
+def test_search_path_scope(tmp_path, template_env):
+    """The search path only has the directories of the loaded patches."""
+    for name in ('a', 'b'):
+        write(tmp_path / name / 'inc' / 'body.j2', "{% include 'common.j2' %}")
+        write(tmp_path / name / 'common.j2', 'RUN ' + name)
+        write(tmp_path / name / 'p.j2', "{% include 'inc/body.j2' %}")
+
+    assert 'RUN a' in render([str(tmp_path / 'a' / 'p.j2')], template_env)
+    # the directory of the previous call isn't searched
+    assert 'RUN b' in render([str(tmp_path / 'b' / 'p.j2')], template_env)
+    assert 'RUN a' in render([str(tmp_path / 'a' / 'p.j2')], template_env)
+
+    # an explicit search path
+    assert 'RUN b' in render([str(tmp_path / 'a' / 'p.j2')], template_env,
+                             searchpath=[str(tmp_path / 'b')])
+
+
+def test_include_not_found(tmp_path, template_env):
+    """An include that isn't in the search path is an error."""
+    write(tmp_path / 'a' / 'common.j2', 'RUN a')
+    write(tmp_path / 'a' / 'other.j2', 'RUN other')
+    path = write(tmp_path / 'b' / 'p.j2', "{% include 'common.j2' %}")
+    assert 'RUN other' in render([str(tmp_path / 'a' / 'other.j2')],
+                                 template_env)
+    with pytest.raises(TemplateNotFound):
+        render([path], template_env)
+
+
+def test_read_once(tmp_path, template_env, monkeypatch):
+    """A patch file is read once per load."""
+    path = write(tmp_path / 'p.j2', 'RUN {{ osfamily }}')
+    opened = []
+    real_open = builtins.open
+
+    def counting_open(file, *args, **kwargs):
+        """Count the opened patches."""
+        if file == path:
+            opened.append(file)
+        return real_open(file, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, 'open', counting_open)
+    for _ in range(2):
+        del opened[:]
+        patches = load_jinja_patches([path], template_env=template_env)
+        assert opened == [path]
+        assert patches[0]['content'] == 'RUN {{ osfamily }}'
+        assert render_patch(patches, {'osfamily': 'Debian',
+                                      'docker_image_user': 'root'}) \
+            .strip().endswith('RUN Debian')
+
+
+def test_modified_patch(tmp_path, template_env):
+    """A modified patch is compiled again."""
+    path = write(tmp_path / 'p.j2', 'RUN one')
+    assert 'RUN one' in render([path], template_env)
+    write(tmp_path / 'p.j2', 'RUN two')
+    assert 'RUN two' in render([path], template_env)
+
+
+def test_missing_patch(tmp_path, template_env):
+    """A missing patch is a DockerfilePatchError."""
+    with pytest.raises(DockerfilePatchError):
+        load_jinja_patches([str(tmp_path / 'missing.j2')],
+                           template_env=template_env)
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
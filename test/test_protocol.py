@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Asher256 <asher256@gmail.com>
+# License: LGPL 2.1
+#
+# Github repo: https://github.com/Asher256/dockerfile-patch/
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Tests of the fact script protocol (dockerfile_patch.protocol)."""
+
+
+import pytest
+
+from dockerfile_patch.protocol import (FACTS_PROTOCOL, HEADER, parse_output,
+                                       script_namespace, script_namespaces)
+
+
+def fact_file(index, fact_format, content, size=None):
+    """Return a fact file of the output of the main script (bytes)."""
+    if size is None:
+        size = len(content)
+    return HEADER + ' {} {:06d} {} {}\n'.format(
+        FACTS_PROTOCOL, index, fact_format, size).encode('ascii') + content
+
+
+def test_script_namespace():
+    """The namespace of a script is its name without extension."""
+    assert script_namespace('/a/default-facts.sh') == 'default_facts'
+    assert script_namespace('facts.d/x.y.sh') == 'x'
+    assert script_namespace('.sh') == 'script'
+
+
+def test_script_namespaces():
+    """The scripts with the same name get unique namespaces."""
+    paths = ['default-facts.sh', 'a/facts.sh', 'b/facts.sh', 'facts_3.sh',
+             'c/facts.py']
+    assert script_namespaces(paths) == {'default-facts.sh': 'default_facts',
+                                        'a/facts.sh': 'facts',
+                                        'b/facts.sh': 'facts_3',
+                                        'facts_3.sh': 'facts_3_4',
+                                        'c/facts.py': 'facts_5'}
+
+
+def test_formats():
+    """The JSON, NUL and YAML fact files are merged (later scripts win)."""
+    output = (fact_file(1, 'json', b'{"a": 1, "b": [1, 2]}') +
+              fact_file(2, 'nul', b'b=x\0c= y=z \0invalid\0') +
+              fact_file(3, 'yaml', b'd: {e: f}\nc: yaml\n'))
+    facts = parse_output(output, ['one', 'two', 'three'])
+    assert facts.pop('scripts') == {'one': {'a': 1, 'b': [1, 2]},
+                                    'two': {'b': 'x', 'c': ' y=z '},
+                                    'three': {'d': {'e': 'f'},
+                                              'c': 'yaml'}}
+    assert facts == {'a': 1, 'b': 'x', 'c': 'yaml', 'd': {'e': 'f'}}
+
+
+def test_same_name():
+    """Two scripts with the same name are not merged."""
+    paths = ['a/facts.sh', 'b/facts.sh']
+    namespaces = script_namespaces(paths)
+    output = fact_file(1, 'json', b'{"x": 1}') + \
+        fact_file(2, 'json', b'{"y": 2}')
+    facts = parse_output(output, [namespaces[path] for path in paths])
+    assert facts['scripts'] == {'facts': {'x': 1}, 'facts_2': {'y': 2}}
+
+
+def test_empty_output():
+    """No fact file: no facts."""
+    assert parse_output(b'', ['one']) == {}
+
+
+def test_without_header():
+    """An output without header is YAML (first protocol)."""
+    assert parse_output(b'osfamily: Debian\n', ['one']) == \
+        {'osfamily': 'Debian'}
+    assert parse_output(b'osfamily: Debian', []) == {'osfamily': 'Debian'}
+
+
+@pytest.mark.parametrize('output', [
+    HEADER,
+    HEADER + b' 2 000001 json',
+    fact_file(1, 'json', b'{}')[:-3],
+    HEADER + b' 2 000001 json\n{}',
+])
+def test_truncated_header(output):
+    """A truncated header is an error."""
+    with pytest.raises(ValueError):
+        parse_output(output, ['one'])
+
+
+@pytest.mark.parametrize('output', [
+    fact_file(1, 'json', b'{"a": 1}', size=20),
+    fact_file(1, 'json', b'{"a": 1}', size=5),
+    fact_file(1, 'json', b'{"a": 1}', size=-1),
+])
+def test_size_mismatch(output):
+    """The size of the header doesn't match the fact file."""
+    with pytest.raises(ValueError):
+        parse_output(output, ['one'])
+
+
+@pytest.mark.parametrize('output', [
+    fact_file(2, 'json', b'{}'),
+    fact_file(0, 'json', b'{}'),
+    fact_file(1, 'xml', b'<a/>'),
+    fact_file(1, 'json', b'[1]'),
+    fact_file(1, 'yaml', b'a: [1'),
+    HEADER + ' {} 000001 json 2\n{{}}'.format(FACTS_PROTOCOL + 1)
+    .encode('ascii'),
+])
+def test_invalid_output(output):
+    """Unknown scripts and formats, invalid facts, newer protocols."""
+    with pytest.raises(ValueError):
+        parse_output(output, ['one'])
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
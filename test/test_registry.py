@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Asher256 <asher256@gmail.com>
+# License: LGPL 2.1
+#
+# Github repo: https://github.com/Asher256/dockerfile-patch/
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Tests of the registry fact engine (dockerfile_patch.registry)."""
+
+
+import io
+import contextlib
+
+import pytest
+
+from dockerfile_patch.registry import (RegistryError, base_layer_scanned,
+                                       scan_base_layer)
+
+
+LAYER = {'digest': 'sha256:' + '0' * 64}
+
+
+class Client(object):
+    """A RegistryClient that returns the same blob."""
+
+    def __init__(self, content):
+        """Init the client."""
+        self.content = content
+
+    @contextlib.contextmanager
+    def blob(self, registry, repository, digest):
+        """Return the blob."""
+        yield io.BytesIO(self.content)
+
+
+def test_stop_after_etc():
+    """The download stops after /etc when an osfamily file was found."""
+    files = {'etc/debian_version': ('file', b'12'),
+             'etc/os-release': ('link', '../usr/lib/os-release')}
+    assert not base_layer_scanned('etc/zz', files)
+    assert not base_layer_scanned('etc', {})
+    assert base_layer_scanned('etc.d', files)
+    assert base_layer_scanned('usr/bin/bash', files)
+
+
+def test_stop_without_os_release_link():
+    """/usr/lib/os-release is only needed through the /etc link."""
+    assert base_layer_scanned('usr', {})
+    assert base_layer_scanned('usr', {'etc/os-release': ('file', b'ID=x')})
+
+
+def test_os_release_link():
+    """The download goes on to /usr/lib/os-release."""
+    files = {'etc/os-release': ('link', '../usr/lib/os-release')}
+    assert not base_layer_scanned('usr/bin/bash', files)
+    assert not base_layer_scanned('usr/lib/os-release', files)
+    assert base_layer_scanned('usr/lib/os-release.d', files)
+    assert base_layer_scanned('usr/lib64', files)
+    assert base_layer_scanned('var', files)
+
+
+def test_unknown_compression():
+    """A layer that can't be read (e.g. zstd) is a RegistryError."""
+    client = Client(b'\x28\xb5\x2f\xfd' + b'\0' * 64)
+    with pytest.raises(RegistryError):
+        scan_base_layer(client, 'registry', 'repository', LAYER)
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Asher256 <asher256@gmail.com>
+# License: LGPL 2.1
+#
+# Github repo: https://github.com/Asher256/dockerfile-patch/
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Tests of the stages of multi-stage Dockerfiles."""
+
+
+import pytest
+
+from dockerfile_patch import DockerfilePatcher, DockerfilePatchError
+from dockerfile_patch.instructions import (build_stages, parse_dockerfile,
+                                           substitute_args)
+
+
+def stages(content, build_args=None):
+    """Return the stages of a Dockerfile."""
+    records, from_index = parse_dockerfile(content)
+    return build_stages(records, from_index, build_args)
+
+
+def patched(content, build_args=None):
+    """Return a Dockerfile patched with 'PATCH <image>' for each image."""
+    dockerfile = DockerfilePatcher(build_args=build_args)
+    dockerfile.loads(content)
+    for image in dockerfile.get_base_images():
+        dockerfile.add_patch(image, 'RUN patch ' + image)
+    return dockerfile.to_str()
+
+
+def test_substitute_args():
+    """$NAME, ${NAME}, ${NAME:-default} and ${NAME:+alternative}."""
+    args = {'A': 'a', 'EMPTY': ''}
+    assert substitute_args('$A-${A}', args) == 'a-a'
+    assert substitute_args('${UNSET:-d} ${EMPTY:-d} ${A:-d}', args) == \
+        'd d a'
+    assert substitute_args('${A:+x} ${UNSET:+x}', args) == 'x '
+    assert substitute_args('x$UNSET', args) == 'x'
+
+
+def test_aliases():
+    """The stages built upon a previous stage resolve to its image."""
+    result = stages('FROM ubuntu:22.04 AS Base\nFROM base AS final\n'
+                    'FROM final\n')
+    assert [stage.alias for stage in result] == ['base', 'final', None]
+    assert [stage.root_image for stage in result] == ['ubuntu:22.04'] * 3
+    assert result[0].parent is None
+    assert result[1].parent is result[0]
+    assert result[2].parent is result[1]
+
+
+def test_scratch():
+    """'FROM scratch' has no external image."""
+    result = stages('FROM scratch AS empty\nFROM empty\nFROM alpine\n')
+    assert [stage.root_image for stage in result] == [None, None, 'alpine']
+    dockerfile = DockerfilePatcher()
+    dockerfile.loads('FROM scratch\nCOPY app /\n')
+    assert dockerfile.get_base_images() == []
+
+
+def test_arg_defaults():
+    """The global ARGs are substituted in the FROM lines."""
+    content = ('ARG BASE=ubuntu\nARG VERSION="22.04"\n'
+               'FROM ${BASE}:${VERSION} AS build\nARG BASE=debian\n'
+               'FROM $BASE\n')
+    assert [stage.image for stage in stages(content)] == \
+        ['ubuntu:22.04', 'ubuntu']
+
+
+def test_build_args():
+    """--build-arg overrides the default values of the ARGs."""
+    content = 'ARG BASE=ubuntu\nARG VERSION\nFROM ${BASE}:${VERSION:-22.04}\n'
+    assert stages(content)[0].image == 'ubuntu:22.04'
+    assert stages(content, {'BASE': 'debian', 'VERSION': '12'})[0].image == \
+        'debian:12'
+    # the build args of undeclared ARGs are not used
+    assert stages('FROM ${BASE:-alpine}\n', {'BASE': 'debian'})[0].image == \
+        'alpine'
+
+
+def test_platform():
+    """The value of --platform is kept (the ARGs are substituted)."""
+    result = stages('ARG ARCH=arm64\nFROM --platform=linux/$ARCH alpine\n'
+                    'FROM --platform=$BUILDPLATFORM alpine\nFROM alpine\n')
+    assert [stage.platform for stage in result] == \
+        ['linux/arm64', None, None]
+    assert [stage.image for stage in result] == ['alpine'] * 3
+
+
+def test_platform_warning(caplog):
+    """The stages of another platform are reported."""
+    from dockerfile_patch.registry import default_platform
+
+    other = 'linux/s390x' if default_platform() != 'linux/s390x' \
+        else 'linux/amd64'
+    DockerfilePatcher().loads('FROM --platform={} alpine AS a\n'
+                              'FROM --platform={} a\n'
+                              'FROM --platform={} debian\n'
+                              .format(other, other, default_platform()))
+    warnings = [record.getMessage() for record in caplog.records
+                if record.levelname == 'WARNING']
+    assert len(warnings) == 1
+    assert other + ' alpine' in warnings[0]
+
+
+def test_unset_image():
+    """A FROM line with an empty image is an error."""
+    with pytest.raises(ValueError):
+        stages('FROM ubuntu\nFROM ${UNSET}\n')
+    with pytest.raises(DockerfilePatchError):
+        DockerfilePatcher().loads('ARG BASE\nFROM $BASE AS build\n')
+
+
+def test_derived_stages():
+    """The derived stages are not patched a second time."""
+    content = ('FROM ubuntu AS base\nUSER app\nFROM base AS final\n'
+               'FROM ubuntu AS other\nFROM scratch\n')
+    assert patched(content) == (
+        'FROM ubuntu AS base\n'
+        "\n#-------- 'ubuntu' dockerfile-patch --------\n"
+        'RUN patch ubuntu\n'
+        "#-------- 'ubuntu' dockerfile-patch --------\n\n"
+        'USER app\nFROM base AS final\n'
+        'FROM ubuntu AS other\n'
+        "\n#-------- 'ubuntu' dockerfile-patch --------\n"
+        'RUN patch ubuntu\n'
+        "#-------- 'ubuntu' dockerfile-patch --------\n\n"
+        'FROM scratch\n')
+
+
+def test_base_images():
+    """The external images, without duplicates and with the build args."""
+    dockerfile = DockerfilePatcher(build_args={'TAG': '12'})
+    dockerfile.loads('ARG TAG=11\nFROM debian:$TAG AS a\nFROM a\n'
+                     'FROM alpine\nFROM debian:12\n')
+    assert dockerfile.get_base_images() == ['debian:12', 'alpine']
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8